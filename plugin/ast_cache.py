@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+import clang.cindex
+from common import content_hash
+
+
+class AstCache(object):
+    """
+    Persists parsed translation units on disk so that they can be loaded with
+    TranslationUnit.from_ast_file() instead of being parsed again after a
+    restart. Entries are keyed by file name and compile arguments and are only
+    used while the contents of the file and of every file it includes are
+    unchanged. Once the entries exceed the size limit, the least recently used
+    ones are removed.
+
+    An empty directory disables the cache.
+    """
+
+    def __init__(self, directory, size_limit):
+        self._directory = os.path.expanduser(directory) if directory else None
+        self._size_limit = size_limit
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return self._directory is not None
+
+    def load(self, index, file, args, variant=""):
+        """variant distinguishes translation units of the same file and
+        arguments parsed with different options."""
+        if not self._directory:
+            return None
+
+        base = self._entry_base_name(file[0], args, variant)
+        manifest = self._read_manifest(base)
+        if not manifest or not self._is_valid(manifest, file):
+            return None
+
+        try:
+            translation_unit = clang.cindex.TranslationUnit.from_ast_file(base + ".ast", index)
+        except clang.cindex.TranslationUnitLoadError:
+            return None
+
+        self._mark_used(base)
+        return translation_unit
+
+    def store(self, translation_unit, file, args, variant=""):
+        if not self._directory:
+            return
+
+        base = self._entry_base_name(file[0], args, variant)
+        try:
+            manifest = dict({
+                'file_name': file[0],
+                'content_hash': content_hash(file[1]),
+                'includes': self._include_signatures(translation_unit, file[0])})
+            self._ensure_directory_exists()
+            translation_unit.save(base + ".ast.tmp")
+            with open(base + ".json.tmp", "w") as f:
+                json.dump(manifest, f)
+            os.rename(base + ".ast.tmp", base + ".ast")
+            os.rename(base + ".json.tmp", base + ".json")
+        except (clang.cindex.TranslationUnitSaveError, IOError, OSError):
+            self._remove_if_exists(base + ".ast.tmp")
+            self._remove_if_exists(base + ".json.tmp")
+            return
+
+        self._enforce_size_limit()
+
+    def _entry_base_name(self, file_name, args, variant):
+        key = hashlib.sha1("\0".join([file_name, variant] + list(args))).hexdigest()
+        return os.path.join(self._directory, key)
+
+    def _include_signatures(self, translation_unit, file_name):
+        signatures = {}
+        for inclusion in translation_unit.get_includes():
+            include_name = inclusion.include.name
+            if include_name != file_name and include_name not in signatures:
+                signatures[include_name] = self._file_signature(include_name)
+        return signatures
+
+    def _file_signature(self, file_name):
+        status = os.stat(file_name)
+        with open(file_name, "rb") as f:
+            return [status.st_mtime, status.st_size, content_hash(f.read())]
+
+    def _is_valid(self, manifest, file):
+        if manifest.get('content_hash') != content_hash(file[1]):
+            return False
+
+        for include_name, (mtime, size, digest) in manifest['includes'].items():
+            try:
+                status = os.stat(include_name)
+            except OSError:
+                return False
+            if status.st_size != size:
+                return False
+            # Only hash the contents if the time stamp indicates a change.
+            if status.st_mtime != mtime:
+                try:
+                    with open(include_name, "rb") as f:
+                        if content_hash(f.read()) != digest:
+                            return False
+                except IOError:
+                    return False
+        return True
+
+    def _read_manifest(self, base):
+        try:
+            with open(base + ".json", "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _mark_used(self, base):
+        try:
+            os.utime(base + ".ast", None)
+        except OSError:
+            pass
+
+    def _ensure_directory_exists(self):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+    def _remove_if_exists(self, file_name):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
+
+    def _enforce_size_limit(self):
+        with self._lock:
+            entries = []
+            for file_name in os.listdir(self._directory):
+                if file_name.endswith(".ast"):
+                    path = os.path.join(self._directory, file_name)
+                    try:
+                        status = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((status.st_mtime, status.st_size, path))
+
+            total_size = sum(size for mtime, size, path in entries)
+            for mtime, size, path in sorted(entries):
+                if total_size <= self._size_limit:
+                    break
+                self._remove_if_exists(path)
+                self._remove_if_exists(path[:-len(".ast")] + ".json")
+                total_size -= size
@@ -214,6 +214,14 @@ class SourceLocation(Structure):
         """Get the file offset represented by this source location."""
         return self._get_instantiation()[3]
 
+    @property
+    def is_in_system_header(self):
+        """Whether the location is in a system header, False if libclang
+        cannot tell."""
+        if conf.function_exists("clang_Location_isInSystemHeader"):
+            return conf.lib.clang_Location_isInSystemHeader(self) != 0
+        return False
+
     def __eq__(self, other):
         return conf.lib.clang_equalLocations(self, other)
 
@@ -1131,6 +1139,14 @@ class Cursor(Structure):
 
         return self._displayname
 
+    @property
+    def brief_comment(self):
+        """Return the brief documentation comment of the declaration, None if
+        it has none."""
+        if conf.function_exists("clang_Cursor_getBriefCommentText"):
+            return conf.lib.clang_Cursor_getBriefCommentText(self) or None
+        return None
+
     @property
     def location(self):
         """
@@ -1673,6 +1689,78 @@ class _CXUnsavedFile(Structure):
     """Helper for passing unsaved file arguments."""
     _fields_ = [("name", c_char_p), ("contents", c_char_p), ('length', c_ulong)]
 
+class UnsavedFiles(object):
+    """
+    In-memory contents of files, kept in a single array of _CXUnsavedFile
+    that is handed to every parse, reparse and code completion. The array
+    refers to the content strings instead of copying them and is only
+    rebuilt when a file is added, removed or given new contents.
+    """
+
+    def __init__(self, unsaved_files=None):
+        self._contents = {}
+        self._names = []
+        self._array = None
+        for name, contents in unsaved_files or []:
+            self.set(name, contents)
+
+    def set(self, name, contents):
+        if hasattr(contents, "read"):
+            contents = contents.read()
+        if not isinstance(contents, str):
+            raise TypeError('Unexpected unsaved file contents.')
+        if name not in self._contents:
+            self._names.append(name)
+        elif self._contents[name] is contents:
+            return
+        self._contents[name] = contents
+        self._array = None
+
+    def remove(self, name):
+        if self._contents.pop(name, None) is not None:
+            self._names.remove(name)
+            self._array = None
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._contents
+
+    def __iter__(self):
+        return ((name, self._contents[name]) for name in self._names)
+
+    def array(self):
+        """The array to pass to libclang, None if there are no files."""
+        if self._array is None and self._names:
+            array = (_CXUnsavedFile * len(self._names))()
+            for i, name in enumerate(self._names):
+                contents = self._contents[name]
+                array[i].name = name
+                array[i].contents = contents
+                array[i].length = len(contents)
+            self._array = array
+        return self._array
+
+def _unsaved_files_array(unsaved_files):
+    """Returns the array and number of unsaved files, given either
+    UnsavedFiles or a list of pairs of file name and contents."""
+    if unsaved_files is None:
+        return None, 0
+    if not isinstance(unsaved_files, UnsavedFiles):
+        unsaved_files = UnsavedFiles(unsaved_files)
+    return unsaved_files.array(), len(unsaved_files)
+
+class _CXTUResourceUsageEntry(Structure):
+    """Helper for reading a single entry of a translation unit's resource
+    usage."""
+    _fields_ = [("kind", c_int), ("amount", c_ulong)]
+
+class _CXTUResourceUsage(Structure):
+    """Helper for reading the resource usage of a translation unit."""
+    _fields_ = [("data", c_void_p), ("numEntries", c_uint),
+                ("entries", POINTER(_CXTUResourceUsageEntry))]
+
 # Functions calls through the python interface are rather slow. Fortunately,
 # for most symboles, we do not need to perform a function call. Their spelling
 # never changes and is consequently provided by this spelling cache.
@@ -1879,6 +1967,58 @@ class CodeCompletionResults(ClangObject):
     def results(self):
         return self.ptr.contents
 
+    def extract(self):
+        """
+        Returns a tuple per result of typed text, word, result type,
+        placeholder spans, cursor kind number, priority and availability
+        number, walking all results in one loop.
+
+        The word joins the spellings of all chunks but the informative ones
+        and the result type. Placeholder spans are (start, end) offsets into
+        the word. This is much faster than iterating the results' strings, as
+        no CompletionString or CompletionChunk is created and chunks of fixed
+        spelling are not asked for their text.
+        """
+        lib = conf.lib
+        num_chunks = lib.clang_getNumCompletionChunks
+        chunk_kind = lib.clang_getCompletionChunkKind
+        chunk_text = lib.clang_getCompletionChunkText
+        get_priority = lib.clang_getCompletionPriority
+        get_availability = lib.clang_getCompletionAvailability
+        spellings = SpellingCache
+
+        structure = self.ptr.contents
+        results = structure.results
+        extracted = []
+        for i in xrange(structure.numResults):
+            result = results[i]
+            cs = result.completionString
+            typed_text = ""
+            result_type = ""
+            spans = []
+            parts = []
+            length = 0
+            for key in xrange(num_chunks(cs)):
+                kind = chunk_kind(cs, key)
+                if kind == 4: # Informative
+                    continue
+                spelling = spellings.get(kind)
+                if spelling is None:
+                    spelling = chunk_text(cs, key).spelling or ""
+                if kind == 15: # ResultType
+                    result_type = spelling
+                    continue
+                if kind == 1: # TypedText
+                    typed_text = spelling
+                elif kind == 3: # Placeholder
+                    spans.append((length, length + len(spelling)))
+                parts.append(spelling)
+                length += len(spelling)
+            extracted.append((typed_text, "".join(parts), result_type, spans,
+                              result.cursorKind, get_priority(cs),
+                              get_availability(cs)))
+        return extracted
+
     @property
     def diagnostics(self):
         class DiagnosticsItr:
@@ -1894,6 +2034,58 @@ class CodeCompletionResults(ClangObject):
 
         return DiagnosticsItr(self)
 
+    @property
+    def contexts(self):
+        """The CompletionContext flags of the kinds of entities that may be
+        completed at the completion position."""
+        return conf.lib.clang_codeCompleteGetContexts(self)
+
+    @property
+    def container_usr(self):
+        """The USR of the entity completed in, e.g. of the class of the object
+        before a member access. Empty if there is none."""
+        return conf.lib.clang_codeCompleteGetContainerUSR(self)
+
+    @property
+    def container_kind(self):
+        """The CursorKind of the entity completed in, and whether its
+        declaration is incomplete, so only some of its members are known."""
+        incomplete = c_uint()
+        kind = conf.lib.clang_codeCompleteGetContainerKind(self, byref(incomplete))
+        return CursorKind.from_id(kind), bool(incomplete.value)
+
+
+class CompletionContext(object):
+    """
+    Flags of the kinds of entities that may be completed at a position, see
+    CodeCompletionResults.contexts.
+    """
+
+    UNEXPOSED = 0
+    ANY_TYPE = 1 << 0
+    ANY_VALUE = 1 << 1
+    OBJC_OBJECT_VALUE = 1 << 2
+    OBJC_SELECTOR_VALUE = 1 << 3
+    CXX_CLASS_TYPE_VALUE = 1 << 4
+    DOT_MEMBER_ACCESS = 1 << 5
+    ARROW_MEMBER_ACCESS = 1 << 6
+    OBJC_PROPERTY_ACCESS = 1 << 7
+    ENUM_TAG = 1 << 8
+    UNION_TAG = 1 << 9
+    STRUCT_TAG = 1 << 10
+    CLASS_TAG = 1 << 11
+    NAMESPACE = 1 << 12
+    NESTED_NAME_SPECIFIER = 1 << 13
+    OBJC_INTERFACE = 1 << 14
+    OBJC_PROTOCOL = 1 << 15
+    OBJC_CATEGORY = 1 << 16
+    OBJC_INSTANCE_MESSAGE = 1 << 17
+    OBJC_CLASS_MESSAGE = 1 << 18
+    OBJC_SELECTOR_NAME = 1 << 19
+    MACRO_NAME = 1 << 20
+    NATURAL_LANGUAGE = 1 << 21
+    UNKNOWN = (1 << 22) - 1
+
 
 class Index(ClangObject):
     """
@@ -2018,9 +2210,6 @@ class TranslationUnit(ClangObject):
         if args is None:
             args = []
 
-        if unsaved_files is None:
-            unsaved_files = []
-
         if index is None:
             index = Index.create()
 
@@ -2028,20 +2217,11 @@ class TranslationUnit(ClangObject):
         if len(args) > 0:
             args_array = (c_char_p * len(args))(* args)
 
-        unsaved_array = None
-        if len(unsaved_files) > 0:
-            unsaved_array = (_CXUnsavedFile * len(unsaved_files))()
-            for i, (name, contents) in enumerate(unsaved_files):
-                if hasattr(contents, "read"):
-                    contents = contents.read()
-
-                unsaved_array[i].name = name
-                unsaved_array[i].contents = contents
-                unsaved_array[i].length = len(contents)
+        unsaved_array, unsaved_count = _unsaved_files_array(unsaved_files)
 
         ptr = conf.lib.clang_parseTranslationUnit(index, filename, args_array,
                                     len(args), unsaved_array,
-                                    len(unsaved_files), options)
+                                    unsaved_count, options)
 
         if ptr is None:
             raise TranslationUnitLoadError("Error parsing translation unit.")
@@ -2113,6 +2293,32 @@ class TranslationUnit(ClangObject):
 
         return iter(includes)
 
+    def get_resource_usage(self):
+        """
+        Return a dictionary mapping the names of the resources libclang
+        allocated for this translation unit (e.g. "AST: ASTContext: expressions,
+        declarations, and types") to the number of bytes they occupy.
+        """
+        if not conf.function_exists("clang_getCXTUResourceUsage"):
+            return {}
+
+        usage = conf.lib.clang_getCXTUResourceUsage(self)
+        try:
+            result = {}
+            for i in xrange(usage.numEntries):
+                entry = usage.entries[i]
+                name = conf.lib.clang_getTUResourceUsageName(entry.kind)
+                result[name] = entry.amount
+            return result
+        finally:
+            conf.lib.clang_disposeCXTUResourceUsage(usage)
+
+    @property
+    def memory_usage(self):
+        """Get the total number of bytes libclang holds for this translation
+        unit."""
+        return sum(self.get_resource_usage().values())
+
     def get_file(self, filename):
         """Obtain a File from this translation unit."""
 
@@ -2202,25 +2408,10 @@ class TranslationUnit(ClangObject):
         as unsaved_files, the first items should be the filenames to be mapped
         and the second should be the contents to be substituted for the
         file. The contents may be passed as strings or file objects.
+        Passing UnsavedFiles instead reuses their array.
         """
-        if unsaved_files is None:
-            unsaved_files = []
-
-        unsaved_files_array = 0
-        if len(unsaved_files):
-            unsaved_files_array = (_CXUnsavedFile * len(unsaved_files))()
-            for i,(name,value) in enumerate(unsaved_files):
-                if not isinstance(value, str):
-                    # FIXME: It would be great to support an efficient version
-                    # of this, one day.
-                    value = value.read()
-                    print value
-                if not isinstance(value, str):
-                    raise TypeError,'Unexpected unsaved file contents.'
-                unsaved_files_array[i].name = name
-                unsaved_files_array[i].contents = value
-                unsaved_files_array[i].length = len(value)
-        ptr = conf.lib.clang_reparseTranslationUnit(self, len(unsaved_files),
+        unsaved_files_array, unsaved_count = _unsaved_files_array(unsaved_files)
+        ptr = conf.lib.clang_reparseTranslationUnit(self, unsaved_count,
                 unsaved_files_array, options)
 
     def save(self, filename):
@@ -2255,6 +2446,7 @@ class TranslationUnit(ClangObject):
         as unsaved_files, the first items should be the filenames to be mapped
         and the second should be the contents to be substituted for the
         file. The contents may be passed as strings or file objects.
+        Passing UnsavedFiles instead reuses their array.
         """
         options = 0
 
@@ -2267,25 +2459,9 @@ class TranslationUnit(ClangObject):
         if include_brief_comments:
             options += 4
 
-        if unsaved_files is None:
-            unsaved_files = []
-
-        unsaved_files_array = 0
-        if len(unsaved_files):
-            unsaved_files_array = (_CXUnsavedFile * len(unsaved_files))()
-            for i,(name,value) in enumerate(unsaved_files):
-                if not isinstance(value, str):
-                    # FIXME: It would be great to support an efficient version
-                    # of this, one day.
-                    value = value.read()
-                    print value
-                if not isinstance(value, str):
-                    raise TypeError,'Unexpected unsaved file contents.'
-                unsaved_files_array[i].name = name
-                unsaved_files_array[i].contents = value
-                unsaved_files_array[i].length = len(value)
+        unsaved_files_array, unsaved_count = _unsaved_files_array(unsaved_files)
         ptr = conf.lib.clang_codeCompleteAt(self, path, line, column,
-                unsaved_files_array, len(unsaved_files), options)
+                unsaved_files_array, unsaved_count, options)
         if ptr:
             return CodeCompletionResults(ptr)
         return None
@@ -2573,6 +2749,19 @@ functionList = [
    [TranslationUnit, c_char_p, c_int, c_int, c_void_p, c_int, c_int],
    POINTER(CCRStructure)),
 
+  ("clang_codeCompleteGetContainerKind",
+   [CodeCompletionResults, POINTER(c_uint)],
+   c_int),
+
+  ("clang_codeCompleteGetContainerUSR",
+   [CodeCompletionResults],
+   _CXString,
+   _CXString.from_result),
+
+  ("clang_codeCompleteGetContexts",
+   [CodeCompletionResults],
+   c_ulonglong),
+
   ("clang_codeCompleteGetDiagnostic",
    [CodeCompletionResults, c_int],
    Diagnostic),
@@ -2608,8 +2797,8 @@ functionList = [
   ("clang_disposeCodeCompleteResults",
    [CodeCompletionResults]),
 
-# ("clang_disposeCXTUResourceUsage",
-#  [CXTUResourceUsage]),
+  ("clang_disposeCXTUResourceUsage",
+   [_CXTUResourceUsage]),
 
   ("clang_disposeDiagnostic",
    [Diagnostic]),
@@ -2750,9 +2939,9 @@ functionList = [
    _CXString,
    _CXString.from_result),
 
-# ("clang_getCXTUResourceUsage",
-#  [TranslationUnit],
-#  CXTUResourceUsage),
+  ("clang_getCXTUResourceUsage",
+   [TranslationUnit],
+   _CXTUResourceUsage),
 
   ("clang_getCXXAccessSpecifier",
    [Cursor],
@@ -3063,6 +3252,15 @@ functionList = [
    [Cursor, callbacks['cursor_visit'], py_object],
    c_uint),
 
+  ("clang_Cursor_getBriefCommentText",
+   [Cursor],
+   _CXString,
+   _CXString.from_result),
+
+  ("clang_Location_isInSystemHeader",
+   [SourceLocation],
+   c_int),
+
   ("clang_Cursor_getNumArguments",
    [Cursor],
    c_int),
@@ -3227,6 +3425,7 @@ register_enumerations()
 __all__ = [
     'Config',
     'CodeCompletionResults',
+    'CompletionContext',
     'CompilationDatabase',
     'CompileCommands',
     'CompileCommand',
@@ -3244,4 +3443,5 @@ __all__ = [
     'TranslationUnit',
     'TypeKind',
     'Type',
+    'UnsavedFiles',
 ]
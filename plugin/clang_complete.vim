@@ -96,6 +96,66 @@ function! s:ClangCompleteInit()
     let g:clang_sort_algo = 'priority'
   endif
 
+  if !exists('g:clang_translation_unit_memory_budget')
+    let g:clang_translation_unit_memory_budget = 2048
+  endif
+
+  if !exists('g:clang_use_compilation_database')
+    let g:clang_use_compilation_database = 1
+  endif
+
+  if !exists('g:clang_ast_cache_directory')
+    let g:clang_ast_cache_directory = ''
+  endif
+
+  if !exists('g:clang_ast_cache_size')
+    let g:clang_ast_cache_size = 4096
+  endif
+
+  if !exists('g:clang_watch_files')
+    let g:clang_watch_files = 1
+  endif
+
+  if !exists('g:clang_min_parser_threads')
+    let g:clang_min_parser_threads = 1
+  endif
+
+  if !exists('g:clang_max_parser_threads')
+    let g:clang_max_parser_threads = 0
+  endif
+
+  if !exists('g:clang_worker_processes')
+    let g:clang_worker_processes = 0
+  endif
+
+  if !exists('g:clang_worker_python')
+    let g:clang_worker_python = 'python'
+  endif
+
+  if !exists('g:clang_completion_limit')
+    let g:clang_completion_limit = 50
+  endif
+
+  if !exists('g:clang_completion_timeout')
+    let g:clang_completion_timeout = 0
+  endif
+
+  if !exists('g:clang_stream_completions')
+    let g:clang_stream_completions = 1
+  endif
+
+  if !exists('g:clang_completion_documentation')
+    let g:clang_completion_documentation = 1
+  endif
+
+  if !exists('g:clang_prefetch_completions')
+    let g:clang_prefetch_completions = 1
+  endif
+
+  if !exists('g:clang_symbol_index_file')
+    let g:clang_symbol_index_file = ''
+  endif
+
   if !exists('g:clang_auto_user_options')
     let g:clang_auto_user_options = 'path, .clang_complete'
   endif
@@ -167,6 +227,12 @@ function! s:ClangCompleteInit()
     augroup end
   endif
 
+  if g:clang_prefetch_completions == 1
+    augroup ClangComplete
+      autocmd CursorHoldI <buffer> call <SID>PrefetchCompletions()
+    augroup end
+  endif
+
   setlocal completefunc=ClangComplete
   setlocal omnifunc=ClangComplete
 
@@ -253,12 +319,43 @@ function! s:initClangCompletePython()
 
     augroup ClangComplete
       autocmd BufReadPost *.cpp,*.c,*.h python clang_plugin.file_opened()
+      autocmd BufWinEnter * python clang_plugin.visible_files_changed()
+      autocmd BufWinLeave * python clang_plugin.visible_files_changed(vim.eval("expand('<afile>:p')"))
+      autocmd BufWritePost *.cpp,*.c,*.h python clang_plugin.file_saved()
       autocmd VimLeave * python clang_plugin.terminate()
+      if exists('##CompleteDone')
+        autocmd CompleteDone * call <SID>CompletionAccepted()
+      endif
+      if exists('##CompleteChanged') && exists('*popup_findinfo')
+        autocmd CompleteChanged * call <SID>ShowCompletionDocumentation()
+      endif
     augroup end
   let s:clang_plugin_loaded = 1
   endif
 endfunction
 
+function! s:CompletionAccepted()
+  if exists('v:completed_item') && has_key(v:completed_item, 'abbr')
+    python clang_plugin.completion_accepted(vim.eval("v:completed_item['abbr']"), vim.eval("get(v:completed_item, 'user_data', '')"))
+  endif
+endfunction
+
+function! s:ShowCompletionDocumentation()
+  if !g:clang_completion_documentation || &completefunc !=# 'ClangComplete'
+        \ || empty(v:event.completed_item)
+    return
+  endif
+  python clang_plugin.show_completion_documentation(vim.eval("v:event.completed_item['abbr']"))
+endfunction
+
+function! g:CalledFromPythonClangShowDocumentation(documentation)
+  let l:id = popup_findinfo()
+  if l:id
+    call popup_settext(l:id, split(a:documentation, "\n", 1))
+    call popup_show(l:id)
+  endif
+endfunction
+
 function! s:NoopKeypress()
   if mode() == "n"
     call feedkeys("f\e", "n")
@@ -294,6 +391,13 @@ function! s:DoPeriodicQuickFix()
 
 endfunction
 
+function! s:PrefetchCompletions()
+  if pumvisible() || !s:ShouldComplete()
+    return
+  endif
+  python clang_plugin.prefetch_completions()
+endfunction
+
 function! g:CalledFromPythonClangDisplayQuickFix(quick_fix)
   " Clear the bad spell, the user may have corrected them.
   syntax clear SpellBad
@@ -345,15 +449,14 @@ function! ClangComplete(findstart, base)
       call b:ResetSnip()
     endif
 
-    python vim.command('let l:res = ' + str(clang_plugin.get_current_completions(vim.eval('a:base'))))
-
-    for item in l:res
-      if g:clang_snippets == 1
-        let item['word'] = b:AddSnip(item['info'], item['args_pos'])
-      else
-        let item['word'] = item['abbr']
-      endif
-    endfor
+    if g:clang_stream_completions == 1
+      " The completions are added by CalledFromPythonClangAddCompletions.
+      let l:res = []
+      python clang_plugin.stream_current_completions(vim.eval('a:base'))
+    else
+      python vim.command('let l:res = ' + str(clang_plugin.get_current_completions(vim.eval('a:base'))))
+      call map(l:res, 's:CompletionItem(v:val)')
+    endif
 
     inoremap <expr> <buffer> <C-Y> <SID>HandlePossibleSelectionCtrlY()
     augroup ClangComplete
@@ -364,10 +467,29 @@ function! ClangComplete(findstart, base)
   if g:clang_debug == 1
     echom 'clang_complete: completion time '. split(reltimestr(reltime(l:time_start)))[0]
   endif
-  return l:res
+  " Only the best completions are returned, ask for them again as the user
+  " types.
+  return {'words': l:res, 'refresh': 'always'}
 endif
 endfunction
 
+function! s:CompletionItem(item)
+  if g:clang_snippets == 1
+    let a:item['word'] = b:AddSnip(a:item['info'], a:item['args_pos'])
+  else
+    " Declarations of headers not included yet must be qualified.
+    let a:item['word'] = get(a:item, 'qualified_name', a:item['abbr'])
+  endif
+  return a:item
+endfunction
+
+function! g:CalledFromPythonClangAddCompletions(completions)
+  for l:item in a:completions
+    call complete_add(s:CompletionItem(l:item))
+  endfor
+  return complete_check()
+endfunction
+
 function! s:HandlePossibleSelectionEnter()
   if pumvisible()
     let b:snippet_chosen = 1
@@ -1,10 +1,21 @@
-from common import SingleResultWorker, TickingDispatcher, abort_after_first_call
+from common import Generations, MovingAverages, SingleResultWorker, TickingDispatcher, abort_after_first_call, listen_and_map
 from completion import Completer
 from finding import DeclarationFinder, DefinitionFinder
-from highlighting import InterestingRangeHighlighter, export_and_highlight_range_if_in_current_file
+from highlighting import InterestingRangeHighlighter, collect_interesting_ranges, export_and_highlight_range_if_in_current_file, \
+    interesting_range_collector, styles_and_actions
 from translation_unit_access import TranslationUnitAccessor
+from worker_pool import WorkerPool
 import actions
 import clang.cindex
+import parse_profiles
+import threading
+import time
+
+
+# Bounds in seconds of the time to wait for the user to stop editing before
+# analyzing the current file.
+MINIMUM_IDLE_WINDOW = 0.02
+MAXIMUM_IDLE_WINDOW = 2.0
 
 
 def make_clang_plugin(editor, clang_complete_flags, library_path):
@@ -16,63 +27,217 @@ def make_clang_plugin(editor, clang_complete_flags, library_path):
 
     translation_unit_accessor = TranslationUnitAccessor(editor)
 
-    return ClangPlugin(editor, translation_unit_accessor, clang_complete_flags)
+    worker_processes = editor.worker_processes()
+    if worker_processes > 0:
+        worker_pool = WorkerPool(editor, worker_processes, library_path)
+    else:
+        worker_pool = None
 
+    return ClangPlugin(editor, translation_unit_accessor, clang_complete_flags, worker_pool)
 
-class CurrentTranslationUnitAccess(object):
-    def __init__(self, translation_unit_accessor):
-        self._translation_unit_accessor = translation_unit_accessor
+
+class FileAnalysis(object):
+    """
+    Analyzes the current file whenever it changed and passes the result to
+    the listeners.
+
+    Requests and results for an older generation of the file than the latest
+    requested one are dropped. Before analyzing, it waits for the user to
+    stop editing for about as long as analyzing the file usually takes.
+    Cheap files are thus analyzed immediately, while expensive files are not
+    analyzed after every keystroke. The latest request is always analyzed.
+    """
+
+    def __init__(self):
         self._listeners = []
+        self._generations = Generations()
+        self._analysis_costs = MovingAverages()
+        self._request_arrived = threading.Event()
         self._worker = SingleResultWorker(self._process)
 
     def terminate(self):
         self._worker.terminate()
+        self._request_arrived.set()
 
-    def file_changed(self, file):
-        self._worker.request(file)
+    def file_changed(self, file, generation=None):
+        if generation is not None:
+            self._generations.request(file[0], generation)
+        self._worker.request((file, generation))
+        self._request_arrived.set()
 
     def add_listener(self, listener):
         self._listeners.append(listener)
 
-    def _process(self, file):
+    def _process(self, request):
+        file, generation = request
+        if self._generations.is_superseded(file[0], generation):
+            return
+        if not self._wait_for_idle_window(file[0]):
+            return
 
-        def do_it(translation_unit):
+        started = time.time()
+
+        def notify(result):
+            self._analysis_costs.add(file[0], time.time() - started)
+            if self._generations.is_superseded(file[0], generation):
+                return
             for listener in self._listeners:
-                listener(translation_unit)
+                listener(result)
+
+        self._analyze(file, notify)
+
+    def _wait_for_idle_window(self, file_name):
+        """Returns False if another request arrived in the meantime."""
+        idle_window = min(MAXIMUM_IDLE_WINDOW, self._analysis_costs.get(file_name, 0))
+        if idle_window < MINIMUM_IDLE_WINDOW:
+            return True
+        self._request_arrived.clear()
+        if self._worker.has_pending_request():
+            return False
+        return not self._request_arrived.wait(idle_window)
+
+    def _analyze(self, file, notify):
+        raise NotImplementedError
+
+
+class CurrentTranslationUnitAccess(FileAnalysis):
+    """Passes the translation unit of the current file to the listeners."""
+
+    def __init__(self, translation_unit_accessor):
+        FileAnalysis.__init__(self)
+        self._translation_unit_accessor = translation_unit_accessor
+
+    def _analyze(self, file, notify):
+        self._translation_unit_accessor.file_changed(file)
+        self._translation_unit_accessor.translation_unit_do(file, notify, parse_profiles.INTERACTIVE)
 
-        self._translation_unit_accessor.clear_caches()
-        self._translation_unit_accessor.translation_unit_do(file, do_it)
+
+class WorkerPoolAnalysis(FileAnalysis):
+    """Analyzes the current file in a worker process, or in this process once
+    the worker pool gave up. Listeners are passed pairs of a quick fix list
+    and the interesting ranges of the file."""
+
+    def __init__(self, worker_pool, translation_unit_accessor, editor):
+        FileAnalysis.__init__(self)
+        self._worker_pool = worker_pool
+        self._translation_unit_accessor = translation_unit_accessor
+        self._collect_interesting_ranges = interesting_range_collector(styles_and_actions(editor))
+
+    def _analyze(self, file, notify):
+        if not self._worker_pool.alive():
+            self._translation_unit_accessor.file_changed(file)
+            self._translation_unit_accessor.translation_unit_do(
+                file, lambda tu: notify(self._collect_interesting_ranges(tu)), parse_profiles.INTERACTIVE)
+            return
+        self._worker_pool.file_changed(file)
+        result = self._worker_pool.analyze(file)
+        if result is not None:
+            notify(result)
 
 
 class ClangPlugin(object):
-    def __init__(self, editor, translation_unit_accessor, clang_complete_flags):
+    def __init__(self, editor, translation_unit_accessor, clang_complete_flags, worker_pool=None):
 
         self._editor = editor
         self._translation_unit_accessor = translation_unit_accessor
+        self._worker_pool = worker_pool
         self._definition_finder = DefinitionFinder(self._editor, self._translation_unit_accessor)
         self._declaration_finder = DeclarationFinder(self._editor, self._translation_unit_accessor)
-        self._completer = Completer(self._editor, self._translation_unit_accessor, int(clang_complete_flags))
-        self._current_translation_unit_access = CurrentTranslationUnitAccess(self._translation_unit_accessor)
+        self._completer = Completer(self._editor, self._translation_unit_accessor, int(clang_complete_flags), worker_pool)
         self._dispatcher = TickingDispatcher()
-        self._interesting_range_highlighter = InterestingRangeHighlighter(self._current_translation_unit_access, self._dispatcher, self._editor)
+        if worker_pool:
+            self._current_translation_unit_access = WorkerPoolAnalysis(
+                worker_pool, self._translation_unit_accessor, self._editor)
+            interesting_ranges = listen_and_map(self._current_translation_unit_access, lambda result: result)
+        else:
+            self._current_translation_unit_access = CurrentTranslationUnitAccess(self._translation_unit_accessor)
+            interesting_ranges = collect_interesting_ranges(self._current_translation_unit_access, self._editor)
+        self._interesting_range_highlighter = InterestingRangeHighlighter(interesting_ranges, self._dispatcher, self._editor)
+        self._modified_buffer_ticks = {}
 
     def terminate(self):
         self._current_translation_unit_access.terminate()
+        self._completer.terminate()
         self._translation_unit_accessor.terminate()
+        if self._worker_pool:
+            self._worker_pool.terminate()
 
     def file_changed(self):
-        self._editor.display_message("File change was notified, clearing all caches.")
-        self._current_translation_unit_access.file_changed(self._editor.current_file())
+        self._editor.display_message("File change was notified.")
+        self._translation_unit_accessor.user_active()
+        self._modified_buffers_changed()
+        self._current_translation_unit_access.file_changed(
+            self._editor.current_file(), self._editor.changedtick())
         self.tick()
 
+    def _modified_buffers_changed(self):
+        """Pass the buffers whose unsaved changes changed since last time, and
+        those that are no longer modified, on to the parsers."""
+        buffers = self._editor.modified_buffers()
+        ticks = dict((file_name, changedtick) for file_name, changedtick, contents in buffers)
+        changed_files = [(file_name, contents) for file_name, changedtick, contents in buffers
+                         if self._modified_buffer_ticks.get(file_name) != changedtick]
+        unmodified_file_names = [file_name for file_name in self._modified_buffer_ticks if file_name not in ticks]
+        self._modified_buffer_ticks = ticks
+        if not changed_files and not unmodified_file_names:
+            return
+        current_file_name = self._editor.file_name()
+        if [file_name for file_name, contents in changed_files if file_name != current_file_name] or [
+                file_name for file_name in unmodified_file_names if file_name != current_file_name]:
+            # Completions in the current file may depend on the other files.
+            self._completer.invalidate_cache()
+        self._translation_unit_accessor.modified_buffers_changed(changed_files, unmodified_file_names)
+        if self._worker_pool:
+            self._worker_pool.modified_buffers_changed(changed_files, unmodified_file_names)
+
+    def _worker_pool_alive(self):
+        """Whether files are parsed in worker processes. Once the pool gave
+        up, they are parsed in this process again."""
+        return self._worker_pool is not None and self._worker_pool.alive()
+
     def tick(self):
         self._dispatcher.tick()
 
     def file_opened(self):
         self._editor.display_message("Noticed opening of new file")
-        self._translation_unit_accessor.enqueue_translation_unit_creation(self._editor.current_file())
+        self.visible_files_changed()
+        if self._worker_pool_alive():
+            self._worker_pool.enqueue_parse(self._editor.current_file())
+        else:
+            self._translation_unit_accessor.enqueue_translation_unit_creation(self._editor.current_file())
+
+    def file_saved(self):
+        self._modified_buffers_changed()
+        file = self._editor.current_file()
+        self._translation_unit_accessor.file_changed(file)
+        if self._worker_pool:
+            self._worker_pool.file_changed(file)
+
+    def includers_of(self, file_name):
+        return self._translation_unit_accessor.includers_of(file_name)
+
+    def visible_files_changed(self, leaving_file_name=None):
+        """leaving_file_name is the file about to leave its last window, which
+        is still listed as visible while leaving."""
+        file_names = [file_name for file_name in self._editor.visible_file_names()
+                      if file_name != leaving_file_name]
+        self._translation_unit_accessor.visible_files_changed(file_names)
+        if self._worker_pool:
+            self._worker_pool.visible_files_changed(file_names)
+
+    def translation_unit_cache_statistics(self):
+        return self._translation_unit_accessor.translation_unit_cache_statistics()
+
+    def parser_thread_utilization(self):
+        return self._translation_unit_accessor.parser_thread_utilization()
 
     def jump_to_definition(self):
+        if self._worker_pool_alive():
+            location = self._worker_pool.definition_location(
+                self._editor.current_file(), self._editor.current_location())
+            if location:
+                self._editor.open_file(location.file_name, location.line, location.column)
+            return
         abort_after_first_call(self._editor.open_location,
                                self._definition_finder.definition_locations_do)
 
@@ -82,8 +247,40 @@ class ClangPlugin(object):
 
     def get_current_completions(self, base):
         "TODO: This must be synchronized as well, but as it runs in a separate thread it gets a bit more complete"
+        self._translation_unit_accessor.user_active()
+        self._modified_buffers_changed()
         return self._completer.get_current_completions(base)
 
+    def stream_current_completions(self, base):
+        self._translation_unit_accessor.user_active()
+        self._modified_buffers_changed()
+        self._completer.stream_current_completions(base)
+
+    def completion_accepted(self, abbreviation, include=""):
+        """include is the #include directive the completion needs, if it is
+        of a header not included yet."""
+        self._completer.completion_accepted(abbreviation)
+        if include:
+            self._editor.insert_include(include)
+
+    def show_completion_documentation(self, abbreviation):
+        documentation = self._completer.current_documentation(abbreviation)
+        if documentation:
+            self._editor.show_completion_documentation(documentation)
+
+    def prefetch_completions(self):
+        self._modified_buffers_changed()
+        self._completer.prefetch_completions()
+
+    def completion_prefetch_statistics(self):
+        return self._completer.prefetch_statistics()
+
+    def container_completion_statistics(self):
+        return self._completer.container_statistics()
+
+    def symbol_index_statistics(self):
+        return self._translation_unit_accessor.symbol_index().statistics()
+
     def find_references_to_outside_of_selection(self):
         def do_it(translation_unit):
             return actions.find_references_to_outside_of_selection(
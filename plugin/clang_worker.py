@@ -0,0 +1,207 @@
+"""
+Entry point of the processes started by worker_pool.WorkerPool. Reads
+pickled messages from stdin and writes pickled responses, tagged with the id
+of their request, to stdout.
+"""
+import cPickle as pickle
+import os
+import sys
+import threading
+import time
+import traceback
+import Queue
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import clang.cindex
+from common import ExportedLocation, abort_after_first_call
+from completion import Completer
+from finding import DefinitionFinder
+from highlighting import interesting_range_collector, styles_and_actions
+from translation_unit_access import TranslationUnitAccessor
+import parse_profiles
+
+
+# Requests answered on a thread of their own, so that they do not wait for
+# analyses, which may parse for seconds.
+COMPLETION_REQUESTS = frozenset(['complete', 'completion_documentation'])
+
+
+class WorkerEditor(object):
+    """Stands in for the editor inside a worker process. Holds the settings
+    the worker was configured with and the state of the current request."""
+
+    def __init__(self, configuration):
+        self._configuration = configuration
+        self._user_options = []
+        self._current_file = None
+        self._current_location = None
+
+    def translation_unit_memory_budget(self):
+        return self._configuration['translation_unit_memory_budget']
+
+    def use_compilation_database(self):
+        return self._configuration['use_compilation_database']
+
+    def ast_cache_directory(self):
+        return self._configuration['ast_cache_directory']
+
+    def ast_cache_size_limit(self):
+        return self._configuration['ast_cache_size_limit']
+
+    def symbol_index_file(self):
+        return self._configuration['symbol_index_file']
+
+    def watch_files(self):
+        return self._configuration['watch_files']
+
+    def minimum_parser_threads(self):
+        return 1
+
+    def maximum_parser_threads(self):
+        return self._configuration['maximum_parser_threads']
+
+    def excluded_directories(self):
+        return self._configuration['excluded_directories']
+
+    def user_options(self):
+        return self._user_options
+
+    def set_user_options(self, user_options):
+        self._user_options = user_options
+
+    def set_current(self, file, location):
+        self._current_file = file
+        self._current_location = location
+
+    def current_file(self):
+        return self._current_file
+
+    def file_name(self):
+        return self._current_file[0]
+
+    def current_location(self):
+        return self._current_location
+
+    def display_message(self, message):
+        if self._configuration['debug']:
+            with open("clang_log.txt", "a") as f:
+                f.write("%s - [worker %d] %s\n" % (time.time(), self._configuration['worker_id'], message))
+
+
+class WorkerServer(object):
+    def __init__(self, configuration):
+        self._editor = WorkerEditor(configuration)
+        self._accessor = TranslationUnitAccessor(self._editor)
+        self._completers = {}
+        self._collect_interesting_ranges = interesting_range_collector(styles_and_actions(self._editor))
+
+    def terminate(self):
+        self._accessor.terminate()
+
+    def handle(self, kind, args):
+        try:
+            return getattr(self, "_handle_" + kind)(*args)
+        except Exception:
+            self._editor.display_message(traceback.format_exc())
+            return None
+
+    def _handle_parse(self, file, user_options):
+        self._editor.set_user_options(user_options)
+        self._accessor.enqueue_translation_unit_creation(file)
+
+    def _handle_file_changed(self, file):
+        self._accessor.file_changed(file)
+
+    def _handle_modified_buffers_changed(self, changed_files, unmodified_file_names):
+        self._accessor.modified_buffers_changed(changed_files, unmodified_file_names)
+
+    def _handle_visible_files_changed(self, file_names):
+        self._accessor.visible_files_changed(file_names)
+
+    def _completer(self, complete_flags):
+        # Completers are kept, as they remember completions by container.
+        completer = self._completers.get(complete_flags)
+        if completer is None:
+            completer = self._completers[complete_flags] = Completer(self._editor, self._accessor, complete_flags)
+        return completer
+
+    def _handle_complete(self, file, user_options, line, column, complete_flags, base, inserted=""):
+        self._editor.set_user_options(user_options)
+        return self._completer(complete_flags).complete(file, line, column, base, inserted)
+
+    def _handle_completion_documentation(self, file, user_options, line, column, abbreviation):
+        self._editor.set_user_options(user_options)
+        return self._completer(0).documentation(file, line, column, abbreviation)
+
+    def _handle_analyze(self, file, user_options):
+        self._editor.set_user_options(user_options)
+        self._accessor.file_changed(file)
+        return self._accessor.translation_unit_do(file, self._collect_interesting_ranges, parse_profiles.INTERACTIVE)
+
+    def _handle_definition_location(self, file, user_options, location):
+        self._editor.set_user_options(user_options)
+        self._editor.set_current(file, location)
+        finder = DefinitionFinder(self._editor, self._accessor)
+        locations = []
+        abort_after_first_call(
+            lambda location: locations.append(ExportedLocation.from_clang_location(location)),
+            finder.definition_locations_do)
+        if locations:
+            return locations[0]
+        return None
+
+
+def main():
+    # Responses go to the original stdout. Everything else printing to
+    # stdout, including libclang, must not corrupt them.
+    responses = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    messages = sys.stdin
+
+    configuration = pickle.load(messages)
+    if configuration['library_path']:
+        clang.cindex.Config.set_library_path(configuration['library_path'])
+    clang.cindex.Config.set_compatibility_check(False)
+    server = WorkerServer(configuration)
+
+    # Notifications are handled as they arrive, even while requests are
+    # being answered. Completion requests are answered on one thread, all
+    # other requests on another, each in the order they arrived.
+    response_lock = threading.Lock()
+    completion_requests = Queue.Queue()
+    other_requests = Queue.Queue()
+
+    def answer(requests):
+        while True:
+            request_id, kind, args = requests.get()
+            result = server.handle(kind, args)
+            with response_lock:
+                pickle.dump((request_id, result), responses, pickle.HIGHEST_PROTOCOL)
+                responses.flush()
+
+    for requests, name in [(completion_requests, "CompletionRequests"), (other_requests, "OtherRequests")]:
+        thread = threading.Thread(target=answer, args=(requests,), name=name)
+        thread.daemon = True
+        thread.start()
+
+    while True:
+        try:
+            kind, args, request_id = pickle.load(messages)
+        except EOFError:
+            break
+        if request_id is None:
+            server.handle(kind, args)
+        elif kind in COMPLETION_REQUESTS:
+            completion_requests.put((request_id, kind, args))
+        else:
+            other_requests.put((request_id, kind, args))
+
+    server.terminate()
+    # The idle parser threads are not daemons.
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
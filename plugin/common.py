@@ -1,3 +1,7 @@
+import hashlib
+import heapq
+import itertools
+import os
 import threading
 import Queue
 
@@ -44,6 +48,14 @@ class ExportedLocation(object):
         return cls(clang_location.file.name if clang_location.file else None, clang_location.line, clang_location.column)
 
 
+def content_hash(contents):
+    return hashlib.sha1(contents).hexdigest()
+
+
+def normalized_file_name(file_name):
+    return os.path.normpath(os.path.abspath(file_name))
+
+
 def get_definition_or_reference(cursor):
     definition = cursor.get_definition()
     if definition:
@@ -53,10 +65,13 @@ def get_definition_or_reference(cursor):
 
 
 class Worker(object):
-    def __init__(self, consume_request, in_queue):
+    def __init__(self, consume_request, in_queue, wait_until_allowed=None):
+        """wait_until_allowed is called before taking each request and may
+        block to hold the worker back."""
         self._alive = True
         self._consume_request = consume_request
         self._in_queue = in_queue
+        self._wait_until_allowed = wait_until_allowed
         self._thread = threading.Thread(target=self._run, name="Worker").start()
 
     def terminate(self):
@@ -64,6 +79,10 @@ class Worker(object):
 
     def _run(self):
         while True:
+            if self._wait_until_allowed:
+                self._wait_until_allowed()
+                if not self._alive:
+                    return
             request = self._in_queue.get()
             if not self._alive:
                 return
@@ -91,6 +110,133 @@ class ReplacingSingleElementQueue(object):
     def get(self):
         return self._queue.get()
 
+    def empty(self):
+        return self._queue.empty()
+
+
+class IndexedPriorityQueue(object):
+    """
+    A blocking priority queue of unique keys. Lower priorities are taken
+    first, equal priorities in the order they were put. Putting a queued key
+    again only changes anything if the new priority is lower, which promotes
+    the key.
+
+    To prevent starvation, entries age: an entry is taken before entries of
+    the next lower priority that were put more than aging puts after it.
+
+    Removed and promoted entries stay in the heap and are skipped when taken,
+    until they make up half of it.
+    """
+
+    def __init__(self, aging=1000):
+        self._aging = aging
+        self._heap = []
+        self._entries = {}
+        self._sequence = itertools.count()
+        self._not_empty = threading.Condition()
+
+    def __len__(self):
+        with self._not_empty:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._not_empty:
+            return key in self._entries
+
+    def priority_of(self, key):
+        with self._not_empty:
+            entry = self._entries.get(key)
+            return entry[1] if entry else None
+
+    def put(self, key, priority=0):
+        """Returns whether key was added or promoted."""
+        with self._not_empty:
+            entry = self._entries.get(key)
+            if entry:
+                if entry[1] <= priority:
+                    return False
+                sequence = entry[2]
+                self._invalidate(entry)
+            else:
+                sequence = next(self._sequence)
+            entry = [priority * self._aging + sequence, priority, sequence, key, True]
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            self._not_empty.notify()
+            return True
+
+    def remove(self, key):
+        """Returns whether key was queued."""
+        with self._not_empty:
+            entry = self._entries.get(key)
+            if not entry:
+                return False
+            self._invalidate(entry)
+            return True
+
+    def get(self):
+        """Block until a key is queued. Returns the priority and the key."""
+        with self._not_empty:
+            while not self._entries:
+                self._not_empty.wait()
+            while True:
+                entry = heapq.heappop(self._heap)
+                if entry[4]:
+                    del self._entries[entry[3]]
+                    return entry[1], entry[3]
+
+    def _invalidate(self, entry):
+        entry[4] = False
+        del self._entries[entry[3]]
+        if len(self._heap) > 2 * len(self._entries) + 32:
+            self._heap = [queued for queued in self._heap if queued[4]]
+            heapq.heapify(self._heap)
+
+
+class Generations(object):
+    """
+    Remembers the latest generation requested for each file, e.g. the
+    buffer's b:changedtick. Work for an older generation of a file is
+    superseded: its result is outdated before it is finished.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}
+
+    def request(self, file_name, generation):
+        with self._lock:
+            if generation > self._latest.get(file_name, generation - 1):
+                self._latest[file_name] = generation
+
+    def is_superseded(self, file_name, generation):
+        if generation is None:
+            return False
+        with self._lock:
+            return generation < self._latest.get(file_name, generation)
+
+
+class MovingAverages(object):
+    """Exponential moving averages of values measured per key, e.g. of the
+    time parsing a file takes."""
+
+    def __init__(self, weight=0.3):
+        self._weight = weight
+        self._lock = threading.Lock()
+        self._averages = {}
+
+    def add(self, key, value):
+        with self._lock:
+            average = self._averages.get(key)
+            if average is None:
+                self._averages[key] = value
+            else:
+                self._averages[key] = average + self._weight * (value - average)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._averages.get(key, default)
+
 
 class SingleResultWorker(object):
     def __init__(self, consume_request):
@@ -106,6 +252,9 @@ class SingleResultWorker(object):
     def request(self, request):
         self._request.put(request)
 
+    def has_pending_request(self):
+        return not self._request.empty()
+
     def peek_result(self):
         return self._result.get_nowait()
 
@@ -0,0 +1,200 @@
+import json
+import os
+import shlex
+import threading
+
+
+DATABASE_FILE_NAME = "compile_commands.json"
+
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx', '.c++', '.m', '.mm')
+
+# Options whose value is a path that must be made absolute, as libclang does
+# not know about the directory the compile command was run in. The path
+# follows the option as the next argument, or for the directory options also
+# attached to it. Options are matched exactly, so that e.g. -include-pch is
+# not taken for -include.
+PATH_OPTIONS = frozenset(['-I', '-isystem', '-iquote', '-idirafter', '-include',
+                          '-include-pch', '-imacros', '-F'])
+ATTACHED_PATH_OPTIONS = ('-isystem', '-iquote', '-idirafter', '-I', '-F')
+
+# Options that only make sense when actually compiling, together with the
+# number of values they take.
+IGNORED_OPTIONS = {'-c': 0, '-o': 1, '-MD': 0, '-MMD': 0, '-MF': 1, '-MT': 1,
+                   '-MQ': 1}
+
+
+class CompilationDatabase(object):
+    """
+    An index from file names to compile arguments that is read from a
+    compile_commands.json. The index is loaded on first use and loaded again
+    whenever the modification time of the json file changes.
+    """
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._arguments = {}
+        self._source_files_by_stem = {}
+        self._inferred_arguments = {}
+
+    def arguments_for(self, file_name):
+        """Return the arguments to parse file_name with or None if neither the
+        file nor a similar source file is part of the database."""
+        file_name = os.path.abspath(file_name)
+        with self._lock:
+            self._load_if_changed()
+            try:
+                return self._arguments[file_name]
+            except KeyError:
+                pass
+            try:
+                return self._inferred_arguments[file_name]
+            except KeyError:
+                arguments = self._infer_arguments(file_name)
+                self._inferred_arguments[file_name] = arguments
+                return arguments
+
+    def _load_if_changed(self):
+        try:
+            mtime = os.stat(self._file_name).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        self._arguments = {}
+        self._source_files_by_stem = {}
+        self._inferred_arguments = {}
+
+        try:
+            with open(self._file_name, "r") as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        for entry in entries:
+            try:
+                directory = entry['directory']
+                source_name = os.path.normpath(os.path.join(directory, entry['file']))
+                if 'arguments' in entry:
+                    command = map(encode, entry['arguments'])
+                else:
+                    command = shlex.split(encode(entry['command']))
+            except (KeyError, ValueError):
+                continue
+            self._arguments[source_name] = sanitize_arguments(command, encode(directory), encode(entry['file']))
+            stem = os.path.splitext(os.path.basename(source_name))[0]
+            self._source_files_by_stem.setdefault(stem, []).append(source_name)
+
+    def _infer_arguments(self, file_name):
+        """Headers usually have no compile command. Use the arguments of the
+        source file with the same name, or else of the source file sharing the
+        longest directory prefix."""
+        stem = os.path.splitext(os.path.basename(file_name))[0]
+        candidates = self._source_files_by_stem.get(stem) or self._arguments.keys()
+        if not candidates:
+            return None
+
+        def common_prefix_length(source_name):
+            return len(os.path.commonprefix([source_name, file_name]))
+
+        return self._arguments[max(candidates, key=common_prefix_length)]
+
+
+def encode(string):
+    "libclang expects byte strings, json returns unicode strings."
+    if isinstance(string, unicode):
+        return string.encode('utf-8')
+    return string
+
+
+def sanitize_arguments(command, directory, source_file):
+    """Drop the compiler, the source file and everything related to output
+    from a compile command and make paths absolute. Options passed on with
+    -Xclang, e.g. "-Xclang -include-pch -Xclang foo.pch", have their path in
+    the argument after the second -Xclang."""
+    result = []
+    arguments = command[1:]
+    i = 0
+    while i < len(arguments):
+        argument = arguments[i]
+        i += 1
+        if argument in IGNORED_OPTIONS:
+            i += IGNORED_OPTIONS[argument]
+            continue
+        if argument.startswith('-o') or argument == source_file:
+            continue
+        if os.path.splitext(argument)[1] in SOURCE_EXTENSIONS and not argument.startswith('-'):
+            continue
+
+        if argument == '-Xclang' and i < len(arguments):
+            option = arguments[i]
+            i += 1
+            result += [argument, option]
+            if option in PATH_OPTIONS and arguments[i:i + 1] == ['-Xclang'] and i + 1 < len(arguments):
+                result += ['-Xclang', os.path.join(directory, arguments[i + 1])]
+                i += 2
+            continue
+
+        if argument in PATH_OPTIONS:
+            if i < len(arguments):
+                result += [argument, os.path.join(directory, arguments[i])]
+                i += 1
+            continue
+
+        for option in ATTACHED_PATH_OPTIONS:
+            if argument.startswith(option) and len(argument) > len(option):
+                argument = option + os.path.join(directory, argument[len(option):])
+                break
+        result.append(argument)
+    return result
+
+
+class CompilationDatabases(object):
+    """Finds the compile_commands.json responsible for a file by walking up
+    from the file's directory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._database_file_for_directory = {}
+        self._databases = {}
+
+    def arguments_for(self, file_name):
+        database = self._database_for(os.path.dirname(os.path.abspath(file_name)))
+        if database:
+            return database.arguments_for(file_name)
+        return None
+
+    def _database_for(self, directory):
+        with self._lock:
+            database_file = self._find_database_file(directory)
+            if not database_file:
+                return None
+            try:
+                return self._databases[database_file]
+            except KeyError:
+                database = CompilationDatabase(database_file)
+                self._databases[database_file] = database
+                return database
+
+    def _find_database_file(self, directory):
+        """Only found files are remembered, as a compile_commands.json may be
+        generated later, e.g. by running cmake."""
+        try:
+            return self._database_file_for_directory[directory]
+        except KeyError:
+            pass
+
+        candidate = os.path.join(directory, DATABASE_FILE_NAME)
+        if os.path.isfile(candidate):
+            result = candidate
+        else:
+            parent_directory = os.path.dirname(directory)
+            if parent_directory == directory:
+                result = None
+            else:
+                result = self._find_database_file(parent_directory)
+        if result:
+            self._database_file_for_directory[directory] = result
+        return result
@@ -1,131 +1,497 @@
+import Queue
+import collections
 import threading
+import time
+import parse_profiles
+from common import content_hash, normalized_file_name
+from completion_containers import ContainerCompletions, line_text
+from completion_documentation import CompletionDocumentation
+from ranking import CompletionRanker
+from symbol_index import include_directive
 
 
-class Completer(object):
+# Number of threads completing, each for a different file.
+COMPLETION_THREADS = 2
 
-    def __init__(self, editor, translation_unit_accessor, complete_flags):
-        self._editor = editor
-        self._translation_unit_accessor = translation_unit_accessor
-        self._complete_flags = complete_flags
+# Number of completion positions whose results are kept for refiltering.
+CACHED_COMPLETIONS = 8
 
-    def format_results(self, result):
-        completion = dict()
-        return_value = None
-        abbr = ""
-        args_pos = []
-        cur_pos = 0
-        word = ""
+# Number of completions passed to the editor at once when streaming them, a
+# screenful of the popup menu.
+STREAMED_COMPLETIONS = 20
 
-        for chunk in result.string:
+# Priority of the completions of headers not included yet, below clang's
+# priority of any completion it offers.
+INDEXED_PRIORITY = 90
 
-            if chunk.isKindInformative():
-                continue
+# Number of characters of a name typed before headers not included yet are
+# looked up, as nearly every short prefix matches some declaration.
+INDEXED_PREFIX_LENGTH = 2
 
-            if chunk.isKindResultType():
-                return_value = chunk
-                continue
+# Operators after which completion is requested.
+MEMBER_ACCESS_TRIGGERS = ('.', '->', '::')
 
-            chunk_spelling = chunk.spelling
+# Words after which a member access is not expected.
+KEYWORDS = frozenset("""
+    auto bool break case char class const continue default delete do double
+    else enum extern float for goto if inline int long namespace new operator
+    private protected public register return short signed sizeof static
+    struct switch template typedef typename union unsigned using virtual void
+    volatile while""".split())
 
-            if chunk.isKindTypedText():
-                abbr = chunk_spelling
 
-            chunk_len = len(chunk_spelling)
-            if chunk.isKindPlaceHolder():
-                args_pos += [[cur_pos, cur_pos + chunk_len]]
-            cur_pos += chunk_len
-            word += chunk_spelling
+class Completer(object):
 
+    def __init__(self, editor, translation_unit_accessor, complete_flags, worker_pool=None):
+        self._editor = editor
+        self._translation_unit_accessor = translation_unit_accessor
+        self._complete_flags = complete_flags
+        self._worker_pool = worker_pool
+        self._service = None
+        self._cache = CompletionCache()
+        self._ranker = CompletionRanker()
+        self._containers = ContainerCompletions()
+        self._documentation = CompletionDocumentation(translation_unit_accessor)
+        # The position of the latest completion, whose completions the
+        # documentation is asked for.
+        self._completed_at = None
+        # The key and future of the latest speculative completion.
+        self._prefetched = None
+        self._prefetches = 0
+        self._prefetch_hits = 0
+        self._prefetch_misses = 0
+
+    def terminate(self):
+        if self._service:
+            self._service.terminate()
+
+    def format_result(self, typed_text, word, result_type, placeholder_spans, cursor_kind, include=None,
+                      qualified_name=None):
+        """include is the directive to insert when the completion is
+        accepted, for completions of headers not included yet. Their
+        qualified_name is inserted instead of the typed text without
+        snippets."""
         menu = word
+        if result_type:
+            menu = result_type + " " + menu
+        if include:
+            menu += "  [" + include + "]"
 
-        if return_value:
-            menu = return_value.spelling + " " + menu
-
+        completion = dict()
         completion['word'] = word
-        completion['abbr'] = abbr
+        completion['abbr'] = typed_text
         completion['menu'] = menu
         completion['info'] = word
-        completion['args_pos'] = args_pos
+        completion['args_pos'] = [list(span) for span in placeholder_spans]
         completion['dup'] = 1
 
         # Replace the number that represents a specific kind with a better
         # textual representation.
-        completion['kind'] = kinds[result.cursorKind]
+        completion['kind'] = kinds[cursor_kind]
+        if include:
+            completion['user_data'] = include
+        if qualified_name and qualified_name != typed_text:
+            completion['qualified_name'] = qualified_name
 
         return completion
 
-    def get_current_completions(self, base):
+    def completion_accepted(self, abbreviation):
+        """Rank the completion higher from now on."""
+        self._ranker.accepted(abbreviation)
 
-        sorting = self._editor.sort_algorithm()
+    def invalidate_cache(self):
+        """Forget all cached completions, e.g. because a header changed."""
+        self._cache.clear()
 
-        thread = CompleteThread(self._editor,
-                                self._translation_unit_accessor,
-                                self._complete_flags,
-                                self._editor.current_line(),
-                                self._editor.current_column())
+    def get_current_completions(self, base):
+        """The completions are cached by the position of the completed token
+        and the contents before it. Typing more of the token only ranks the
+        cached completions again. Only the best ones are formatted and
+        passed to the editor, more follow as the typed token narrows them
+        down."""
+        return [self.format_result(*result) for priority, abbr, result in self._best_completions(base)]
+
+    def stream_current_completions(self, base, batch_size=STREAMED_COMPLETIONS):
+        """Like get_current_completions, but adds the completions to the
+        editor in batches, best first, so the first ones show before the
+        others are formatted. Stops once the user typed."""
+        entries = self._best_completions(base)
+        for start in range(0, len(entries), batch_size):
+            batch = [self.format_result(*result) for priority, abbr, result in entries[start:start + batch_size]]
+            if self._editor.add_completions(batch):
+                return
+
+    def _best_completions(self, base):
+        sorting = self._editor.sort_algorithm()
 
-        thread.start()
-        while thread.is_alive():
-            thread.join(0.01)
-            if self._editor.abort_requested():
+        file = self._editor.current_file()
+        line = self._editor.current_line()
+        column = self._editor.current_column()
+        self._completed_at = (line, column)
+        key = CompletionCache.key(file, line, column)
+        all_entries = self._cache.get(key)
+        if all_entries is None:
+            all_entries = self._prefetched_completions(key)
+        if all_entries is None:
+            self._prefetch_misses += 1
+            all_entries = self._wait(self._completion_service().submit(file, line, column, ""))
+            if all_entries is None:
                 return []
-        completionResult = thread.result
-        if completionResult is None:
+            self._cache.put(key, all_entries)
+        indexed_entries = self._indexed_entries(file, line, column, base, all_entries)
+        if indexed_entries:
+            all_entries = all_entries + indexed_entries
+        return self._ranker.best(all_entries, base, self._editor.completion_limit(), sorting)
+
+    def _indexed_entries(self, file, line, column, base, entries):
+        """Entries for the declarations of headers the file does not include
+        yet that start with base, unless a name is completed in a class or
+        namespace."""
+        accessor = self._translation_unit_accessor
+        if accessor is None or len(base) < INDEXED_PREFIX_LENGTH:
+            return []
+        index = accessor.symbol_index()
+        if not index.enabled():
+            return []
+        if line_text(file[1], line)[:column - 1].rstrip().endswith(MEMBER_ACCESS_TRIGGERS):
+            return []
+        symbols = index.lookup(base, self._editor.completion_limit() or STREAMED_COMPLETIONS)
+        if not symbols:
             return []
 
-        results = completionResult.results
-
-        if base != "":
-            results = filter(lambda x: self.get_abbr(x.string).startswith(base), results)
-
-        if sorting == 'priority':
-            get_priority = lambda x: x.string.priority
-            key = get_priority
-            results = sorted(results, None, key)
-        if sorting == 'alpha':
-            get_abbreviation = lambda x: self.get_abbr(x.string).lower()
-            key = get_abbreviation
-            results = sorted(results, None, key)
-        return map(self.format_results, results)
-
-    def get_abbr(self, strings):
-        for chunks in strings:
-            if chunks.isKindTypedText():
-                return chunks.spelling
-            return ""
-
-
-class CompleteThread(threading.Thread):
-    lock = threading.Lock()
+        file_name = normalized_file_name(file[0])
+        visible = set(entry[1] for entry in entries)
+        included = accessor.includes_of(file_name) or ()
+        include_directories = accessor.include_directories(file[0])
+        indexed = []
+        for symbol in symbols:
+            if symbol.name in visible or symbol.header == file_name:
+                continue
+            if symbol.header in included:
+                include = None
+            else:
+                include = include_directive(symbol.header, file_name, include_directories)
+                if include is None:
+                    continue
+                if include in file[1]:
+                    include = None
+            indexed.append((INDEXED_PRIORITY, symbol.name,
+                            (symbol.name, symbol.word, symbol.result_type, symbol.placeholder_spans,
+                             symbol.kind, include, symbol.qualified_name)))
+        return indexed
+
+    def current_documentation(self, abbreviation):
+        """The documentation of one of the latest completions, None if there
+        is none."""
+        if self._completed_at is None:
+            return None
+        line, column = self._completed_at
+        return self.documentation(self._editor.current_file(), line, column, abbreviation)
+
+    def documentation(self, file, line, column, abbreviation):
+        if self._worker_pool and self._worker_pool.alive():
+            return self._worker_pool.completion_documentation(file, line, column, abbreviation)
 
-    def __init__(self, editor, translation_unit_accessor, complete_flags, line, column):
-        threading.Thread.__init__(self)
-        self._editor = editor
-        self._complete_flags = complete_flags
-        self._line = line
-        self._column = column
-        self._translation_unit_accessor = translation_unit_accessor
-        self._current_file = editor.current_file()
-        self._file_name = editor.file_name()
-
-        self.result = None
-
-    def run(self):
-        try:
-            CompleteThread.lock.acquire()
-            self.result = self.get_current_completion_results(
-                self._line, self._column)
-        except Exception, e:
-            self._editor.display_message("Exception thrown in completion thread: " + str(e))
-        finally:
-            CompleteThread.lock.release()
-
-    def get_current_completion_results(self, line, column):
         def _do_it(translation_unit):
-            return translation_unit.codeComplete(
-                self._file_name, line, column, [self._current_file], self._complete_flags)
+            return self._documentation.documentation(translation_unit, file, line, column, abbreviation)
+        return self._translation_unit_accessor.translation_unit_for_completion_do(
+            file, _do_it, parse_profiles.INTERACTIVE)
+
+    def prefetch_completions(self):
+        """Complete in the background where completion is likely to be
+        requested next, so it is served from the cache: at a member access
+        operator before the cursor, or at one pretended to follow the
+        expression before the cursor."""
+        line = self._editor.current_line()
+        file = self._editor.current_file()
+        start = line_offset(file[1], line)
+        end = file[1].find("\n", start)
+        speculation = speculative_completion(file[1][start:] if end == -1 else file[1][start:end],
+                                             self._editor.current_column())
+        if speculation is None:
+            return
+        column, inserted = speculation
+        key = CompletionCache.key(insert(file, line, column, inserted), line, column + len(inserted))
+        if key in self._cache or (self._prefetched and self._prefetched[0] == key
+                                  and not self._prefetched[1].cancelled()):
+            return
+        if self._prefetched:
+            self._prefetched[1].cancel()
+        self._prefetched = (key, self._completion_service().submit(file, line, column, "", inserted))
+        self._prefetches += 1
+
+    def _prefetched_completions(self, key):
+        if not self._prefetched or self._prefetched[0] != key:
+            return None
+        future = self._prefetched[1]
+        self._prefetched = None
+        entries = self._wait(future)
+        if entries is None:
+            return None
+        self._prefetch_hits += 1
+        self._cache.put(key, entries)
+        return entries
+
+    def container_statistics(self):
+        return self._containers.statistics()
+
+    def prefetch_statistics(self):
+        return dict({'prefetches': self._prefetches,
+                     'hits': self._prefetch_hits,
+                     'misses': self._prefetch_misses})
+
+    def _completion_service(self):
+        if self._service is None:
+            self._service = CompletionService(self._editor, self.complete)
+        return self._service
+
+    def _wait(self, future):
+        timeout = self._editor.completion_timeout()
+        deadline = time.time() + timeout if timeout > 0 else None
+        while not future.wait(0.01):
+            if self._editor.abort_requested() or (deadline and time.time() > deadline):
+                future.cancel()
+                return None
+        return future.result()
+
+    def complete(self, file, line, column, base, inserted=""):
+        """Returns tuples of priority, abbreviation and the arguments of
+        format_result for the completions at the given position starting with
+        base. inserted is text to pretend precedes the position, e.g. a member
+        access operator not typed yet."""
+        if self._worker_pool and self._worker_pool.alive():
+            return self._worker_pool.complete(file, line, column, self._complete_flags, base, inserted)
+
+        completed_file = insert(file, line, column, inserted)
+        completed_column = column + len(inserted)
+        accessor = self._translation_unit_accessor
 
-        return self._translation_unit_accessor.translation_unit_do(self._current_file, _do_it)
+        def _do_it(translation_unit):
+            # Completions of members and qualified names are the same in
+            # the same container. Editing the file may change those of the
+            # containers it declares, though.
+            container = self._containers.container_at(
+                translation_unit, accessor.parsed_contents(file[0], translation_unit),
+                completed_file, line, completed_column)
+            if container and container.declared_in == file[0]:
+                container = None
+            entries = container and self._containers.get(container, accessor.dependencies_unchanged,
+                                                          accessor.includes_of(file[0]))
+            if entries is None:
+                completion_result = translation_unit.codeComplete(
+                    file[0], line, completed_column, accessor.unsaved_files(completed_file),
+                    self._complete_flags)
+                if completion_result is None:
+                    return None
+                entries = self.completion_entries(completion_result, "")
+                self._containers.put(container, completion_result, completed_file, line, completed_column, entries,
+                                     accessor.dependency_generations(
+                                         file[0], container is None or container.declared_in is None))
+            return [entry for entry in entries if entry[1].startswith(base)]
+
+        return self._translation_unit_accessor.translation_unit_for_completion_do(
+            file, _do_it, parse_profiles.INTERACTIVE)
+
+    def completion_entries(self, completion_result, base):
+        entries = []
+        for typed_text, word, result_type, placeholder_spans, cursor_kind, priority, availability \
+                in completion_result.extract():
+            if typed_text.startswith(base):
+                entries.append((priority, typed_text,
+                                (typed_text, word, result_type, placeholder_spans, cursor_kind)))
+        return entries
+
+
+def line_offset(contents, line):
+    """The offset of the start of the given line, counted from 1."""
+    offset = 0
+    for i in range(line - 1):
+        offset = contents.find("\n", offset) + 1
+        if offset == 0:
+            return len(contents)
+    return offset
+
+
+def position_offset(contents, line, column):
+    return min(line_offset(contents, line) + column - 1, len(contents))
+
+
+def insert(file, line, column, text):
+    """The file with the text inserted at the given position."""
+    if not text:
+        return file
+    offset = position_offset(file[1], line, column)
+    return (file[0], file[1][:offset] + text + file[1][offset:])
+
+
+def is_identifier_character(character):
+    return character.isalnum() or character == '_'
+
+
+def speculative_completion(line_text, column):
+    """Where completion is likely to be requested next with the cursor at
+    the given column of the line: a pair of the column and the text to
+    pretend precedes it, e.g. a member access operator not typed yet. None
+    if completion is unlikely."""
+    before = line_text[:column - 1]
+    start = len(before)
+    while start > 0 and is_identifier_character(before[start - 1]):
+        start -= 1
+    if before[:start].endswith(MEMBER_ACCESS_TRIGGERS):
+        return (start + 1, "")
+    expression = before[start:]
+    if not expression:
+        if before.endswith((')', ']')):
+            return (column, ".")
+        return None
+    if expression[0].isdigit() or expression in KEYWORDS:
+        return None
+    if expression == "this":
+        return (column, "->")
+    return (column, ".")
+
+
+class CompletionCache(object):
+    """The unfiltered completions of the most recently completed positions."""
+
+    def __init__(self, size=CACHED_COMPLETIONS):
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(file, line, column):
+        """Identifies a completion by the position of the completed token
+        and the contents of the file before it, which alone determine the
+        completions."""
+        contents = file[1]
+        return (file[0], line, column, content_hash(contents[:position_offset(contents, line, column)]))
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entries = self._entries.pop(key, None)
+            if entries is not None:
+                self._entries[key] = entries
+            return entries
+
+    def put(self, key, entries):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entries
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CompletionFuture(object):
+    """The result of a completion request, None if completing failed. A
+    cancelled request is not completed, or its result is dropped."""
+
+    def __init__(self, file, line, column, base, inserted=""):
+        self.file = file
+        self.line = line
+        self.column = column
+        self.base = base
+        self.inserted = inserted
+        self._done = threading.Event()
+        self._cancelled = False
+        self._result = None
+
+    def wait(self, timeout=None):
+        """Returns whether the request is done."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        return self._result
+
+    def cancel(self):
+        self._cancelled = True
+        self._done.set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def set_result(self, result):
+        if not self._cancelled:
+            self._result = result
+        self._done.set()
+
+
+class CompletionService(object):
+    """
+    Completes on long-lived threads. Each file is completed by one thread at
+    a time, different files concurrently. A new request for a file cancels
+    the file's older requests: a waiting one is never completed, the result
+    of a running one is dropped.
+    """
+
+    def __init__(self, editor, complete, number_of_threads=COMPLETION_THREADS):
+        self._editor = editor
+        self._complete = complete
+        self._lock = threading.Lock()
+        # The latest waiting request of every file.
+        self._waiting = {}
+        self._running = {}
+        # Names of files with a waiting request no thread has taken yet.
+        self._queue = Queue.Queue()
+        self._alive = True
+        self._threads = []
+        for i in range(number_of_threads):
+            thread = threading.Thread(target=self._run, name="Completion")
+            thread.start()
+            self._threads.append(thread)
+
+    def terminate(self):
+        self._alive = False
+        for thread in self._threads:
+            self._queue.put(None)
+
+    def submit(self, file, line, column, base, inserted=""):
+        future = CompletionFuture(file, line, column, base, inserted)
+        file_name = file[0]
+        with self._lock:
+            for older in [self._waiting.get(file_name), self._running.get(file_name)]:
+                if older:
+                    older.cancel()
+            self._waiting[file_name] = future
+            if file_name not in self._running:
+                self._queue.put(file_name)
+        return future
+
+    def _run(self):
+        while True:
+            file_name = self._queue.get()
+            if not self._alive:
+                return
+            with self._lock:
+                future = self._waiting.pop(file_name, None)
+                if future is None:
+                    continue
+                self._running[file_name] = future
+            try:
+                if not future.cancelled():
+                    future.set_result(self._complete(
+                        future.file, future.line, future.column, future.base, future.inserted))
+            except Exception, e:
+                self._editor.display_message("Exception thrown in completion thread: " + str(e))
+                future.set_result(None)
+            finally:
+                with self._lock:
+                    del self._running[file_name]
+                    # A request that arrived meanwhile waits for this thread.
+                    if file_name in self._waiting:
+                        self._queue.put(file_name)
 
 
 kinds = dict({
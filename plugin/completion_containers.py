@@ -0,0 +1,293 @@
+import collections
+import re
+import threading
+from clang.cindex import CompletionContext, CursorKind, TypeKind
+from common import normalized_file_name
+
+
+# Number of containers whose completions are kept.
+CACHED_CONTAINERS = 32
+
+# The completion context clang reports for a member access operator.
+MEMBER_ACCESS_CONTEXTS = {'.': CompletionContext.DOT_MEMBER_ACCESS,
+                          '->': CompletionContext.ARROW_MEMBER_ACCESS}
+
+# Kinds of containers whose names qualify other names.
+QUALIFYING_KINDS = frozenset([CursorKind.NAMESPACE, CursorKind.CLASS_DECL,
+                              CursorKind.STRUCT_DECL, CursorKind.UNION_DECL,
+                              CursorKind.ENUM_DECL])
+
+FUNCTION_KINDS = frozenset([CursorKind.FUNCTION_DECL, CursorKind.CXX_METHOD,
+                            CursorKind.CONSTRUCTOR, CursorKind.DESTRUCTOR,
+                            CursorKind.CONVERSION_FUNCTION, CursorKind.FUNCTION_TEMPLATE])
+
+METHOD_KINDS = frozenset([CursorKind.CXX_METHOD, CursorKind.CONSTRUCTOR,
+                          CursorKind.DESTRUCTOR, CursorKind.CONVERSION_FUNCTION])
+
+SCOPE_KINDS = frozenset([CursorKind.NAMESPACE, CursorKind.LINKAGE_SPEC,
+                         CursorKind.CLASS_DECL, CursorKind.STRUCT_DECL])
+
+_accessed_name = re.compile(r'([A-Za-z_]\w*)\s*(\.|->|::)$')
+
+
+def accessed_name(line_text, column):
+    """The name and the operator right before the given column if the
+    completion there is a member access of or qualified by a plain name, e.g.
+    ('foo', '->') for "foo->". None otherwise, e.g. for "foo().bar."."""
+    match = _access(line_text, column)
+    return match and (match.group(1), match.group(2))
+
+
+def _access(line_text, column):
+    before = line_text[:column - 1]
+    match = _accessed_name.search(before)
+    if match is None or before[:match.start()].rstrip().endswith(('.', '->', '::', ')', ']')):
+        return None
+    return match
+
+
+def access_at(file, line, column):
+    """Like accessed_name for the position in the file, with the offset of
+    the name in its contents."""
+    match = _access(line_text(file[1], line), column)
+    if match is None:
+        return None
+    return match.group(1), match.group(2), line_start(file[1], line) + match.start()
+
+
+def parsed_before(parsed_contents, file, offset):
+    """Whether the translation unit built from parsed_contents, None if
+    unknown, was built from the file's contents up to the offset. Only then
+    do lines, declarations and types found in it hold for the file."""
+    return parsed_contents is not None and parsed_contents[:offset] == file[1][:offset]
+
+
+def line_start(contents, line):
+    """The offset of the line's start, None if there are fewer lines."""
+    start = 0
+    for i in range(line - 1):
+        start = contents.find("\n", start) + 1
+        if start == 0:
+            return None
+    return start
+
+
+def line_text(contents, line):
+    start = line_start(contents, line)
+    if start is None:
+        return ""
+    end = contents.find("\n", start)
+    return contents[start:] if end == -1 else contents[start:end]
+
+
+def _contains_line(cursor, file_name, line):
+    extent = cursor.extent
+    return (extent.start.file is not None and extent.start.file.name == file_name
+            and extent.start.line <= line <= extent.end.line)
+
+
+def enclosing_function(translation_unit, file_name, line):
+    """The function whose definition spans the line."""
+    children = translation_unit.cursor.get_children()
+    while True:
+        for child in children:
+            if _contains_line(child, file_name, line):
+                if child.kind in FUNCTION_KINDS:
+                    return child
+                if child.kind in SCOPE_KINDS:
+                    children = child.get_children()
+                    break
+        else:
+            return None
+
+
+def last_variable_named(cursor, name, line):
+    """The last variable or parameter of the name declared within the
+    cursor up to the line."""
+    found = None
+    for child in cursor.get_children():
+        if child.location.line > line:
+            break
+        if child.kind in (CursorKind.VAR_DECL, CursorKind.PARM_DECL) and child.spelling == name:
+            found = child
+        found = last_variable_named(child, name, line) or found
+    return found
+
+
+def field_named(record, name):
+    for child in record.get_children():
+        if child.kind == CursorKind.FIELD_DECL and child.spelling == name:
+            return child
+    return None
+
+
+def record_container(record, operator, scope=None):
+    usr = record.get_usr()
+    if not usr:
+        return None
+    declared_in = record.location.file
+    return Container(usr, operator, declared_in and declared_in.name, scope)
+
+
+def accessing_scope(translation_unit, file_name, line):
+    """The USR of the class whose method spans the line, as the members it
+    may access depend on it. None outside of methods."""
+    function = enclosing_function(translation_unit, file_name, line)
+    if function is None or function.kind not in METHOD_KINDS:
+        return None
+    return function.semantic_parent.get_usr() or None
+
+
+def accessed_record(translation_unit, file_name, line, name, operator):
+    """The declaration of the class whose member the name accesses with the
+    operator on the line, looked up in the translation unit. None if not
+    found."""
+    function = enclosing_function(translation_unit, file_name, line)
+    if function is None:
+        return None
+    if name == 'this':
+        if operator != '->' or function.kind not in METHOD_KINDS:
+            return None
+        return function.semantic_parent
+    declaration = last_variable_named(function, name, line)
+    if declaration is None and function.kind in METHOD_KINDS:
+        declaration = field_named(function.semantic_parent, name)
+    if declaration is None:
+        return None
+    return record_of(declaration.type, operator)
+
+
+def record_of(type, operator):
+    """The declaration of the class of a member access on a value of the
+    type."""
+    type = type.get_canonical()
+    if type.kind in (TypeKind.LVALUEREFERENCE, TypeKind.RVALUEREFERENCE):
+        type = type.get_pointee().get_canonical()
+    if operator == '->':
+        if type.kind != TypeKind.POINTER:
+            return None
+        type = type.get_pointee().get_canonical()
+    if type.kind != TypeKind.RECORD:
+        return None
+    return type.get_declaration()
+
+
+class Container(object):
+    """What a completion is in, identified by the container's USR, the
+    operator accessing it and the scope accessing it: the class of the
+    method completed in for members, as it decides which private and
+    protected members are accessible, and the file completed in for names
+    qualified by a namespace, as namespaces are open and which of their
+    declarations are visible depends on the file's includes."""
+
+    def __init__(self, usr, operator, declared_in=None, scope=None):
+        self.key = (usr, operator, scope)
+        self.usr = usr
+        self.operator = operator
+        # The file declaring the container, None if unknown.
+        self.declared_in = declared_in
+
+
+class ContainerCompletions(object):
+    """
+    Completions of members and of qualified names by the container they are
+    completed in, e.g. the class of the object before ".", as completions in
+    the same container are the same wherever they are requested. They are
+    answered from memory while the files they were completed from are
+    unchanged.
+
+    To find the container without completing, the name before the operator
+    is looked up in the last translation unit built: among the variables and
+    parameters of the enclosing function, and the fields of its class. It is
+    only looked up if the translation unit was built from the same contents
+    before the name, as the lines, declarations and types it finds are
+    those of the contents it was built from. Names qualifying others are
+    remembered per file from earlier completions.
+    """
+
+    def __init__(self, size=CACHED_CONTAINERS):
+        self._size = size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._qualifiers = {}
+        self._hits = 0
+        self._misses = 0
+
+    def container_at(self, translation_unit, parsed_contents, file, line, column):
+        """The container of the completion at the position, None if it is not
+        in one or it cannot be found out without completing. parsed_contents
+        are those the translation unit was built from, None if unknown."""
+        access = access_at(file, line, column)
+        if access is None:
+            return None
+        name, operator, offset = access
+        if operator == '::':
+            with self._lock:
+                usr = self._qualifiers.get((file[0], name))
+            return Container(usr, operator, scope=file[0]) if usr else None
+
+        if not parsed_before(parsed_contents, file, offset):
+            return None
+        record = accessed_record(translation_unit, file[0], line, name, operator)
+        return record and record_container(record, operator, accessing_scope(translation_unit, file[0], line))
+
+    def get(self, container, dependencies_unchanged, included_names):
+        """The completions cached for the container, if the files they were
+        completed from are unchanged. Members completed in another file are
+        only used if the file completed in includes the container's
+        declaration too. included_names are the normalized names of the
+        files it includes, None if unknown."""
+        with self._lock:
+            entry = self._entries.get(container.key)
+            if entry and dependencies_unchanged(entry[1]) and self._sees_container(container, included_names):
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+            return None
+
+    def _sees_container(self, container, included_names):
+        if container.operator == '::':
+            # Keyed by the file completed in already.
+            return True
+        if container.declared_in is None or included_names is None:
+            return False
+        return normalized_file_name(container.declared_in) in included_names
+
+    def put(self, container, completion_result, file, line, column, entries, dependencies):
+        """Cache the unfiltered completions at the position if clang completed
+        them in the container expected, or remember the container of a
+        qualifying name."""
+        if dependencies is None:
+            return
+        access = accessed_name(line_text(file[1], line), column)
+        if access is None:
+            return
+        name, operator = access
+        usr = completion_result.container_usr
+        kind, incomplete = completion_result.container_kind
+        if not usr or incomplete:
+            return
+        if operator == '::':
+            if kind not in QUALIFYING_KINDS:
+                return
+        elif not completion_result.contexts & MEMBER_ACCESS_CONTEXTS[operator]:
+            return
+        # Only a container found out correctly may be answered from memory.
+        if operator != '::' and (container is None or container.usr != usr):
+            return
+        with self._lock:
+            if operator == '::':
+                self._qualifiers[(file[0], name)] = usr
+                key = Container(usr, operator, scope=file[0]).key
+            else:
+                key = container.key
+            self._entries.pop(key, None)
+            self._entries[key] = (entries, dependencies)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def statistics(self):
+        with self._lock:
+            return dict({'hits': self._hits,
+                         'misses': self._misses,
+                         'containers': len(self._entries)})
@@ -0,0 +1,164 @@
+import threading
+from clang.cindex import Cursor, CursorKind
+from completion_containers import (FUNCTION_KINDS, METHOD_KINDS, QUALIFYING_KINDS, access_at,
+                                   accessed_record, enclosing_function, last_variable_named, line_start,
+                                   parsed_before)
+
+
+# Declarations whose type is not worth showing in front of their name.
+UNTYPED_KINDS = QUALIFYING_KINDS | frozenset([CursorKind.CONSTRUCTOR, CursorKind.DESTRUCTOR,
+                                              CursorKind.CLASS_TEMPLATE, CursorKind.TYPEDEF_DECL])
+
+# Number of symbols starting with a name looked at in the symbol index for
+# the declarations of the name.
+INDEXED_CANDIDATES = 20
+
+
+def members_named(scope, name):
+    """The declarations of the name in a class, its bases or a namespace,
+    those of the class first."""
+    found = []
+    bases = []
+    for child in scope.get_children():
+        if child.kind == CursorKind.CXX_BASE_SPECIFIER:
+            bases.append(child.type.get_canonical().get_declaration())
+        elif child.spelling == name:
+            found.append(child)
+    for base in bases:
+        if base:
+            found.extend(members_named(base, name))
+    return found
+
+
+def declaration_at(translation_unit, file_name, line, column):
+    """The declaration declared or referenced at the position, None if there
+    is none, e.g. because the file is not part of the translation unit."""
+    location = translation_unit.get_location(file_name, (line, column))
+    return Cursor.from_location(translation_unit, location).referenced
+
+
+def describe(declaration):
+    """The signature of the declaration, qualified by its scopes, followed
+    by its brief comment."""
+    names = [declaration.displayname]
+    parent = declaration.semantic_parent
+    while parent and parent.kind.is_declaration():
+        if parent.spelling:
+            names.insert(0, parent.spelling)
+        parent = parent.semantic_parent
+    signature = "::".join(names)
+    if declaration.kind in FUNCTION_KINDS and declaration.kind not in UNTYPED_KINDS:
+        signature = declaration.result_type.spelling + " " + signature
+    elif declaration.kind not in UNTYPED_KINDS and declaration.type.spelling:
+        signature = declaration.type.spelling + " " + signature
+    comment = declaration.brief_comment
+    if comment:
+        return signature + "\n\n" + comment
+    return signature
+
+
+class CompletionDocumentation(object):
+    """
+    Documentation of completions, looked up only for the completion the user
+    highlights instead of having clang attach comments to every candidate.
+    The declaration of the completion is looked up by name where it was
+    completed: in the accessed class or namespace, or among the variables
+    of the enclosing function and the members of its class, or else where
+    the symbol index found it. The translation unit is never walked as a
+    whole. As it may be older than the file, it is only looked at if it was
+    built from the same contents before the completion.
+
+    Documentation is memoized by the declaration's USR while the file and
+    the files it includes are unchanged.
+    """
+
+    def __init__(self, translation_unit_accessor):
+        self._translation_unit_accessor = translation_unit_accessor
+        self._lock = threading.Lock()
+        # The generations of the files the memoized documentation is of.
+        self._dependencies = None
+        self._documentation = {}
+        # The USRs of the declarations of names in classes and namespaces.
+        self._usrs = {}
+
+    def documentation(self, translation_unit, file, line, column, abbreviation):
+        """The documentation of the completion completed at the position,
+        None if its declaration is not found."""
+        accessor = self._translation_unit_accessor
+        self._forget_if_changed(accessor.dependency_generations(file[0], include_self=True))
+        parsed_contents = accessor.parsed_contents(file[0], translation_unit)
+        access = access_at(file, line, column)
+        if access:
+            name, operator, offset = access
+            if operator == '::':
+                if not parsed_before(parsed_contents, file, offset + len(name)):
+                    return None
+                scope = declaration_at(translation_unit, file[0], line, offset - line_start(file[1], line) + 1)
+                if scope is not None and scope.kind not in QUALIFYING_KINDS:
+                    scope = None
+            elif parsed_before(parsed_contents, file, offset):
+                scope = accessed_record(translation_unit, file[0], line, name, operator)
+            else:
+                scope = None
+            if scope is None:
+                return None
+            key = (scope.get_usr(), abbreviation)
+            with self._lock:
+                usr = self._usrs.get(key)
+                if usr in self._documentation:
+                    return self._documentation[usr]
+            declarations = members_named(scope, abbreviation)
+        else:
+            key = None
+            declarations = self._visible_declarations(translation_unit, parsed_contents, file, line, abbreviation)
+
+        if not declarations:
+            return None
+        # Overloads share the documentation of the first documented one.
+        documented = [declaration for declaration in declarations if declaration.brief_comment]
+        declaration = (documented or declarations)[0]
+        usr = declaration.get_usr()
+        with self._lock:
+            if key:
+                self._usrs[key] = usr
+            if usr and usr in self._documentation:
+                return self._documentation[usr]
+        documentation = describe(declaration)
+        if usr:
+            with self._lock:
+                self._documentation[usr] = documentation
+        return documentation
+
+    def _forget_if_changed(self, dependencies):
+        """Documentation of other versions of the files may be outdated. It
+        is not kept at all while the files included are unknown."""
+        with self._lock:
+            if dependencies is None or dependencies != self._dependencies:
+                self._dependencies = dependencies
+                self._documentation = {}
+                self._usrs = {}
+
+    def _visible_declarations(self, translation_unit, parsed_contents, file, line, name):
+        start = line_start(file[1], line)
+        if start is not None and parsed_before(parsed_contents, file, start):
+            function = enclosing_function(translation_unit, file[0], line)
+            if function:
+                variable = last_variable_named(function, name, line)
+                if variable:
+                    return [variable]
+                if function.kind in METHOD_KINDS:
+                    members = members_named(function.semantic_parent, name)
+                    if members:
+                        return members
+        return self._indexed_declarations(translation_unit, name)
+
+    def _indexed_declarations(self, translation_unit, name):
+        declarations = []
+        for symbol in self._translation_unit_accessor.symbol_index().lookup(name, INDEXED_CANDIDATES):
+            if symbol.name != name:
+                continue
+            declaration = declaration_at(translation_unit, symbol.header, symbol.line, symbol.column)
+            # The header may have changed since it was indexed.
+            if declaration is not None and declaration.get_usr() == symbol.usr:
+                declarations.append(declaration)
+        return declarations
@@ -0,0 +1,53 @@
+import threading
+from common import content_hash
+
+
+class FileStates(object):
+    """
+    Remembers a content hash and a generation for every file whose contents
+    were handed to the parser. A file's generation is increased whenever its
+    contents change, so comparing generations tells whether anything derived
+    from a file is still valid.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._states = {}
+
+    def update(self, file_name, contents):
+        """Record the contents of a file. Returns True if they differ from the
+        previously recorded contents."""
+        digest = content_hash(contents)
+        with self._lock:
+            state = self._states.get(file_name)
+            if state and state[0] == digest:
+                return False
+            self._generation += 1
+            self._states[file_name] = (digest, self._generation)
+            return True
+
+    def invalidate(self, file_name):
+        """Forget the contents of a file, e.g. because it changed on disk. Its
+        generation is increased all the same."""
+        with self._lock:
+            self._generation += 1
+            self._states[file_name] = (None, self._generation)
+
+    def content_hash(self, file_name):
+        with self._lock:
+            try:
+                return self._states[file_name][0]
+            except KeyError:
+                return None
+
+    def generation(self, file_name=None):
+        """The generation of the given file, or the most recent generation of
+        all files."""
+        with self._lock:
+            if file_name is None:
+                return self._generation
+            try:
+                return self._states[file_name][1]
+            except KeyError:
+                return None
@@ -0,0 +1,188 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from common import normalized_file_name
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def make_file_watcher(on_change):
+    """
+    Create a watcher that calls on_change with a set of changed file names.
+    Changes arriving in a burst (e.g. a branch switch) are reported together.
+    If the watcher lost track of changes, on_change is called with None.
+    Uses inotify where available and falls back to polling modification
+    times.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyFileWatcher(on_change)
+        except (OSError, AttributeError):
+            pass
+    return PollingFileWatcher(on_change)
+
+
+class ChangeBatcher(object):
+    """Collects changes until none arrived for quiet_period seconds, or the
+    first one is max_delay seconds old."""
+
+    def __init__(self, quiet_period, max_delay):
+        self._quiet_period = quiet_period
+        self._max_delay = max_delay
+        self._changes = set()
+        self._first_change = None
+        self._last_change = None
+
+    def add(self, file_names):
+        now = time.time()
+        if not self._changes:
+            self._first_change = now
+        self._last_change = now
+        self._changes.update(file_names)
+
+    def is_due(self):
+        if not self._changes:
+            return False
+        now = time.time()
+        return (now - self._last_change >= self._quiet_period
+                or now - self._first_change >= self._max_delay)
+
+    def time_until_due(self, default):
+        if not self._changes:
+            return default
+        now = time.time()
+        return max(0, min(self._last_change + self._quiet_period,
+                          self._first_change + self._max_delay) - now)
+
+    def take(self):
+        changes = self._changes
+        self._changes = set()
+        return changes
+
+
+class InotifyFileWatcher(object):
+    def __init__(self, on_change, quiet_period=0.2, max_delay=2.0):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+        self._on_change = on_change
+        self._batcher = ChangeBatcher(quiet_period, max_delay)
+        self._lock = threading.Lock()
+        self._files = set()
+        self._directory_for_watch = {}
+        self._watch_for_directory = {}
+        self._alive = True
+        self._thread = threading.Thread(target=self._run, name="InotifyFileWatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def terminate(self):
+        self._alive = False
+
+    def watch_files(self, file_names):
+        with self._lock:
+            for file_name in map(normalized_file_name, file_names):
+                if file_name in self._files:
+                    continue
+                self._files.add(file_name)
+                directory = os.path.dirname(file_name)
+                if directory in self._watch_for_directory:
+                    continue
+                watch = self._libc.inotify_add_watch(self._fd, directory, WATCH_MASK)
+                if watch >= 0:
+                    self._watch_for_directory[directory] = watch
+                    self._directory_for_watch[watch] = directory
+
+    def _run(self):
+        try:
+            while self._alive:
+                timeout = self._batcher.time_until_due(default=1.0)
+                if select.select([self._fd], [], [], timeout)[0]:
+                    self._read_events()
+                if self._batcher.is_due():
+                    self._on_change(self._batcher.take())
+        finally:
+            os.close(self._fd)
+
+    def _read_events(self):
+        data = os.read(self._fd, 65536)
+        changed = set()
+        offset = 0
+        with self._lock:
+            while offset + EVENT_HEADER.size <= len(data):
+                watch, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    self._batcher.take()
+                    self._on_change(None)
+                    return
+
+                directory = self._directory_for_watch.get(watch)
+                if directory is not None and name:
+                    file_name = os.path.join(directory, name)
+                    if file_name in self._files:
+                        changed.add(file_name)
+        if changed:
+            self._batcher.add(changed)
+
+
+class PollingFileWatcher(object):
+    def __init__(self, on_change, interval=2.0):
+        self._on_change = on_change
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._mtimes = {}
+        self._alive = True
+        self._thread = threading.Thread(target=self._run, name="PollingFileWatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def terminate(self):
+        self._alive = False
+
+    def watch_files(self, file_names):
+        with self._lock:
+            for file_name in map(normalized_file_name, file_names):
+                if file_name not in self._mtimes:
+                    self._mtimes[file_name] = self._mtime(file_name)
+
+    def _mtime(self, file_name):
+        try:
+            return os.stat(file_name).st_mtime
+        except OSError:
+            return None
+
+    def _run(self):
+        while self._alive:
+            time.sleep(self._interval)
+            with self._lock:
+                file_names = list(self._mtimes)
+            changed = set()
+            for file_name in file_names:
+                mtime = self._mtime(file_name)
+                if mtime != self._mtimes[file_name]:
+                    self._mtimes[file_name] = mtime
+                    changed.add(file_name)
+            if changed and self._alive:
+                self._on_change(changed)
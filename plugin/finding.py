@@ -2,6 +2,7 @@ import os
 import Levenshtein
 import clang.cindex
 from common import get_definition_or_reference
+import parse_profiles
 
 
 class DeclarationFinder(object):
@@ -34,7 +35,7 @@ class DeclarationFinder(object):
                 function(declaration_cursor)
 
         self._translation_unit_accessor.current_translation_unit_do(
-            call_function_with_declaration_in)
+            call_function_with_declaration_in, allow_stale=True)
 
     def declaration_locations_do(self, function):
         self._declaration_cursors_do(
@@ -61,9 +62,10 @@ class DefinitionFinder(object):
             alternate_cursor = self._find_corresponding_cursor_in_alternate_translation_unit(cursor, translation_unit)
             if alternate_cursor:
                 function(alternate_cursor)
+        # Only declarations are looked up, so function bodies are not needed.
         for file_name in self._alternate_files(cursor.extent.start.file.name):
             self._translation_unit_accessor.translation_unit_for_file_named_do(
-                file_name, call_function_with_alternate_cursor)
+                file_name, call_function_with_alternate_cursor, parse_profiles.BACKGROUND)
 
     def _find_definition_in_translation_unit(self, translation_unit, location):
         cursor = clang.cindex.Cursor.from_location(translation_unit, location)
@@ -82,9 +84,10 @@ class DefinitionFinder(object):
         return finder.definition_files()
 
     def _guessed_alternate_translation_units_do(self, file_name, function):
+        # The current location may be within a function body.
         for file in self._alternate_files(file_name):
             self._translation_unit_accessor.translation_unit_for_file_named_do(
-                file, function)
+                file, function, parse_profiles.DIAGNOSTICS)
 
     def _definitions_of_current_cursor_do(self, translation_unit, function):
         def call_function_with_definition_if_exists(cursor):
@@ -102,7 +105,7 @@ class DefinitionFinder(object):
 
     def _definition_cursors_do(self, function):
         for translation_unit_do in [
-            self._translation_unit_accessor.current_translation_unit_do,
+            lambda f: self._translation_unit_accessor.current_translation_unit_do(f, allow_stale=True),
             lambda f: self._guessed_alternate_translation_units_do(
                 self._editor.file_name(), f),
         ]:
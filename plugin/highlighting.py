@@ -39,15 +39,31 @@ def interesting_range_collector(styles_and_actions):
     return do_it
 
 
+def styles_and_actions(editor):
+    return [
+        ("Diagnostic", actions.find_diagnostics),
+        ("Non-const reference", actions.make_find_parameters_passed_by_non_const_reference(editor)),
+        ("Overridden method declaration", actions.find_overriden_method_declarations),
+        ("Implemented method declaration", actions.find_implemented_pure_virtual_methods)]
+        #("Static method declaration", actions.find_static_method_declarations),
+        #("Member reference", actions.find_member_references),
+        #("Virtual method call", actions.find_virtual_method_calls),
+        #("Omitted default argument", actions.find_omitted_default_arguments)]
+
+
+def collect_interesting_ranges(current_translation_unit_access, editor):
+    return listen_and_map(
+        current_translation_unit_access,
+        interesting_range_collector(styles_and_actions(editor)))
+
+
 class InterestingRangeHighlighter(object):
-    def __init__(self, current_translation_unit_access, dispatch_in_main_thread, editor):
+    def __init__(self, interesting_ranges, dispatch_in_main_thread, editor):
+        """interesting_ranges is a queue of pairs of a quick fix list and
+        the interesting ranges of the current file."""
         self._editor = editor
 
-        dispatch_in_main_thread.add_queue(
-            listen_and_map(
-                current_translation_unit_access,
-                interesting_range_collector(self._styles_and_actions())),
-            self._display_ranges)
+        dispatch_in_main_thread.add_queue(interesting_ranges, self._display_ranges)
 
     def _display_ranges(self, d_n_r):
         diagnostics, ranges = d_n_r
@@ -56,19 +72,8 @@ class InterestingRangeHighlighter(object):
         if self._editor.should_highlight_interesting_ranges():
             self._highlight_interesting_ranges(ranges)
 
-    def _styles_and_actions(self):
-        return [
-            ("Diagnostic", actions.find_diagnostics),
-            ("Non-const reference", actions.make_find_parameters_passed_by_non_const_reference(self._editor)),
-            ("Overridden method declaration", actions.find_overriden_method_declarations),
-            ("Implemented method declaration", actions.find_implemented_pure_virtual_methods)]
-            #("Static method declaration", actions.find_static_method_declarations),
-            #("Member reference", actions.find_member_references),
-            #("Virtual method call", actions.find_virtual_method_calls),
-            #("Omitted default argument", actions.find_omitted_default_arguments)]
-
     def _clear_interesting_ranges(self):
-        for highlight_style, action in self._styles_and_actions():
+        for highlight_style, action in styles_and_actions(self._editor):
             self._editor.clear_highlights(highlight_style)
 
     def _highlight_interesting_ranges(self, ranges):
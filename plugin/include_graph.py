@@ -0,0 +1,48 @@
+import threading
+from common import normalized_file_name
+
+
+class IncludeGraph(object):
+    """
+    Records the files every cached translation unit includes and, in reverse,
+    the translation units that include a file. File names are normalized, so
+    relative and absolute names of the same file match.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._includes = {}
+        self._included_by = {}
+
+    def update(self, translation_unit_file_name, included_file_names):
+        included_file_names = frozenset(map(normalized_file_name, included_file_names))
+        with self._lock:
+            self._remove(translation_unit_file_name)
+            self._includes[translation_unit_file_name] = included_file_names
+            for file_name in included_file_names:
+                self._included_by.setdefault(file_name, set()).add(translation_unit_file_name)
+
+    def remove(self, translation_unit_file_name):
+        with self._lock:
+            self._remove(translation_unit_file_name)
+
+    def _remove(self, translation_unit_file_name):
+        for file_name in self._includes.pop(translation_unit_file_name, ()):
+            including = self._included_by[file_name]
+            including.discard(translation_unit_file_name)
+            if not including:
+                del self._included_by[file_name]
+
+    def includers_of(self, file_name):
+        """The translation units that include the given file."""
+        with self._lock:
+            return set(self._included_by.get(normalized_file_name(file_name), ()))
+
+    def includes_of(self, translation_unit_file_name):
+        """The files the translation unit includes, None if unknown."""
+        with self._lock:
+            return self._includes.get(translation_unit_file_name)
+
+    def included_files(self):
+        with self._lock:
+            return set(self._included_by)
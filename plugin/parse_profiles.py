@@ -0,0 +1,47 @@
+from clang.cindex import TranslationUnit
+
+
+class ParseProfile(object):
+    """
+    How thoroughly to parse a translation unit. A translation unit parsed
+    with a profile of higher rank serves requests for lower ranks, the other
+    way round it must be parsed again.
+    """
+
+    def __init__(self, name, rank, options, reparse_after_parse):
+        self.name = name
+        self.rank = rank
+        self.options = options
+        # Reparsing right after parsing builds the precompiled preamble, which
+        # makes later reparses and completions fast.
+        self.reparse_after_parse = reparse_after_parse
+
+    def serves(self, other):
+        return self.rank >= other.rank
+
+    def builds_preamble(self):
+        return bool(self.options & TranslationUnit.PARSE_PRECOMPILED_PREAMBLE)
+
+    def __repr__(self):
+        return self.name
+
+
+# Files that are only parsed to find definitions in them. Function bodies
+# are skipped and no preamble is built, as the file is not edited.
+BACKGROUND = ParseProfile(
+    "background", 0,
+    TranslationUnit.PARSE_SKIP_FUNCTION_BODIES,
+    False)
+
+# Files shown to the user, which need complete diagnostics and fast
+# reparses but no completion.
+DIAGNOSTICS = ParseProfile(
+    "diagnostics", 1,
+    TranslationUnit.PARSE_PRECOMPILED_PREAMBLE,
+    True)
+
+# The file being edited.
+INTERACTIVE = ParseProfile(
+    "interactive", 2,
+    TranslationUnit.PARSE_PRECOMPILED_PREAMBLE | TranslationUnit.PARSE_CACHE_COMPLETION_RESULTS,
+    True)
@@ -0,0 +1,120 @@
+import multiprocessing
+import threading
+import time
+
+
+# Seconds without edits or completions after which the editor counts as idle.
+IDLE_AFTER = 2.0
+
+# Below this fraction of available system memory, background parsing pauses.
+MINIMUM_AVAILABLE_MEMORY = 0.1
+
+
+def available_memory_fraction():
+    """The fraction of system memory available to new processes, None if
+    unknown."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            values = dict()
+            for line in f:
+                name, value = line.split(":", 1)
+                values[name] = int(value.split()[0])
+        return float(values['MemAvailable']) / values['MemTotal']
+    except (IOError, KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+def number_of_cores():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class ParserThreadScheduler(object):
+    """
+    Decides how many of the idle parser threads may parse. While the user is
+    editing or completing, only minimum threads parse, so they do not compete
+    with the user's requests. Once the editor is idle, maximum threads parse.
+    Under memory pressure, no thread parses.
+
+    Threads are numbered. Thread i parses only while i is below the number of
+    allowed threads, so the same threads keep working.
+    """
+
+    def __init__(self, minimum, maximum, is_over_memory_budget, idle_after=IDLE_AFTER, poll_interval=0.5):
+        self._maximum = max(1, maximum)
+        self._minimum = min(max(0, minimum), self._maximum)
+        self._is_over_memory_budget = is_over_memory_budget
+        self._idle_after = idle_after
+        self._poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._last_activity = 0
+        self._terminated = False
+        self._started_at = time.time()
+        self._busy_since = {}
+        self._busy_time = [0.0] * self._maximum
+        self._parses = [0] * self._maximum
+        self._memory_checked_at = 0
+        self._under_memory_pressure = False
+
+    def number_of_threads(self):
+        return self._maximum
+
+    def terminate(self):
+        with self._condition:
+            self._terminated = True
+            self._condition.notify_all()
+
+    def user_active(self):
+        with self._condition:
+            self._last_activity = time.time()
+
+    def allowed_threads(self):
+        if self._is_under_memory_pressure():
+            return 0
+        if time.time() - self._last_activity < self._idle_after:
+            return self._minimum
+        return self._maximum
+
+    def _is_under_memory_pressure(self):
+        now = time.time()
+        if now - self._memory_checked_at >= self._poll_interval:
+            self._memory_checked_at = now
+            available = available_memory_fraction()
+            self._under_memory_pressure = (
+                self._is_over_memory_budget()
+                or (available is not None and available < MINIMUM_AVAILABLE_MEMORY))
+        return self._under_memory_pressure
+
+    def wait_until_allowed(self, thread_index):
+        """Block the calling thread until it may take the next file."""
+        with self._condition:
+            while not self._terminated and thread_index >= self.allowed_threads():
+                self._condition.wait(self._poll_interval)
+
+    def started_parsing(self, thread_index):
+        with self._condition:
+            self._busy_since[thread_index] = time.time()
+
+    def finished_parsing(self, thread_index):
+        with self._condition:
+            started = self._busy_since.pop(thread_index, None)
+            if started is not None:
+                self._busy_time[thread_index] += time.time() - started
+                self._parses[thread_index] += 1
+
+    def utilization(self):
+        """For each thread, the number of parses and the fraction of time
+        spent parsing."""
+        with self._condition:
+            now = time.time()
+            elapsed = max(now - self._started_at, 1e-6)
+            result = []
+            for thread_index in range(self._maximum):
+                busy_time = self._busy_time[thread_index]
+                if thread_index in self._busy_since:
+                    busy_time += now - self._busy_since[thread_index]
+                result.append(dict({'parses': self._parses[thread_index],
+                                    'utilization': busy_time / elapsed}))
+            return result
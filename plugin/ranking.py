@@ -0,0 +1,131 @@
+import heapq
+import itertools
+import threading
+
+
+# How well a completion matches what was typed, better matches first.
+PREFIX, CASE_INSENSITIVE_PREFIX, CAMEL_CASE, SUBSEQUENCE = range(4)
+
+# Priority bonus of the most recently accepted completion. Completions
+# accepted earlier get less.
+RECENCY_BONUS = 30
+RECENCY_DECAY = 0.9
+
+# Priorities are capped at this, above clang's usual priorities and those of
+# completions from the symbol index.
+MAXIMUM_PRIORITY = 100
+
+# Any better match outranks any worse match, whatever the priorities and
+# bonuses of the two.
+MATCH_WEIGHT = MAXIMUM_PRIORITY + RECENCY_BONUS + 1
+
+# Number of accepted completions remembered.
+REMEMBERED_ACCEPTANCES = 1000
+
+
+def word_starts(word):
+    """Offsets of the words in an identifier, e.g. of g, V and N in
+    getValue_now."""
+    starts = []
+    for i, char in enumerate(word):
+        if char == '_':
+            continue
+        if i == 0 or word[i - 1] == '_' or (char.isupper() and not word[i - 1].isupper()):
+            starts.append(i)
+    return starts
+
+
+def matches_camel_case(word, base):
+    """Whether every character of base continues the current word of the
+    identifier or starts one of its later words, e.g. gVal in getValue."""
+    lower_word = word.lower()
+    starts = word_starts(word)
+    position = 0
+    for char in base.lower():
+        if 0 < position < len(word) and lower_word[position] == char:
+            position += 1
+            continue
+        for start in starts:
+            if start >= position and lower_word[start] == char:
+                position = start + 1
+                break
+        else:
+            return False
+    return True
+
+
+def is_subsequence(base, word):
+    characters = iter(word)
+    return all(char in characters for char in base)
+
+
+def match(word, base):
+    """How well word matches base, None if not at all."""
+    if word.startswith(base):
+        return PREFIX
+    lower_word = word.lower()
+    lower_base = base.lower()
+    if lower_word.startswith(lower_base):
+        return CASE_INSENSITIVE_PREFIX
+    if matches_camel_case(word, base):
+        return CAMEL_CASE
+    if is_subsequence(lower_base, lower_word):
+        return SUBSEQUENCE
+    return None
+
+
+class CompletionRanker(object):
+    """
+    Selects the best completions for what was typed. A completion's score
+    combines how well it matches, clang's priority and how recently it was
+    accepted; lower scores are better. Only the best are selected, with a
+    heap, so the cost of ranking a wide scope does not depend on sorting it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acceptances = itertools.count(1)
+        self._accepted = {}
+
+    def accepted(self, abbreviation):
+        with self._lock:
+            self._accepted[abbreviation] = self._acceptances.next()
+            if len(self._accepted) > REMEMBERED_ACCEPTANCES:
+                for abbreviation, acceptance in sorted(
+                        self._accepted.items(), key=lambda item: item[1])[:len(self._accepted) // 2]:
+                    del self._accepted[abbreviation]
+
+    def _recency_bonuses(self):
+        with self._lock:
+            latest = max(self._accepted.values() or [0])
+            return dict((abbreviation, RECENCY_BONUS * RECENCY_DECAY ** (latest - acceptance))
+                        for abbreviation, acceptance in self._accepted.items())
+
+    def best(self, entries, base, limit, sorting='priority'):
+        """The best limit entries (all if limit is 0) of tuples of priority,
+        abbreviation and data matching base. sorting is 'priority' to order
+        them by score, 'alpha' to order them alphabetically or 'none' to
+        keep clang's order."""
+        if sorting == 'none':
+            matching = (entry for entry in entries if match(entry[1], base) is not None)
+            if limit:
+                return list(itertools.islice(matching, limit))
+            return list(matching)
+
+        bonuses = self._recency_bonuses()
+        scored = []
+        for index, entry in enumerate(entries):
+            quality = match(entry[1], base)
+            if quality is None:
+                continue
+            score = quality * MATCH_WEIGHT + min(entry[0], MAXIMUM_PRIORITY) - bonuses.get(entry[1], 0)
+            # The index keeps equal scores in clang's order.
+            scored.append((score, index, entry))
+        if limit:
+            best = heapq.nsmallest(limit, scored)
+        else:
+            best = sorted(scored)
+        best = [entry for score, index, entry in best]
+        if sorting == 'alpha':
+            best.sort(key=lambda entry: entry[1].lower())
+        return best
@@ -0,0 +1,364 @@
+import bisect
+import itertools
+import json
+import os
+import threading
+import time
+from clang.cindex import CursorKind
+from common import normalized_file_name
+
+
+# Seconds between saves of an index that changed, and between checks whether
+# another process saved it.
+SAVE_INTERVAL = 60.0
+RELOAD_INTERVAL = 5.0
+
+# Increased whenever the format of the index file changes.
+FORMAT_VERSION = 2
+
+# Declarations worth completing in files not included yet.
+INDEXED_KINDS = frozenset([CursorKind.FUNCTION_DECL, CursorKind.FUNCTION_TEMPLATE,
+                           CursorKind.CLASS_DECL, CursorKind.STRUCT_DECL,
+                           CursorKind.UNION_DECL, CursorKind.ENUM_DECL,
+                           CursorKind.CLASS_TEMPLATE, CursorKind.TYPEDEF_DECL,
+                           CursorKind.VAR_DECL])
+
+# Kinds only indexed where they are defined, not where forward declared.
+DEFINED_KINDS = frozenset([CursorKind.CLASS_DECL, CursorKind.STRUCT_DECL,
+                           CursorKind.UNION_DECL, CursorKind.ENUM_DECL,
+                           CursorKind.CLASS_TEMPLATE])
+
+# Declarations whose members are indexed qualified by their name.
+NAMESPACE_KINDS = frozenset([CursorKind.NAMESPACE, CursorKind.LINKAGE_SPEC])
+
+PARAMETER_KINDS = frozenset([CursorKind.TEMPLATE_TYPE_PARAMETER, CursorKind.TEMPLATE_NON_TYPE_PARAMETER,
+                             CursorKind.TEMPLATE_TEMPLATE_PARAMETER])
+
+
+class Symbol(object):
+    """A declaration in a header, at the line and column in it. word is what
+    completing it inserts, its signature, with the placeholder spans into
+    it."""
+
+    __slots__ = ('name', 'qualified_name', 'kind', 'usr', 'result_type', 'word', 'placeholder_spans',
+                 'line', 'column', 'header')
+
+    def __init__(self, name, qualified_name, kind, usr, result_type, word, placeholder_spans, line, column, header):
+        self.name = name
+        self.qualified_name = qualified_name
+        self.kind = kind
+        self.usr = usr
+        self.result_type = result_type
+        self.word = word
+        self.placeholder_spans = placeholder_spans
+        self.line = line
+        self.column = column
+        self.header = header
+
+
+def _placeholders(word, opening, parameters, closing):
+    spans = []
+    for i, parameter in enumerate(parameters):
+        if i > 0:
+            word += ", "
+        spans.append((len(word) + len(opening), len(word) + len(opening) + len(parameter)))
+        word += parameter
+    return opening + word + closing, spans
+
+
+def signature(cursor, qualified_name):
+    """The word completing the declaration inserts and its placeholder spans,
+    e.g. "ns::max(int a, int b)"."""
+    if cursor.kind in (CursorKind.FUNCTION_DECL, CursorKind.FUNCTION_TEMPLATE):
+        parameters = [(child.type.spelling + " " + child.spelling).strip()
+                      for child in cursor.get_children() if child.kind == CursorKind.PARM_DECL]
+        word, spans = _placeholders("", "(", parameters, ")")
+    elif cursor.kind == CursorKind.CLASS_TEMPLATE:
+        parameters = [child.spelling for child in cursor.get_children() if child.kind in PARAMETER_KINDS]
+        word, spans = _placeholders("", "<", parameters, ">")
+    else:
+        return qualified_name, []
+    return qualified_name + word, [(start + len(qualified_name), end + len(qualified_name)) for start, end in spans]
+
+
+def result_type(cursor):
+    if cursor.kind in (CursorKind.FUNCTION_DECL, CursorKind.FUNCTION_TEMPLATE):
+        return cursor.result_type.spelling
+    if cursor.kind == CursorKind.VAR_DECL:
+        return cursor.type.spelling
+    return ""
+
+
+def include_directive(header, file_name, include_directories):
+    """The shortest #include directive of the header found relative to the
+    including file or one of the include directories, None if there is
+    none."""
+    best = None
+    for directory in [os.path.dirname(file_name)] + list(include_directories):
+        relative = os.path.relpath(header, directory)
+        if relative.startswith(os.pardir):
+            continue
+        if best is None or len(relative) < len(best):
+            best = relative
+    if best is None:
+        return None
+    return '#include "%s"' % best.replace(os.sep, '/')
+
+
+def include_directories(arguments):
+    """The directories of the -I, -iquote and -isystem options."""
+    directories = []
+    options = ('-I', '-iquote', '-isystem')
+    arguments = list(arguments)
+    for i, argument in enumerate(arguments):
+        for option in options:
+            if argument == option and i + 1 < len(arguments):
+                directories.append(arguments[i + 1])
+            elif argument.startswith(option) and len(argument) > len(option):
+                directories.append(argument[len(option):])
+            else:
+                continue
+            break
+    return [normalized_file_name(directory) for directory in directories]
+
+
+class SymbolIndex(object):
+    """
+    Indexes the declarations in the headers of the translation units parsed,
+    so that completion can offer those of headers not included yet. Only
+    headers that are new or changed on disk since they were indexed are
+    walked, system headers are skipped.
+
+    The index is kept in a file that survives restarts and is shared by the
+    processes parsing, each merging its headers with those the others saved.
+    A header's declarations from the latest version of the header win.
+
+    Names are looked up by prefix, ignoring case, in a sorted table. Only the
+    entries of the headers indexed or loaded are replaced in it, by the
+    thread indexing or loading them.
+
+    An empty file name disables the index.
+    """
+
+    def __init__(self, file_name):
+        self._file_name = os.path.expanduser(file_name) if file_name else None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._table_lock = threading.Lock()
+        self._loaded = threading.Event()
+        # Modification time and symbol tuples by header.
+        self._headers = {}
+        # Sorted lowercase names and their symbols, replaced as a whole so
+        # that readers need no lock.
+        self._table = ([], [])
+        self._changed = False
+        self._saved_at = time.time()
+        self._checked_at = 0
+        self._loaded_mtime = None
+        if self._file_name:
+            self._load_in_background()
+        else:
+            self._loaded.set()
+
+    def enabled(self):
+        return self._file_name is not None
+
+    def wait_until_loaded(self, timeout=None):
+        return self._loaded.wait(timeout)
+
+    def index_translation_unit(self, translation_unit, file_name):
+        """Index the headers the translation unit includes that changed."""
+        if not self._file_name:
+            return
+        file_name = normalized_file_name(file_name)
+        mtimes = {}
+        for inclusion in translation_unit.get_includes():
+            header = normalized_file_name(inclusion.include.name)
+            if header not in mtimes and header != file_name:
+                mtimes[header] = _mtime(header)
+        with self._lock:
+            stale = dict((header, mtime) for header, mtime in mtimes.iteritems()
+                         if mtime is not None and self._headers.get(header, (None,))[0] != mtime)
+        if not stale:
+            return
+
+        symbols = dict((header, []) for header in stale)
+        system_headers = set()
+        self._collect(translation_unit.cursor, [], stale, symbols, system_headers, {}, set())
+        with self._lock:
+            for header, mtime in stale.items():
+                self._headers[header] = (mtime, symbols[header])
+            self._changed = True
+        self._update_table(stale)
+        if time.time() - self._saved_at > SAVE_INTERVAL:
+            self.save()
+
+    def _collect(self, cursor, scopes, stale, symbols, system_headers, names, usrs):
+        for child in cursor.get_children():
+            location_file = child.location.file
+            if location_file is None:
+                continue
+            header = names.get(location_file.name)
+            if header is None:
+                header = names[location_file.name] = normalized_file_name(location_file.name)
+            if header not in stale or header in system_headers:
+                continue
+            if child.location.is_in_system_header:
+                system_headers.add(header)
+                continue
+            name = child.spelling
+            if child.kind in NAMESPACE_KINDS:
+                if child.kind == CursorKind.LINKAGE_SPEC:
+                    self._collect(child, scopes, stale, symbols, system_headers, names, usrs)
+                elif name:
+                    self._collect(child, scopes + [name], stale, symbols, system_headers, names, usrs)
+                continue
+            if child.kind not in INDEXED_KINDS or not name or name.startswith("__"):
+                continue
+            if child.kind in DEFINED_KINDS and not child.is_definition():
+                continue
+            usr = child.get_usr()
+            if not usr or usr in usrs:
+                continue
+            usrs.add(usr)
+            qualified_name = "::".join(scopes + [name])
+            word, spans = signature(child, qualified_name)
+            symbols[header].append((name, qualified_name, child.kind.value, usr,
+                                    result_type(child), word, spans, child.location.line, child.location.column))
+
+    def lookup(self, prefix, limit):
+        """Up to limit symbols whose name starts with the prefix, ignoring
+        case, one per USR."""
+        self._reload_if_saved_elsewhere()
+        keys, symbols = self._table
+        prefix = prefix.lower()
+        found = []
+        usrs = set()
+        for i in xrange(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix) or len(found) >= limit:
+                break
+            symbol = symbols[i]
+            if symbol.usr not in usrs:
+                usrs.add(symbol.usr)
+                found.append(symbol)
+        return found
+
+    def statistics(self):
+        with self._lock:
+            return dict({'headers': len(self._headers),
+                         'symbols': len(self._table[0])})
+
+    def _update_table(self, headers):
+        """Replace the entries of the headers in the table by their current
+        ones."""
+        if not headers:
+            return
+        with self._table_lock:
+            with self._lock:
+                current = [(header, self._headers[header][1]) for header in sorted(headers)]
+            entries = [(symbol[0].lower(), Symbol(*(tuple(symbol) + (header,))))
+                       for header, symbols in current for symbol in symbols]
+            entries.sort(key=lambda entry: entry[0])
+            keys, symbols = self._table
+            kept = [entry for entry in itertools.izip(keys, symbols) if entry[1].header not in headers]
+            # Both runs are sorted already, so sorting merges them in linear time.
+            merged = sorted(kept + entries, key=lambda entry: entry[0])
+            self._table = ([entry[0] for entry in merged], [entry[1] for entry in merged])
+
+    def save(self):
+        """Write the index, merged with the one saved by other processes."""
+        if not self._file_name:
+            return
+        with self._save_lock:
+            saved, mtime = self._read()
+            with self._lock:
+                merged = self._merge(saved)
+                headers = dict(self._headers)
+                self._changed = False
+            temporary_name = self._file_name + ".%d.tmp" % os.getpid()
+            try:
+                directory = os.path.dirname(self._file_name)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(temporary_name, "w") as f:
+                    json.dump(dict({'version': FORMAT_VERSION, 'headers': headers}), f)
+                os.rename(temporary_name, self._file_name)
+                self._loaded_mtime = _mtime(self._file_name)
+            except (IOError, OSError):
+                try:
+                    os.remove(temporary_name)
+                except OSError:
+                    pass
+            self._saved_at = time.time()
+        self._update_table(merged)
+
+    def save_if_changed(self):
+        if self._changed:
+            self.save()
+
+    def _merge(self, saved):
+        """Take the headers saved in a later version, returns their names."""
+        merged = set()
+        for header, (mtime, symbols) in saved.items():
+            known = self._headers.get(header)
+            if known is None or known[0] < mtime:
+                self._headers[header] = (mtime, symbols)
+                merged.add(header)
+        return merged
+
+    def _read(self):
+        """The headers saved and the modification time of the file."""
+        mtime = _mtime(self._file_name)
+        if mtime is None:
+            return dict(), None
+        try:
+            with open(self._file_name) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict(), mtime
+        if not isinstance(saved, dict) or saved.get('version') != FORMAT_VERSION:
+            return dict(), mtime
+        return _encoded(saved['headers']), mtime
+
+    def _load(self):
+        with self._save_lock:
+            saved, mtime = self._read()
+            with self._lock:
+                merged = self._merge(saved)
+            self._loaded_mtime = mtime
+        self._update_table(merged)
+        self._loaded.set()
+
+    def _load_in_background(self):
+        thread = threading.Thread(target=self._load, name="Symbol index loader")
+        thread.daemon = True
+        thread.start()
+
+    def _reload_if_saved_elsewhere(self):
+        now = time.time()
+        if not self._file_name or now - self._checked_at < RELOAD_INTERVAL:
+            return
+        self._checked_at = now
+        mtime = _mtime(self._file_name)
+        if mtime is not None and mtime != self._loaded_mtime:
+            self._loaded_mtime = mtime
+            self._load_in_background()
+
+
+def _encoded(value):
+    """The value read from JSON with its strings encoded like those libclang
+    returns."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_encoded(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_encoded(key), _encoded(item)) for key, item in value.iteritems())
+    return value
+
+
+def _mtime(file_name):
+    try:
+        return os.path.getmtime(file_name)
+    except OSError:
+        return None
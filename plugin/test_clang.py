@@ -5,7 +5,29 @@ import unittest
 import mock
 import threading
 import translation_unit_access
+import translation_unit_cache
+import ast_cache
+import compilation_database
+import include_graph
+import file_watching
+import worker_pool
+import parser_scheduling
+import parse_profiles
+import ranking
+import unsaved_files
+import signal
+import sys
+import clang.cindex
+import json
+import Queue
+import os
+import shutil
+import tempfile
 import common
+import completion
+import completion_containers
+import completion_documentation
+import symbol_index
 import math
 import configure_clang
 
@@ -38,6 +60,12 @@ class TestEditor(object):
         self._contents = 'invalid contents'
         self._selection = ((1, 1), (1, 1))
         self._highlights = {}
+        self._changedtick = 0
+        self._modified_buffers = {}
+        self.added_completions = []
+        self.batches_wanted = 1000
+        self.documentation = []
+        self.inserted_includes = []
 
     def display_diagnostics(self, quickfix_list):
         pass
@@ -45,6 +73,36 @@ class TestEditor(object):
     def excluded_directories(self):
         return []
 
+    def translation_unit_memory_budget(self):
+        return 1024 * 1024 * 1024
+
+    def visible_file_names(self):
+        return [self.file_name()]
+
+    def use_compilation_database(self):
+        return False
+
+    def watch_files(self):
+        return False
+
+    def worker_python(self):
+        return sys.executable
+
+    def minimum_parser_threads(self):
+        return 1
+
+    def maximum_parser_threads(self):
+        return 7
+
+    def ast_cache_directory(self):
+        return ""
+
+    def ast_cache_size_limit(self):
+        return 0
+
+    def symbol_index_file(self):
+        return ""
+
     def clear_highlights(self, style):
         self._highlights[style] = []
 
@@ -64,6 +122,22 @@ class TestEditor(object):
     def abort_requested(self):
         return False
 
+    def completion_timeout(self):
+        return 0
+
+    def completion_limit(self):
+        return 50
+
+    def show_completion_documentation(self, documentation):
+        self.documentation.append(documentation)
+
+    def insert_include(self, directive):
+        self.inserted_includes.append(directive)
+
+    def add_completions(self, completions):
+        self.added_completions.append([completion['abbr'] for completion in completions])
+        return len(self.added_completions) >= self.batches_wanted
+
     def current_line(self):
         return self._current_line
 
@@ -80,11 +154,20 @@ class TestEditor(object):
         return self._contents
 
     def changedtick(self):
-        return self.current_file()
+        return self._changedtick
 
     def current_file(self):
         return (self.file_name(), self.contents())
 
+    def modified_buffers(self):
+        return [(file_name, changedtick, contents)
+                for file_name, (changedtick, contents) in self._modified_buffers.items()]
+
+    def modify_buffer(self, file_name, contents):
+        """Change a buffer other than the current one without saving it."""
+        self._changedtick += 1
+        self._modified_buffers[file_name] = (self._changedtick, contents)
+
     def user_options(self):
         return ""
 
@@ -97,11 +180,13 @@ class TestEditor(object):
     def open_file(self, file_name, line, column):
         self._file_name = file_name
         self._contents = open(file_name, 'r').read()
+        self._changedtick += 1
         self._current_line = line
         self._current_column = column
 
     def set_content(self, content):
         self._contents = content
+        self._changedtick += 1
 
     def open_location(self, location):
         self.open_file(location.file.name, location.line, location.column)
@@ -114,6 +199,8 @@ class TestEditor(object):
 
 
 class TestClangPlugin(unittest.TestCase):
+    max_time = 0.5
+
     def setUp(self):
         self.editor = TestEditor()
         self.translation_unit_accessor = translation_unit_access.TranslationUnitAccessor(self.editor)
@@ -123,7 +210,7 @@ class TestClangPlugin(unittest.TestCase):
         self.clang_plugin.terminate()
 
     def assert_eventually(self, do_it):
-        max_time = 0.5
+        max_time = self.max_time
         step_size = 0.05
         for i in range(int(math.ceil(max_time / step_size))):
             if do_it():
@@ -194,6 +281,41 @@ class TestClangPlugin(unittest.TestCase):
         self.open_source_file("test_incomplete.cpp", 7, 7)
         self.clang_plugin.get_current_completions("")
 
+    def test_completions_are_formatted(self):
+        self.editor.set_content("struct Foo { int bar(int x); }; void f() { Foo foo; foo.")
+        self.editor._current_line = 1
+        self.editor._current_column = 57
+        completions = self.clang_plugin.get_current_completions("b")
+        self.assertEquals(["bar"], [completion['abbr'] for completion in completions])
+        self.assertEquals("bar(int x)", completions[0]['word'])
+        self.assertEquals("int bar(int x)", completions[0]['menu'])
+        self.assertEquals([[4, 9]], completions[0]['args_pos'])
+
+    def test_completion_uses_modified_buffers(self):
+        header = os.path.abspath(self.full_file_name("defined_in_header.h"))
+        self.editor.modify_buffer(header, "struct FromBuffer { int from_buffer; };")
+        self.editor.set_content('#include "%s"\nvoid f() { struct FromBuffer b; b.' % header)
+        self.editor._current_line = 2
+        self.editor._current_column = 35
+        completions = self.clang_plugin.get_current_completions("")
+        self.assertEquals(["from_buffer"], [completion['abbr'] for completion in completions])
+
+    def test_file_leaving_its_window_is_no_longer_visible(self):
+        self.editor.visible_file_names = lambda: ["/a.cpp", "/b.cpp"]
+        with mock.patch.object(self.translation_unit_accessor, 'visible_files_changed') as visible_files_changed:
+            self.clang_plugin.visible_files_changed("/a.cpp")
+            visible_files_changed.assert_called_with(["/b.cpp"])
+            self.clang_plugin.visible_files_changed()
+            visible_files_changed.assert_called_with(["/a.cpp", "/b.cpp"])
+
+    def test_documentation_of_highlighted_completion(self):
+        self.editor.set_content("struct Foo {\n  /// Does bar.\n  int bar(int x);\n};\nvoid f() { Foo foo; foo.")
+        self.editor._current_line = 5
+        self.editor._current_column = 25
+        self.clang_plugin.get_current_completions("b")
+        self.clang_plugin.show_completion_documentation("bar")
+        self.assertEquals(["int Foo::bar(int)\n\nDoes bar."], self.editor.documentation)
+
     def test_defined_in_another_source_declaration_starting_with_other_reference(self):
         self.assert_jumps_to_definition(
             "test_defined_in_another_source_declaration_starting_with_other_reference.cpp", 5, 3,
@@ -259,6 +381,492 @@ class TestClangPlugin(unittest.TestCase):
         self.assert_eventually(lambda: has_diagnostic_at_line(self.editor, num_changes))
 
 
+    def test_diagnostics_use_modified_buffers(self):
+        header = os.path.abspath(self.full_file_name("defined_in_header.h"))
+        self.editor.set_content('#include "%s"\nint x = from_buffer;' % header)
+        self.clang_plugin.file_changed()
+        self.assert_eventually(lambda: has_diagnostics(self.editor))
+
+        self.editor.modify_buffer(header, "int from_buffer;")
+        self.clang_plugin.file_changed()
+        self.assert_eventually(lambda: not has_diagnostics(self.editor))
+
+
+class TestClangPluginWithWorkerPool(TestClangPlugin):
+    """Runs all plugin tests with files being parsed by worker processes."""
+    max_time = 10
+
+    def setUp(self):
+        self.editor = TestEditor()
+        self.translation_unit_accessor = translation_unit_access.TranslationUnitAccessor(self.editor)
+        self.worker_pool = worker_pool.WorkerPool(self.editor, 2, clang.cindex.Config.library_path)
+        self.clang_plugin = clang_plugin.ClangPlugin(self.editor, self.translation_unit_accessor, 0, self.worker_pool)
+
+    def test_completes_in_worker(self):
+        self.editor.set_content("struct Foo { int bar; }; void f() { Foo foo; foo.")
+        self.editor._current_line = 1
+        self.editor._current_column = 50
+        completions = self.clang_plugin.get_current_completions("")
+        self.assertTrue("bar" in [completion['abbr'] for completion in completions])
+
+    def test_crashed_worker_is_restarted(self):
+        process = self.worker_pool._process_for(self.editor.file_name())
+        os.kill(process._process.pid, signal.SIGKILL)
+        self.assert_eventually(lambda: process.restarts() == 1)
+        self.editor.set_content("foo")
+        diagnostics, ranges = self.worker_pool.analyze(self.editor.current_file())
+        self.assertTrue(diagnostics)
+
+    def test_hanging_worker_yields_no_result(self):
+        process = self.worker_pool._process_for(self.editor.file_name())
+        os.kill(process._process.pid, signal.SIGSTOP)
+        try:
+            with mock.patch.dict(worker_pool.REQUEST_TIMEOUTS, {'completion_documentation': 0.1}):
+                self.assertEquals(None, self.worker_pool.completion_documentation(
+                    self.editor.current_file(), 1, 1, "foo"))
+        finally:
+            os.kill(process._process.pid, signal.SIGCONT)
+
+    def test_completes_in_this_process_once_the_pool_gave_up(self):
+        for process in self.worker_pool._processes:
+            process._given_up = True
+        self.assertFalse(self.worker_pool.alive())
+        self.test_completes_in_worker()
+
+
+class TestWorkerProcess(unittest.TestCase):
+    def test_crashing_worker_is_given_up_on(self):
+        messages = []
+        with mock.patch.multiple(worker_pool, FIRST_RESTART_DELAY=0.01, MAXIMUM_CRASHES=3):
+            process = worker_pool.WorkerProcess("false", dict(worker_id=0), messages.append)
+            try:
+                for i in range(100):
+                    if process.given_up():
+                        break
+                    time.sleep(0.05)
+                self.assertTrue(process.given_up())
+                self.assertEquals(3, process.restarts())
+                self.assertEquals(None, process.request('complete'))
+            finally:
+                process.terminate()
+
+
+class TestParserThreadScheduler(unittest.TestCase):
+    def setUp(self):
+        self.over_memory_budget = False
+        self.scheduler = parser_scheduling.ParserThreadScheduler(
+            1, 4, lambda: self.over_memory_budget, idle_after=10, poll_interval=0)
+
+    def test_all_threads_parse_when_idle(self):
+        self.assertEquals(4, self.scheduler.allowed_threads())
+
+    def test_one_thread_parses_while_user_is_active(self):
+        self.scheduler.user_active()
+        self.assertEquals(1, self.scheduler.allowed_threads())
+
+    def test_no_thread_parses_under_memory_pressure(self):
+        self.over_memory_budget = True
+        self.assertEquals(0, self.scheduler.allowed_threads())
+
+    def test_reports_utilization(self):
+        self.scheduler.started_parsing(2)
+        self.scheduler.finished_parsing(2)
+        utilization = self.scheduler.utilization()
+        self.assertEquals(4, len(utilization))
+        self.assertEquals(1, utilization[2]['parses'])
+        self.assertEquals(0, utilization[0]['parses'])
+
+
+class TestCurrentTranslationUnitAccess(unittest.TestCase):
+    def setUp(self):
+        self.accessor = mock.MagicMock(spec=['file_changed', 'translation_unit_do'])
+        self.access = clang_plugin.CurrentTranslationUnitAccess(self.accessor)
+        self.received = Queue.Queue()
+        self.access.add_listener(self.received.put)
+
+    def tearDown(self):
+        self.access.terminate()
+
+    def test_results_of_superseded_generations_are_dropped(self):
+        def translation_unit_do(file, function, profile):
+            if file[1] == "old":
+                self.access.file_changed(("a.cpp", "new"), 2)
+            return function(file[1])
+        self.accessor.translation_unit_do.side_effect = translation_unit_do
+
+        self.access.file_changed(("a.cpp", "old"), 1)
+        self.assertEquals("new", self.received.get(timeout=1))
+        time.sleep(0.1)
+        self.assertTrue(self.received.empty())
+
+    def test_waits_for_edits_to_stop_for_expensive_files(self):
+        parsed = []
+
+        def translation_unit_do(file, function, profile):
+            parsed.append(file[1])
+            time.sleep(0.2)
+            return function(file[1])
+        self.accessor.translation_unit_do.side_effect = translation_unit_do
+
+        self.access.file_changed(("a.cpp", "0"), 0)
+        self.assertEquals("0", self.received.get(timeout=1))
+        for i in range(1, 5):
+            self.access.file_changed(("a.cpp", str(i)), i)
+            time.sleep(0.05)
+        self.assertEquals("4", self.received.get(timeout=2))
+        self.assertEquals(["0", "4"], parsed)
+
+
+class TestCompletionService(unittest.TestCase):
+    def setUp(self):
+        self.started = Queue.Queue()
+        self.finish = threading.Event()
+        self.service = completion.CompletionService(TestEditor(), self.complete)
+
+    def tearDown(self):
+        self.finish.set()
+        self.service.terminate()
+
+    def complete(self, file, line, column, base, inserted=""):
+        self.started.put(file)
+        self.finish.wait(1)
+        return [file[1]]
+
+    def test_latest_request_of_a_file_wins(self):
+        running = self.service.submit(("a.cpp", "0"), 1, 1, "")
+        self.started.get(timeout=1)
+        waiting = self.service.submit(("a.cpp", "1"), 1, 1, "")
+        latest = self.service.submit(("a.cpp", "2"), 1, 1, "")
+        self.assertTrue(running.cancelled())
+        self.assertTrue(waiting.cancelled())
+        self.finish.set()
+        self.assertTrue(latest.wait(1))
+        self.assertEquals(["2"], latest.result())
+        self.assertEquals(("a.cpp", "2"), self.started.get(timeout=1))
+        self.assertTrue(self.started.empty())
+
+    def test_files_are_completed_concurrently(self):
+        a = self.service.submit(("a.cpp", "a"), 1, 1, "")
+        b = self.service.submit(("b.cpp", "b"), 1, 1, "")
+        started = set([self.started.get(timeout=1), self.started.get(timeout=1)])
+        self.assertEquals(set([("a.cpp", "a"), ("b.cpp", "b")]), started)
+        self.finish.set()
+        self.assertTrue(a.wait(1) and b.wait(1))
+        self.assertEquals(["b"], b.result())
+
+
+class TestCompletionCache(unittest.TestCase):
+    def test_key_depends_on_contents_before_the_token_only(self):
+        key = completion.CompletionCache.key
+        self.assertEquals(key(("a.cpp", "x;\nfoo.ba"), 2, 5), key(("a.cpp", "x;\nfoo.bar"), 2, 5))
+        self.assertNotEquals(key(("a.cpp", "x;\nfoo.ba"), 2, 5), key(("a.cpp", "y;\nfoo.ba"), 2, 5))
+
+    def test_typing_refilters_cached_completions(self):
+        editor = TestEditor()
+        editor.set_content("foo.")
+        editor._current_line = 1
+        editor._current_column = 5
+        completer = completion.Completer(editor, None, 0)
+        bases = []
+
+        def complete(file, line, column, base, inserted=""):
+            bases.append(base)
+            return [(priority, abbr, (abbr, abbr, "int", [], 6))
+                    for priority, abbr in [(1, "bar"), (2, "baz"), (3, "qux")]]
+        completer.complete = complete
+        try:
+            self.assertEquals(3, len(completer.get_current_completions("")))
+            editor.set_content("foo.ba")
+            self.assertEquals(["bar", "baz"], [c['abbr'] for c in completer.get_current_completions("ba")])
+            self.assertEquals([""], bases)
+            editor.set_content("fob.ba")
+            completer.get_current_completions("ba")
+            self.assertEquals(2, len(bases))
+        finally:
+            completer.terminate()
+
+
+class TestCompletionStreaming(unittest.TestCase):
+    def test_completions_are_streamed_best_first(self):
+        editor = TestEditor()
+        editor.set_content("foo.")
+        editor._current_line = 1
+        editor._current_column = 5
+        editor.batches_wanted = 2
+        completer = completion.Completer(editor, None, 0)
+        completer.complete = lambda file, line, column, base, inserted="": [
+            (priority, "name%d" % priority, ("name%d" % priority, "", "int", [], 6)) for priority in range(9, 0, -1)]
+        try:
+            completer.stream_current_completions("", batch_size=2)
+            self.assertEquals([["name1", "name2"], ["name3", "name4"]], editor.added_completions)
+        finally:
+            completer.terminate()
+
+
+class TestCompletionPrefetch(unittest.TestCase):
+    def test_speculates_on_member_access(self):
+        speculate = completion.speculative_completion
+        self.assertEquals((5, ""), speculate("foo.ba", 7))
+        self.assertEquals((9, ""), speculate("a::foo->", 9))
+        self.assertEquals((4, "."), speculate("foo", 4))
+        self.assertEquals((5, "."), speculate("f(x)", 5))
+        self.assertEquals((5, "->"), speculate("this", 5))
+        self.assertEquals(None, speculate("return", 7))
+        self.assertEquals(None, speculate("x = 10", 7))
+        self.assertEquals(None, speculate("x = ", 5))
+
+    def test_completes_in_advance(self):
+        editor = TestEditor()
+        editor.set_content("int x;\nfoo")
+        editor._current_line = 2
+        editor._current_column = 4
+        completer = completion.Completer(editor, None, 0)
+        completed = []
+
+        def complete(file, line, column, base, inserted=""):
+            completed.append(completion.insert(file, line, column, inserted)[1])
+            return [(1, "bar", ("bar", "bar", "int", [], 6))]
+        completer.complete = complete
+        try:
+            completer.prefetch_completions()
+            completer.prefetch_completions()
+            editor.set_content("int x;\nfoo.")
+            editor._current_column = 5
+            self.assertEquals(["bar"], [c['abbr'] for c in completer.get_current_completions("")])
+            self.assertEquals(["int x;\nfoo."], completed)
+            self.assertEquals({'prefetches': 1, 'hits': 1, 'misses': 0}, completer.prefetch_statistics())
+        finally:
+            completer.terminate()
+
+
+class TestContainerCompletions(unittest.TestCase):
+    def setUp(self):
+        self.containers = completion_containers.ContainerCompletions()
+        self.result = mock.MagicMock()
+        self.result.container_usr = "c:@S@Foo"
+        self.result.container_kind = (clang.cindex.CursorKind.STRUCT_DECL, False)
+        self.result.contexts = clang.cindex.CompletionContext.DOT_MEMBER_ACCESS
+
+    def test_finds_accessed_names(self):
+        accessed_name = completion_containers.accessed_name
+        self.assertEquals(("foo", "->"), accessed_name("  foo->", 8))
+        self.assertEquals(("std", "::"), accessed_name("std::", 6))
+        self.assertEquals(None, accessed_name("foo().", 7))
+        self.assertEquals(None, accessed_name("a.b.", 5))
+        self.assertEquals(None, accessed_name("x = ", 5))
+
+    def test_members_are_only_looked_up_in_translation_units_of_the_same_contents(self):
+        record = mock.MagicMock()
+        record.get_usr.return_value = "c:@S@Foo"
+        record.location.file = None
+        file = ("/a.cpp", "void f() {\n  Foo foo;\n  foo.")
+        with mock.patch.multiple(completion_containers, accessed_record=mock.MagicMock(return_value=record),
+                                 accessing_scope=mock.MagicMock(return_value=None)):
+            container_at = self.containers.container_at
+            self.assertTrue(container_at(None, file[1], file, 3, 7) is not None)
+            # Typed after the name since parsing.
+            self.assertTrue(container_at(None, file[1][:-4], file, 3, 7) is not None)
+            self.assertEquals(None, container_at(None, "\n" + file[1], file, 3, 7))
+            self.assertEquals(None, container_at(None, "void f() {\n  Bar foo;\n  foo.", file, 3, 7))
+            self.assertEquals(None, container_at(None, None, file, 3, 7))
+
+    def test_completions_in_the_same_container_are_cached(self):
+        container = completion_containers.Container("c:@S@Foo", ".", "/foo.h")
+        self.containers.put(container, self.result, ("/a.cpp", "foo."), 1, 5, ["bar"], "dependencies")
+        same_container = completion_containers.Container("c:@S@Foo", ".", "/foo.h")
+        self.assertEquals(["bar"], self.containers.get(same_container, lambda dependencies: True, set(["/foo.h"])))
+        self.assertEquals(None, self.containers.get(same_container, lambda dependencies: False, set(["/foo.h"])))
+
+    def test_completions_in_another_container_than_expected_are_not_cached(self):
+        container = completion_containers.Container("c:@S@Bar", ".", "/bar.h")
+        self.containers.put(container, self.result, ("/a.cpp", "bar."), 1, 5, ["bar"], "dependencies")
+        self.assertEquals(None, self.containers.get(container, lambda dependencies: True, set(["/bar.h"])))
+
+    def test_members_are_cached_per_accessing_class(self):
+        outside = completion_containers.Container("c:@S@Foo", ".", "/foo.h")
+        self.containers.put(outside, self.result, ("/a.cpp", "foo."), 1, 5, ["public"], "dependencies")
+        inside = completion_containers.Container("c:@S@Foo", ".", "/foo.h", "c:@S@Foo")
+        self.assertEquals(None, self.containers.get(inside, lambda dependencies: True, set(["/foo.h"])))
+
+    def test_members_are_only_used_by_files_including_the_container(self):
+        container = completion_containers.Container("c:@S@Foo", ".", "/foo.h")
+        self.containers.put(container, self.result, ("/a.cpp", "foo."), 1, 5, ["bar"], "dependencies")
+        self.assertEquals(None, self.containers.get(container, lambda dependencies: True, set(["/other.h"])))
+        self.assertEquals(None, self.containers.get(container, lambda dependencies: True, None))
+
+    def test_qualified_names_are_cached_per_file(self):
+        self.result.container_usr = "c:@N@ns"
+        self.result.container_kind = (clang.cindex.CursorKind.NAMESPACE, False)
+        self.containers.put(None, self.result, ("/a.cpp", "ns::"), 1, 5, ["foo"], "dependencies")
+        in_a = completion_containers.Container("c:@N@ns", "::", scope="/a.cpp")
+        in_b = completion_containers.Container("c:@N@ns", "::", scope="/b.cpp")
+        self.assertEquals(["foo"], self.containers.get(in_a, lambda dependencies: True, None))
+        self.assertEquals(None, self.containers.get(in_b, lambda dependencies: True, None))
+
+
+class TestCompletionDocumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.accessor = mock.MagicMock()
+        self.accessor.dependency_generations.return_value = (1, 2)
+        self.accessor.parsed_contents.return_value = None
+        self.documentation = completion_documentation.CompletionDocumentation(self.accessor)
+        declaration = mock.MagicMock()
+        declaration.get_usr.return_value = "c:@F@foo#"
+        self.documentation._visible_declarations = mock.MagicMock(return_value=[declaration])
+        self.file = ("/a.cpp", "void f() {\n  fo")
+
+    def document(self):
+        return self.documentation.documentation(None, self.file, 2, 5, "foo")
+
+    def test_documentation_is_memoized_while_the_files_are_unchanged(self):
+        with mock.patch.object(completion_documentation, 'describe', return_value="void foo()") as describe:
+            self.assertEquals("void foo()", self.document())
+            self.assertEquals("void foo()", self.document())
+            self.assertEquals(1, describe.call_count)
+            self.accessor.dependency_generations.return_value = (1, 3)
+            self.document()
+            self.assertEquals(2, describe.call_count)
+            self.accessor.dependency_generations.return_value = None
+            self.document()
+            self.document()
+            self.assertEquals(4, describe.call_count)
+
+
+class TestCompletionRanker(unittest.TestCase):
+    def setUp(self):
+        self.ranker = ranking.CompletionRanker()
+
+    def best(self, entries, base, limit=0, sorting='priority'):
+        return [abbr for priority, abbr, data in self.ranker.best(
+            [(priority, abbr, None) for priority, abbr in entries], base, limit, sorting)]
+
+    def test_matches(self):
+        self.assertEquals(ranking.PREFIX, ranking.match("getValue", "get"))
+        self.assertEquals(ranking.CASE_INSENSITIVE_PREFIX, ranking.match("getValue", "GetV"))
+        self.assertEquals(ranking.CAMEL_CASE, ranking.match("getValue", "gVal"))
+        self.assertEquals(ranking.CAMEL_CASE, ranking.match("get_value", "gv"))
+        self.assertEquals(ranking.SUBSEQUENCE, ranking.match("getValue", "gtl"))
+        self.assertEquals(None, ranking.match("getValue", "x"))
+
+    def test_better_matches_come_first(self):
+        entries = [(10, "gravity"), (50, "getValue"), (70, "gv"), (10, "other")]
+        self.assertEquals(["gv", "getValue", "gravity"], self.best(entries, "gv"))
+
+    def test_only_the_best_are_selected(self):
+        entries = [(priority, "name%d" % priority) for priority in range(100, 0, -1)]
+        self.assertEquals(["name1", "name2", "name3"], self.best(entries, "name", 3))
+        self.assertEquals(["name1", "name10", "name2"], self.best(entries, "name", 10, 'alpha')[:3])
+
+    def test_better_matches_outrank_accepted_completions_of_any_priority(self):
+        entries = [(0, "GetVolume"), (completion.INDEXED_PRIORITY, "getValue"), (500, "getVariant")]
+        self.ranker.accepted("GetVolume")
+        self.assertEquals(["getValue", "getVariant", "GetVolume"], self.best(entries, "getV"))
+
+    def test_accepted_completions_rank_higher(self):
+        entries = [(34, "first"), (40, "second")]
+        self.ranker.accepted("second")
+        self.assertEquals(["second", "first"], self.best(entries, ""))
+
+
+class TestIndexedPriorityQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = common.IndexedPriorityQueue(aging=10)
+
+    def test_takes_lower_priorities_first(self):
+        self.queue.put("b.cpp", 1)
+        self.queue.put("a.cpp", 0)
+        self.assertEquals((0, "a.cpp"), self.queue.get())
+        self.assertEquals((1, "b.cpp"), self.queue.get())
+
+    def test_keys_are_queued_once(self):
+        self.queue.put("a.cpp", 1)
+        self.assertFalse(self.queue.put("a.cpp", 1))
+        self.assertEquals(1, len(self.queue))
+
+    def test_promotes_keys(self):
+        self.queue.put("a.cpp", 1)
+        self.queue.put("b.cpp", 1)
+        self.assertTrue(self.queue.put("b.cpp", 0))
+        self.assertFalse(self.queue.put("b.cpp", 1))
+        self.assertEquals(0, self.queue.priority_of("b.cpp"))
+        self.assertEquals((0, "b.cpp"), self.queue.get())
+        self.assertEquals((1, "a.cpp"), self.queue.get())
+        self.assertEquals(0, len(self.queue))
+
+    def test_removes_keys(self):
+        self.queue.put("a.cpp", 0)
+        self.queue.put("b.cpp", 0)
+        self.assertTrue(self.queue.remove("a.cpp"))
+        self.assertFalse("a.cpp" in self.queue)
+        self.assertEquals((0, "b.cpp"), self.queue.get())
+
+    def test_old_entries_are_taken_before_newer_entries_of_higher_priority(self):
+        self.queue.put("old.cpp", 1)
+        for i in range(20):
+            self.queue.put("new%d.cpp" % i, 0)
+        taken = [self.queue.get()[1] for i in range(21)]
+        self.assertEquals(10, taken.index("old.cpp"))
+
+
+class TestMovingAverages(unittest.TestCase):
+    def test_averages_are_weighted(self):
+        averages = common.MovingAverages(weight=0.5)
+        self.assertEquals(None, averages.get("a.cpp"))
+        averages.add("a.cpp", 1.0)
+        averages.add("a.cpp", 3.0)
+        self.assertEquals(2.0, averages.get("a.cpp"))
+
+
+class TestGenerations(unittest.TestCase):
+    def test_older_generations_are_superseded(self):
+        generations = common.Generations()
+        generations.request("a.cpp", 2)
+        generations.request("a.cpp", 1)
+        self.assertTrue(generations.is_superseded("a.cpp", 1))
+        self.assertFalse(generations.is_superseded("a.cpp", 2))
+        self.assertFalse(generations.is_superseded("b.cpp", 1))
+        self.assertFalse(generations.is_superseded("a.cpp", None))
+
+
+class TestUnsavedFiles(unittest.TestCase):
+    def test_array_is_rebuilt_only_on_changes(self):
+        contents = "int a;"
+        files = clang.cindex.UnsavedFiles([("a.cpp", contents)])
+        array = files.array()
+        files.set("a.cpp", contents)
+        self.assertTrue(array is files.array())
+        files.set("a.cpp", "int b;")
+        self.assertEquals("int b;", files.array()[0].contents)
+        files.set("b.cpp", "int c;")
+        self.assertEquals(2, len(files.array()))
+        files.remove("a.cpp")
+        self.assertEquals([("b.cpp", "int c;")], list(files))
+
+    def test_registry_reuses_unsaved_files_of_a_generation(self):
+        registry = unsaved_files.UnsavedFileRegistry()
+        first = registry.unsaved_files("a.cpp", [("a.cpp", "int a;")], 1)
+        self.assertTrue(first is registry.unsaved_files("a.cpp", [("a.cpp", "int a;")], 1))
+        second = registry.unsaved_files("a.cpp", [("a.cpp", "int b;")], 2)
+        self.assertFalse(first is second)
+        self.assertEquals([("a.cpp", "int b;")], list(second))
+        registry.forget("a.cpp")
+        self.assertFalse(second is registry.unsaved_files("a.cpp", [("a.cpp", "int b;")], 2))
+
+    def test_only_included_buffers_are_relevant(self):
+        buffers = unsaved_files.ModifiedBuffers()
+        buffers.update("a.h", "int a;")
+        buffers.update("b.h", "int b;")
+        a = os.path.abspath("a.h")
+        self.assertEquals(2, len(buffers.relevant_to("c.cpp", None)))
+        self.assertEquals([a], [name for name, contents, generation in buffers.relevant_to("c.cpp", [a])])
+        self.assertEquals([], buffers.relevant_to("a.h", [a]))
+        buffers.remove("a.h")
+        self.assertEquals([], buffers.relevant_to("c.cpp", [a]))
+        self.assertEquals(None, buffers.contents("a.h"))
+        self.assertEquals("int b;", buffers.contents("b.h"))
+
+
 class TestTranslationUnitParser(unittest.TestCase):
     def test_files_changed_while_parsing_should_not_be_up_to_date(self):
 
@@ -291,6 +899,488 @@ class TestTranslationUnitParser(unittest.TestCase):
         self.assertFalse(parser.is_up_to_date("foo.cpp"))
 
 
+class TestTranslationUnitCache(unittest.TestCase):
+    def setUp(self):
+        self.evicted = []
+        self.cache = translation_unit_cache.TranslationUnitCache(100, self.evicted.append)
+
+    def translation_unit(self, memory_usage):
+        translation_unit = mock.MagicMock(spec=[])
+        translation_unit.memory_usage = memory_usage
+        return translation_unit
+
+    def test_counts_hits_and_misses(self):
+        self.cache.add("a.cpp", self.translation_unit(10))
+        self.cache.get("a.cpp")
+        self.cache.get("b.cpp")
+        statistics = self.cache.statistics()
+        self.assertEquals(1, statistics['hits'])
+        self.assertEquals(1, statistics['misses'])
+
+    def test_evicts_least_recently_used(self):
+        self.cache.add("a.cpp", self.translation_unit(40))
+        self.cache.add("b.cpp", self.translation_unit(40))
+        self.cache.get("a.cpp")
+        self.cache.add("c.cpp", self.translation_unit(40))
+        self.assertEquals(["b.cpp"], self.evicted)
+        self.assertTrue("a.cpp" in self.cache)
+        self.assertEquals(1, self.cache.statistics()['evictions'])
+
+    def test_never_evicts_pinned_translation_units(self):
+        self.cache.pin(["a.cpp"])
+        self.cache.add("a.cpp", self.translation_unit(60))
+        self.cache.add("b.cpp", self.translation_unit(60))
+        self.assertEquals([], self.evicted)
+        self.cache.add("c.cpp", self.translation_unit(10))
+        self.assertEquals(["b.cpp"], self.evicted)
+
+    def test_keeps_most_recent_translation_unit_even_if_too_large(self):
+        self.cache.add("a.cpp", self.translation_unit(1000))
+        self.assertTrue("a.cpp" in self.cache)
+
+    def test_reevaluates_after_memory_usage_changes(self):
+        translation_unit = self.translation_unit(10)
+        self.cache.add("a.cpp", translation_unit)
+        self.cache.add("b.cpp", self.translation_unit(10))
+        translation_unit.memory_usage = 200
+        self.cache.get("a.cpp")
+        self.cache.update_memory_usage("a.cpp")
+        self.assertEquals(["b.cpp"], self.evicted)
+
+
+class TestAstCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.header_name = os.path.join(self.directory, "header.h")
+        self.source_name = os.path.join(self.directory, "source.cpp")
+        self.write(self.header_name, "void foo();")
+        self.source = (self.source_name, '#include "header.h"\nvoid bar() { foo(); }')
+        self.index = clang_plugin.clang.cindex.Index.create()
+        self.cache = ast_cache.AstCache(os.path.join(self.directory, "cache"), 1024 * 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, file_name, contents):
+        with open(file_name, "w") as f:
+            f.write(contents)
+
+    def store(self):
+        translation_unit = self.index.parse(self.source_name, [], [self.source])
+        self.cache.store(translation_unit, self.source, [])
+
+    def test_loads_stored_translation_unit(self):
+        self.store()
+        translation_unit = self.cache.load(self.index, self.source, [])
+        self.assertEquals("TRANSLATION_UNIT", translation_unit.cursor.kind.name)
+
+    def test_ignores_entries_for_other_arguments(self):
+        self.store()
+        self.assertEquals(None, self.cache.load(self.index, self.source, ["-DFOO"]))
+
+    def test_ignores_entries_for_changed_contents(self):
+        self.store()
+        changed_source = (self.source_name, self.source[1] + "\n")
+        self.assertEquals(None, self.cache.load(self.index, changed_source, []))
+
+    def test_ignores_entries_with_changed_includes(self):
+        self.store()
+        self.write(self.header_name, "void foo(int);")
+        self.assertEquals(None, self.cache.load(self.index, self.source, []))
+
+
+class TestSymbolIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.header_name = os.path.join(self.directory, "include", "header.h")
+        self.source_name = os.path.join(self.directory, "source.cpp")
+        os.mkdir(os.path.dirname(self.header_name))
+        self.write(self.header_name, "namespace ns { int max(int a, int b); struct Point { int x; }; }\n")
+        self.source = (self.source_name, '#include "include/header.h"\nint main() {}')
+        self.index_file_name = os.path.join(self.directory, "symbols.json")
+        self.index = symbol_index.SymbolIndex(self.index_file_name)
+        self.index.wait_until_loaded()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, file_name, contents):
+        with open(file_name, "w") as f:
+            f.write(contents)
+
+    def index_source(self, index):
+        translation_unit = clang_plugin.clang.cindex.Index.create().parse(self.source_name, [], [self.source])
+        index.index_translation_unit(translation_unit, self.source_name)
+
+    def test_indexes_declarations_of_included_headers(self):
+        self.index_source(self.index)
+        [symbol] = self.index.lookup("ma", 10)
+        self.assertEquals("ns::max", symbol.qualified_name)
+        self.assertEquals("ns::max(int a, int b)", symbol.word)
+        self.assertEquals([(8, 13), (15, 20)], symbol.placeholder_spans)
+        self.assertEquals(common.normalized_file_name(self.header_name), symbol.header)
+        self.assertEquals([], self.index.lookup("main", 10))
+
+    def test_looks_up_names_by_prefix_ignoring_case(self):
+        self.index_source(self.index)
+        self.assertEquals(["Point"], [symbol.name for symbol in self.index.lookup("poi", 10)])
+        self.assertEquals([], self.index.lookup("x", 10))
+
+    def test_changed_headers_replace_their_declarations(self):
+        self.index_source(self.index)
+        self.write(self.header_name, "int min(int a, int b);\n")
+        mtime = os.path.getmtime(self.header_name) + 10
+        os.utime(self.header_name, (mtime, mtime))
+        self.index_source(self.index)
+        self.assertEquals([], self.index.lookup("max", 10))
+        self.assertEquals(["min"], [symbol.qualified_name for symbol in self.index.lookup("min", 10)])
+        self.assertEquals(1, self.index.statistics()['symbols'])
+
+    def test_completions_of_namespace_members_are_qualified(self):
+        completer = completion.Completer(TestEditor(), None, 0)
+        try:
+            formatted = completer.format_result("max", "ns::max(int a)", "int", [(8, 13)], 8,
+                                                '#include "header.h"', "ns::max")
+        finally:
+            completer.terminate()
+        self.assertEquals("ns::max", formatted['qualified_name'])
+        self.assertEquals('#include "header.h"', formatted['user_data'])
+
+    def test_saved_index_is_loaded(self):
+        self.index_source(self.index)
+        self.index.save()
+        loaded = symbol_index.SymbolIndex(self.index_file_name)
+        self.assertTrue(loaded.wait_until_loaded(5))
+        self.assertEquals(["ns::max"], [symbol.qualified_name for symbol in loaded.lookup("max", 10)])
+
+    def test_include_directive_is_the_shortest_relative_path(self):
+        include_directive = symbol_index.include_directive
+        self.assertEquals('#include "lib/a.h"',
+                          include_directive("/p/include/lib/a.h", "/p/src/main.cpp", ["/p", "/p/include"]))
+        self.assertEquals('#include "a.h"', include_directive("/p/src/a.h", "/p/src/main.cpp", []))
+        self.assertEquals(None, include_directive("/q/a.h", "/p/src/main.cpp", ["/p"]))
+
+    def test_finds_include_directories_in_arguments(self):
+        self.assertEquals(["/p/include", "/p/lib"],
+                          symbol_index.include_directories(["-I/p/include", "-DX", "-isystem", "/p/lib"]))
+
+
+class TestCompilationDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source_directory = os.path.join(self.directory, "src")
+        os.mkdir(self.source_directory)
+        self.write_database([
+            dict({'directory': self.directory,
+                  'command': 'g++ -c -Iinclude -DFOO -o src/foo.o src/foo.cpp',
+                  'file': 'src/foo.cpp'}),
+            dict({'directory': self.directory,
+                  'arguments': ['g++', '-c', '-DBAR', 'src/bar.cpp'],
+                  'file': 'src/bar.cpp'})])
+        self.databases = compilation_database.CompilationDatabases()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_database(self, entries):
+        with open(os.path.join(self.directory, "compile_commands.json"), "w") as f:
+            json.dump(entries, f)
+
+    def arguments_for(self, file_name):
+        return self.databases.arguments_for(os.path.join(self.source_directory, file_name))
+
+    def test_finds_arguments_of_source_file(self):
+        self.assertEquals(
+            ["-I" + os.path.join(self.directory, "include"), "-DFOO"],
+            self.arguments_for("foo.cpp"))
+
+    def test_header_uses_arguments_of_source_file_with_same_name(self):
+        self.assertEquals(["-DBAR"], self.arguments_for("bar.h"))
+
+    def test_reloads_changed_database(self):
+        self.assertEquals(["-DBAR"], self.arguments_for("bar.cpp"))
+        self.write_database([
+            dict({'directory': self.directory,
+                  'arguments': ['g++', '-DBAZ', 'src/bar.cpp'],
+                  'file': 'src/bar.cpp'})])
+        database_file_name = os.path.join(self.directory, "compile_commands.json")
+        os.utime(database_file_name, (time.time() + 10, time.time() + 10))
+        self.assertEquals(["-DBAZ"], self.arguments_for("bar.cpp"))
+
+    def test_files_outside_of_any_database_have_no_arguments(self):
+        self.assertEquals(None, self.databases.arguments_for("/some_file.cpp"))
+
+    def test_databases_created_later_are_found(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, "foo.cpp")
+            self.assertEquals(None, self.databases.arguments_for(file_name))
+            with open(os.path.join(directory, "compile_commands.json"), "w") as f:
+                json.dump([dict({'directory': directory, 'arguments': ['g++', '-DFOO', 'foo.cpp'],
+                                 'file': 'foo.cpp'})], f)
+            self.assertEquals(["-DFOO"], self.databases.arguments_for(file_name))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_precompiled_header_is_not_taken_for_an_include(self):
+        sanitize = compilation_database.sanitize_arguments
+        self.assertEquals(["-include-pch", "/build/foo.pch", "-include", "/build/foo.h"],
+                          sanitize(["g++", "-include-pch", "foo.pch", "-include", "foo.h", "foo.cpp"],
+                                   "/build", "foo.cpp"))
+
+    def test_paths_passed_with_xclang_are_made_absolute(self):
+        sanitize = compilation_database.sanitize_arguments
+        self.assertEquals(["-Xclang", "-include-pch", "-Xclang", "/build/foo.pch", "-Xclang", "-fno-validate-pch"],
+                          sanitize(["clang++", "-Xclang", "-include-pch", "-Xclang", "foo.pch",
+                                    "-Xclang", "-fno-validate-pch", "foo.cpp"], "/build", "foo.cpp"))
+        self.assertEquals(["-Xclang", "-include", "-Xclang", "/build/foo.h"],
+                          sanitize(["clang++", "-Xclang", "-include", "-Xclang", "foo.h", "foo.cpp"],
+                                   "/build", "foo.cpp"))
+
+
+class TestTranslationUnitInvalidation(unittest.TestCase):
+    def setUp(self):
+        self.index = mock.MagicMock(spec=[])
+        self.index.parse = mock.MagicMock(side_effect=self.make_translation_unit)
+        self.translation_units = []
+        self.parser = translation_unit_access.SynchronizedTranslationUnitParser(self.index, TestEditor())
+
+    def make_translation_unit(self, file_name, *args):
+        translation_unit = mock.MagicMock()
+        translation_unit.memory_usage = 0
+        inclusion = mock.MagicMock()
+        inclusion.include.name = os.path.abspath("header.h")
+        translation_unit.get_includes.return_value = [inclusion]
+        self.translation_units.append(translation_unit)
+        return translation_unit
+
+    def parse(self, file_name, contents, profile=parse_profiles.INTERACTIVE):
+        self.parser.translation_unit_do(file_name, lambda: contents, lambda tu: tu, profile)
+
+    def number_of_reparses(self):
+        return sum(tu.reparse.call_count for tu in self.translation_units)
+
+    def test_unchanged_file_is_not_reparsed(self):
+        self.parse("source.cpp", "void foo();")
+        reparses = self.number_of_reparses()
+        self.parser.file_changed(("source.cpp", "void foo();"))
+        self.parse("source.cpp", "void foo();")
+        self.assertEquals(reparses, self.number_of_reparses())
+
+    def test_changing_a_file_does_not_invalidate_unrelated_files(self):
+        self.parse("source.cpp", "void foo();")
+        self.parser.file_changed(("other.cpp", "void bar();"))
+        self.assertTrue(self.parser.is_up_to_date("source.cpp"))
+
+    def test_changing_a_file_invalidates_itself(self):
+        self.parse("source.cpp", "void foo();")
+        self.parser.file_changed(("source.cpp", "void bar();"))
+        self.assertFalse(self.parser.is_up_to_date("source.cpp"))
+
+    def test_changing_an_included_file_invalidates_including_files(self):
+        self.parse("source.cpp", "void foo();")
+        self.parser.file_changed((os.path.abspath("header.h"), "void bar();"))
+        self.assertFalse(self.parser.is_up_to_date("source.cpp"))
+
+    def test_changes_on_disk_invalidate_including_files(self):
+        self.parse("source.cpp", "void foo();")
+        self.parse("other.cpp", "void bar();")
+        affected = self.parser.files_changed_on_disk(
+            set([os.path.abspath("header.h"), os.path.abspath("unrelated.h")]))
+        self.assertEquals(set(["source.cpp", "other.cpp"]), affected)
+        self.assertFalse(self.parser.is_up_to_date("source.cpp"))
+
+    def test_changes_on_disk_to_the_contents_parsed_are_skipped(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, "source.cpp")
+            with open(file_name, "w") as f:
+                f.write("void foo();")
+            self.parse(file_name, "void foo();")
+            self.assertEquals(set(), self.parser.files_changed_on_disk(set([file_name])))
+            self.assertTrue(self.parser.is_up_to_date(file_name))
+            with open(file_name, "w") as f:
+                f.write("void bar();")
+            self.assertEquals(set([file_name]), self.parser.files_changed_on_disk(set([file_name])))
+            self.assertFalse(self.parser.is_up_to_date(file_name))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_lost_changes_on_disk_invalidate_everything(self):
+        self.parse("source.cpp", "void foo();")
+        self.parser.files_changed_on_disk(None)
+        self.assertFalse(self.parser.is_up_to_date("source.cpp"))
+
+    def test_background_parses_skip_function_bodies(self):
+        self.parse("source.cpp", "void foo();", parse_profiles.BACKGROUND)
+        self.assertEquals(parse_profiles.BACKGROUND.options, self.index.parse.call_args[0][3])
+        self.assertEquals(0, self.number_of_reparses())
+
+    def test_richer_profiles_parse_again(self):
+        self.parse("source.cpp", "void foo();", parse_profiles.BACKGROUND)
+        self.assertFalse(self.parser.is_up_to_date("source.cpp", profile=parse_profiles.INTERACTIVE))
+        self.parse("source.cpp", "void foo();", parse_profiles.INTERACTIVE)
+        self.assertEquals(2, self.index.parse.call_count)
+        self.parse("source.cpp", "void foo();", parse_profiles.BACKGROUND)
+        self.assertEquals(2, self.index.parse.call_count)
+        self.assertTrue(self.parser.is_up_to_date("source.cpp", profile=parse_profiles.DIAGNOSTICS))
+
+    def use_ast_cache(self):
+        ast_cache = mock.MagicMock()
+        ast_cache.load.return_value = None
+        with mock.patch.object(translation_unit_access, 'AstCache', return_value=ast_cache):
+            self.parser = translation_unit_access.SynchronizedTranslationUnitParser(self.index, TestEditor())
+        return ast_cache
+
+    def wait_until_stored(self):
+        self.parser._ast_cache_stores.join()
+
+    def test_ast_cache_is_bypassed_while_included_buffers_are_modified(self):
+        ast_cache = self.use_ast_cache()
+        self.parse("source.cpp", "void foo();")
+        self.wait_until_stored()
+        self.assertEquals(1, ast_cache.load.call_count)
+        self.assertEquals(1, ast_cache.store.call_count)
+
+        self.parser.buffer_modified((os.path.abspath("header.h"), "int a;"))
+        # The includes of other.cpp are unknown, so the buffer may be among them.
+        self.parse("other.cpp", "void bar();")
+        self.wait_until_stored()
+        self.assertEquals(1, ast_cache.load.call_count)
+        self.assertEquals(1, ast_cache.store.call_count)
+
+    def test_modified_buffers_are_not_stored_in_the_ast_cache(self):
+        ast_cache = self.use_ast_cache()
+        self.parser.buffer_modified(("source.cpp", "void foo();"))
+        self.parse("source.cpp", "void foo();")
+        self.wait_until_stored()
+        self.assertEquals(1, ast_cache.load.call_count)
+        self.assertEquals(0, ast_cache.store.call_count)
+
+    def test_ast_cache_stores_the_version_published(self):
+        ast_cache = self.use_ast_cache()
+        stored = threading.Event()
+        ast_cache.store.side_effect = lambda *args: stored.set()
+        self.parse("source.cpp", "void foo();")
+        self.assertTrue(stored.wait(1))
+        self.assertTrue(ast_cache.store.call_args[0][0] is self.translation_units[0])
+        self.assertEquals(("source.cpp", "void foo();"), ast_cache.store.call_args[0][1])
+
+    def test_new_versions_are_built_on_the_standby_translation_unit(self):
+        self.parse("source.cpp", "void foo();")
+        self.parse("source.cpp", "void bar();")
+        self.assertEquals(2, self.index.parse.call_count)
+        self.parse("source.cpp", "void baz();")
+        self.assertEquals(2, self.index.parse.call_count)
+        self.assertEquals(2, self.translation_units[0].reparse.call_count)
+
+    def test_first_change_after_a_fresh_parse_is_built_on_a_new_standby(self):
+        ast_cache = self.use_ast_cache()
+        self.parse("source.cpp", "void foo();")
+        self.parse("source.cpp", "void bar();")
+        self.assertEquals(1, ast_cache.load.call_count)
+        self.assertEquals(1, self.translation_units[1].reparse.call_count)
+
+    def test_reads_mark_translation_units_as_used(self):
+        self.parse("source.cpp", "void foo();")
+        self.parse("source.cpp", "void foo();")
+        self.parser.translation_unit_for_completion_do("source.cpp", lambda: "void foo();", lambda tu: tu)
+        statistics = self.parser.translation_unit_cache_statistics()
+        self.assertEquals(1, statistics['misses'])
+        self.assertEquals(2, statistics['hits'])
+
+    def test_stale_readers_do_not_wait_for_a_reparse(self):
+        self.parse("source.cpp", "void foo();")
+        self.parse("source.cpp", "void bar();")
+        published, standby = self.translation_units[1], self.translation_units[0]
+        reparsing = threading.Event()
+        continue_reparsing = threading.Event()
+
+        def reparse(*args):
+            reparsing.set()
+            continue_reparsing.wait(1)
+        standby.reparse.side_effect = reparse
+        thread = threading.Thread(target=lambda: self.parse("source.cpp", "void baz();"))
+        thread.start()
+        reparsing.wait(1)
+
+        read = self.parser.translation_unit_do(
+            "source.cpp", lambda: "void baz();", lambda tu: tu, parse_profiles.INTERACTIVE, allow_stale=True)
+        self.assertTrue(read is published)
+        continue_reparsing.set()
+        thread.join()
+        read = self.parser.translation_unit_do("source.cpp", lambda: "void baz();", lambda tu: tu)
+        self.assertTrue(read is standby)
+
+    def test_completion_does_not_reparse_first(self):
+        self.parser.translation_unit_for_completion_do("source.cpp", lambda: "void foo();", lambda tu: tu)
+        self.assertEquals(1, self.index.parse.call_count)
+        reparses = self.number_of_reparses()
+        self.parser.file_changed(("source.cpp", "void bar();"))
+        read = self.parser.translation_unit_for_completion_do("source.cpp", lambda: "void bar();", lambda tu: tu)
+        self.assertTrue(read is self.translation_units[0])
+        self.assertEquals(reparses, self.number_of_reparses())
+        self.assertEquals(1, self.index.parse.call_count)
+
+
+class TestIncludeGraph(unittest.TestCase):
+    def setUp(self):
+        self.graph = include_graph.IncludeGraph()
+
+    def test_finds_includers(self):
+        self.graph.update("a.cpp", ["common.h", "a.h"])
+        self.graph.update("b.cpp", ["common.h"])
+        self.assertEquals(set(["a.cpp", "b.cpp"]), self.graph.includers_of("common.h"))
+        self.assertEquals(set(["a.cpp"]), self.graph.includers_of(os.path.abspath("a.h")))
+
+    def test_updating_replaces_previous_includes(self):
+        self.graph.update("a.cpp", ["a.h"])
+        self.graph.update("a.cpp", ["b.h"])
+        self.assertEquals(set(), self.graph.includers_of("a.h"))
+        self.assertEquals(set(["a.cpp"]), self.graph.includers_of("b.h"))
+
+    def test_removed_translation_units_include_nothing(self):
+        self.graph.update("a.cpp", ["a.h"])
+        self.graph.remove("a.cpp")
+        self.assertEquals(set(), self.graph.includers_of("a.h"))
+        self.assertEquals(None, self.graph.includes_of("a.cpp"))
+
+
+class TestFileWatching(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "watched.h")
+        with open(self.file_name, "w") as f:
+            f.write("void foo();")
+        self.changes = []
+        self.changed = threading.Event()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def on_change(self, file_names):
+        self.changes.append(file_names)
+        self.changed.set()
+
+    def test_batcher_reports_bursts_together(self):
+        batcher = file_watching.ChangeBatcher(quiet_period=0.05, max_delay=10)
+        batcher.add(["a.h"])
+        batcher.add(["b.h"])
+        self.assertFalse(batcher.is_due())
+        time.sleep(0.1)
+        self.assertTrue(batcher.is_due())
+        self.assertEquals(set(["a.h", "b.h"]), batcher.take())
+        self.assertFalse(batcher.is_due())
+
+    def test_polling_watcher_reports_changed_files(self):
+        watcher = file_watching.PollingFileWatcher(self.on_change, interval=0.05)
+        watcher.watch_files([self.file_name])
+        os.utime(self.file_name, (0, 0))
+        self.changed.wait(5)
+        watcher.terminate()
+        self.assertEquals([set([self.file_name])], self.changes[:1])
+
+
 def range_from_tuples(file_name, start, end):
     start_pos = common.ExportedLocation(file_name, start[0], start[1])
     end_pos = common.ExportedLocation(file_name, end[0], end[1])
@@ -452,6 +1542,8 @@ class TestIdleTranslationUnitParserThreadDistributor(unittest.TestCase):
     def setUp(self):
         self.editor = TestEditor()
         self.parser = mock.MagicMock(spec=[])
+        self.parser.is_over_memory_budget = mock.MagicMock(return_value=False)
+        self.parser.modified_buffer_contents = mock.MagicMock(return_value=None)
         self.distributor = translation_unit_access.IdleTranslationUnitParserThreadDistributor(
             self.editor, self.parser)
 
@@ -465,7 +1557,7 @@ class TestIdleTranslationUnitParserThreadDistributor(unittest.TestCase):
 
         contents = ""
 
-        def translation_unit_do(file_name, get_contents, enqueue_related_file):
+        def translation_unit_do(file_name, get_contents, enqueue_related_file, profile):
             self.assertEquals(contents, get_contents())
             with is_in_parser:
                 is_in_parser.notify()
@@ -495,6 +1587,62 @@ class TestIdleTranslationUnitParserThreadDistributor(unittest.TestCase):
         with continue_parsing:
             continue_parsing.notify()
 
+    def parse_once_released(self, parsed):
+        """Makes the files taken from the queue be parsed only once released,
+        with the contents they have by then."""
+        release = threading.Event()
+
+        def translation_unit_do(file_name, get_contents, function, profile):
+            release.wait(1)
+            parsed.append((file_name, get_contents()))
+
+        self.parser.is_up_to_date = mock.MagicMock(return_value=False)
+        self.parser.translation_unit_do = mock.MagicMock(side_effect=translation_unit_do)
+        return release
+
+    def wait_until_parsed(self, parsed, count):
+        for i in range(20):
+            if len(parsed) >= count:
+                return
+            time.sleep(0.05)
+        self.assertEquals(count, len(parsed))
+
+    def test_forgotten_contents_of_queued_files_are_read_from_disk(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, "queued.cpp")
+            with open(file_name, "w") as f:
+                f.write("void bar();")
+            parsed = []
+            release = self.parse_once_released(parsed)
+            self.distributor.enqueue_file((file_name, "void baz();"))
+            self.distributor.forget_file_contents([file_name])
+            release.set()
+            self.wait_until_parsed(parsed, 1)
+            self.assertEquals([(file_name, "void bar();")], parsed)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_queued_modified_buffers_are_parsed_with_their_unsaved_contents(self):
+        parsed = []
+        release = self.parse_once_released(parsed)
+        self.parser.modified_buffer_contents.return_value = "void unsaved();"
+        self.distributor.enqueue_file(("buffer.cpp", "void foo();"))
+        self.distributor.forget_file_contents(["buffer.cpp"])
+        release.set()
+        self.wait_until_parsed(parsed, 1)
+        self.assertEquals([("buffer.cpp", "void unsaved();")], parsed)
+
+    def test_files_that_cannot_be_read_do_not_stop_parsing(self):
+        parsed = []
+        release = self.parse_once_released(parsed)
+        self.distributor.enqueue_file(("/nonexistent/removed.cpp", "void foo();"))
+        self.distributor.forget_file_contents(["/nonexistent/removed.cpp"])
+        self.distributor.enqueue_file(("last.cpp", "void bar();"))
+        release.set()
+        self.wait_until_parsed(parsed, 1)
+        self.assertEquals([("last.cpp", "void bar();")], parsed)
+
 
 class TestIdleTranslationUnitParserThread(unittest.TestCase):
     def test_parsing_enqueues_related_files(self):
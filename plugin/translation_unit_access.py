@@ -2,53 +2,128 @@ import clang.cindex
 import threading
 import Queue
 from finding import DefinitionFileFinder
-from common import Worker
+from common import IndexedPriorityQueue, Worker, content_hash
+from file_states import FileStates
+from include_graph import IncludeGraph
+from symbol_index import SymbolIndex, include_directories
+from translation_unit_cache import TranslationUnitCache
+from ast_cache import AstCache
+from compilation_database import CompilationDatabases
+from file_watching import make_file_watcher
+from parser_scheduling import ParserThreadScheduler, number_of_cores
+from unsaved_files import ModifiedBuffers, UnsavedFileRegistry
+from translation_unit_snapshots import DoubleBufferedTranslationUnit, TranslationUnitHandle
+import parse_profiles
 import traceback
 
 
+# Files reported changed on disk are read and compared with the contents
+# parsed, e.g. to skip the file just saved from the editor, unless more
+# changed at once, e.g. by switching branches.
+MAXIMUM_COMPARED_CHANGES = 64
+
+
 class TranslationUnitParsingAction(object):
-    def __init__(self, editor, index, translation_units, up_to_date, file):
+    """
+    Builds the next version of a file's translation unit on a handle no
+    reader uses: the standby handle if it was parsed with a profile serving
+    the requested one, else a new translation unit. Readers keep using the
+    published version until the new one is published. Without an AST cache,
+    e.g. as modified buffers are parsed, translation units are not loaded
+    from it. New translation units are handed to store_in_ast_cache once
+    published, unless it is None.
+    """
+
+    def __init__(self, editor, index, compile_arguments, translation_units, is_up_to_date, ast_cache, store_in_ast_cache, file, content_hash, unsaved_files, profile):
         self._editor = editor
         self._index = index
+        self._compile_arguments = compile_arguments
         self._translation_units = translation_units
-        self._up_to_date = up_to_date
+        self._is_up_to_date = is_up_to_date
+        self._ast_cache = ast_cache
+        self._store_in_ast_cache = store_in_ast_cache
         self._file = file
+        self._content_hash = content_hash
+        self._unsaved_files = unsaved_files
+        self._profile = profile
 
     def parse(self):
-        if self._file_name() in self._translation_units:
-            result = self._reuse_existing_translation_unit()
-        else:
-            result = self._read_new_translation_unit()
-        self._up_to_date.add(self._file_name())
-        return result
+        """Returns the file's DoubleBufferedTranslationUnit, None if the file
+        was never parsed successfully."""
+        versions = self._translation_units.peek(self._file_name())
+        if versions is None:
+            versions = DoubleBufferedTranslationUnit()
+        published = versions.published()
+        if published and published.profile().serves(self._profile):
+            if self._is_up_to_date:
+                return versions
+            if self._reparse_standby(versions):
+                return self._stored(versions)
+        # Either not parsed yet or parsed with a poorer profile.
+        if self._read_new_translation_unit(versions):
+            return self._stored(versions)
+        if published:
+            return versions
+        return None
 
     def _file_name(self):
         return self._file[0]
 
-    def _reuse_existing_translation_unit(self):
-        tu = self._translation_units[self._file_name()]
-        if self._file_name() not in self._up_to_date:
-            tu.reparse([self._file])
-        return tu
-
-    def _read_new_translation_unit(self):
-        flags = clang.cindex.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE
+    def _stored(self, versions):
+        if self._file_name() in self._translation_units:
+            self._translation_units.update_memory_usage(self._file_name())
+        else:
+            self._translation_units.add(self._file_name(), versions)
+        return versions
+
+    def _reparse_standby(self, versions):
+        handle = versions.take_standby()
+        if handle is None and self._profile.reparse_after_parse:
+            # There is none yet after a fresh parse, so it is created now.
+            handle = self._new_standby(versions.published().profile())
+        if not handle or handle.loaded_from_ast_cache or not handle.profile.serves(self._profile):
+            return False
+        with handle.lock:
+            handle.translation_unit.reparse(self._unsaved_files)
+            versions.publish(handle, self._content_hash, self._profile.reparse_after_parse, self._file[1])
+        return True
+
+    def _new_standby(self, profile):
+        tu = self._index.parse(self._file_name(), self._compile_arguments(self._file_name()),
+                               self._unsaved_files, profile.options)
+        return tu and TranslationUnitHandle(tu, profile)
+
+    def _read_new_translation_unit(self, versions):
+        flags = self._profile.options
+
+        args = self._compile_arguments(self._file_name())
+
+        tu = self._ast_cache and self._ast_cache.load(self._index, self._file, args, self._profile.name)
+        if tu:
+            handle = TranslationUnitHandle(tu, self._profile, loaded_from_ast_cache=True)
+            with handle.lock:
+                versions.publish(handle, self._content_hash, False, self._file[1])
+            return True
 
-        args = self._editor.user_options()
-        tu = self._index.parse(self._file_name(), args, [self._file], flags)
+        tu = self._index.parse(self._file_name(), args, self._unsaved_files, flags)
 
         if tu is None:
             self._editor.display_message("Cannot parse this source file. The following arguments "
                                          + "are used for clang: " + " ".join(args))
-            return None
+            return False
 
-        self._translation_units[self._file_name()] = tu
+        if self._profile.reparse_after_parse:
+            # Reparse to initialize the PCH cache even for auto completion
+            # This should be done by index.parse(), however it is not.
+            # So we need to reparse ourselves.
+            tu.reparse(self._unsaved_files)
 
-        # Reparse to initialize the PCH cache even for auto completion
-        # This should be done by index.parse(), however it is not.
-        # So we need to reparse ourselves.
-        tu.reparse([self._file])
-        return tu
+        handle = TranslationUnitHandle(tu, self._profile)
+        with handle.lock:
+            published = versions.publish(handle, self._content_hash, self._profile.reparse_after_parse, self._file[1])
+        if self._store_in_ast_cache:
+            self._store_in_ast_cache(published, self._file, args, self._profile.name)
+        return True
 
 
 class SynchronizedAccess(object):
@@ -70,77 +145,340 @@ class SynchronizedAccess(object):
         doer = self._synchronized_doer_for_key(key)
         return doer.do(action)
 
-    def synchronized_if_not_locked_do(self, key, action):
-        doer = self._synchronized_doer_for_key(key)
-        try:
-            return doer.do_if_not_locked(action)
-        except AlreadyLocked:
-            pass
+    def is_locked(self, key):
+        """Whether another thread is doing something for the key."""
+        return self._synchronized_doer_for_key(key).is_locked()
 
 
 class SynchronizedTranslationUnitParser(object):
-    def __init__(self, index, editor):
+    def __init__(self, index, editor, on_includes_updated=None):
         self._editor = editor
+        self._on_includes_updated = on_includes_updated
         self._index = index
-        self._translation_units = dict()
-        self._up_to_date = set()
+        self._translation_units = TranslationUnitCache(
+            editor.translation_unit_memory_budget(),
+            self._translation_unit_evicted)
+        self._file_states = FileStates()
+        self._up_to_date = {}
+        self._invalidated_at = {}
+        # Increased whenever it is unknown which files changed.
+        self._changes_lost = 0
+        self._include_graph = IncludeGraph()
+        self._ast_cache = AstCache(editor.ast_cache_directory(), editor.ast_cache_size_limit())
+        self._ast_cache_stores = Queue.Queue()
+        if self._ast_cache.enabled():
+            writer = threading.Thread(target=self._write_ast_cache, name="AST cache writer")
+            writer.daemon = True
+            writer.start()
+        self._symbol_index = SymbolIndex(editor.symbol_index_file())
+        self._unsaved_files = UnsavedFileRegistry()
+        self._modified_buffers = ModifiedBuffers()
+        if editor.use_compilation_database():
+            self._compilation_databases = CompilationDatabases()
+        else:
+            self._compilation_databases = None
         self._synchronized = SynchronizedAccess()
 
-    def translation_unit_do(self, file_name, get_content, function):
-        def do_it():
-            return self._call_if_not_null(function, self._parse((file_name, get_content())))
-        return self._synchronized.synchronized_do(file_name, do_it)
+    def translation_unit_do(self, file_name, get_content, function, profile=parse_profiles.INTERACTIVE, allow_stale=False):
+        """Call function with the translation unit of the file's contents.
+        Only one thread at a time builds a file's translation unit, readers
+        of an up to date one do not wait for it. If allow_stale, readers do
+        not wait for a build either, but use the last version built."""
+        return self._read_or_parse(file_name, self._translation_units.get(file_name),
+                                   get_content, function, profile, allow_stale)
+
+    def _read_or_parse(self, file_name, versions, get_content, function, profile, allow_stale):
+        contents = get_content()
+        if versions and (self.is_up_to_date(file_name, contents, profile) or (
+                allow_stale and self._synchronized.is_locked(file_name)
+                and self._serves(versions, profile))):
+            return versions.read(function)
 
-    def translation_unit_if_parsed_do(self, file, function):
         def do_it():
-            if self.is_up_to_date(file[0]):
-                return self._call_if_not_null(function, self._parse(file))
-
-        return self._synchronized.synchronized_if_not_locked_do(
-                file[0], do_it)
+            return self._parse((file_name, contents), profile)
+        versions = self._synchronized.synchronized_do(file_name, do_it)
+        if versions:
+            return versions.read(function)
+
+    def translation_unit_for_completion_do(self, file_name, get_content, function, profile=parse_profiles.INTERACTIVE):
+        """Like translation_unit_do, but any translation unit with a
+        precompiled preamble does, however old. Completing reparses with the
+        unsaved contents and reuses the preamble anyway, so reparsing first
+        would only delay completing. Only a file without one is parsed."""
+        versions = self._translation_units.get(file_name)
+        published = versions and versions.published()
+        if (published and published.profile().serves(profile) and published.profile().builds_preamble()
+                and not published.handle.loaded_from_ast_cache):
+            return versions.read(function)
+        return self._read_or_parse(file_name, versions, get_content, function, profile, allow_stale=True)
 
-    def _call_if_not_null(self, function, arg):
-        if arg:
-            return function(arg)
-
-    def _parse(self, file):
+    def translation_unit_if_parsed_do(self, file, function):
+        if self.is_up_to_date(file[0], file[1]):
+            versions = self._translation_units.get(file[0])
+            if versions:
+                return versions.read(function)
+
+    def parsed_contents(self, file_name, translation_unit):
+        """The contents of the file the translation unit, being read, was
+        built from. None if it is not the published version."""
+        versions = self._translation_units.peek(file_name)
+        published = versions and versions.published()
+        if published and published.translation_unit() is translation_unit:
+            return published.contents
+        return None
+
+    def _serves(self, versions, profile):
+        published = versions.published()
+        return published is not None and published.profile().serves(profile)
+
+    def _profile_of(self, file_name):
+        versions = self._translation_units.peek(file_name)
+        if versions:
+            published = versions.published()
+            if published:
+                return published.profile()
+        return parse_profiles.BACKGROUND
+
+    def _parse(self, file, profile):
         self._editor.display_message("[" + threading.currentThread(
-        ).name + " ] - Starting parse: " + file[0])
-
+        ).name + " ] - Starting %s parse: %s" % (profile, file[0]))
+
+        self._file_states.update(file[0], file[1])
+        digest = self._file_states.content_hash(file[0])
+        started_at = self._file_states.generation()
+        up_to_date = self._up_to_date
+        was_up_to_date = up_to_date.get(file[0]) == digest
+
+        # The AST cache only knows the files on disk, so translation units
+        # that may include modified buffers bypass it, and those of a
+        # modified buffer are not stored in it.
+        if self._modified_buffers.relevant_to(file[0], self._include_graph.includes_of(file[0])):
+            ast_cache = None
+        else:
+            ast_cache = self._ast_cache
+        if ast_cache and self._ast_cache.enabled() and self._modified_buffers.contents(file[0]) is None:
+            store_in_ast_cache = self._store_in_ast_cache
+        else:
+            store_in_ast_cache = None
         action = TranslationUnitParsingAction(self._editor, self._index,
-                self._translation_units, self._up_to_date, file)
+                self._compile_arguments, self._translation_units, was_up_to_date, ast_cache,
+                store_in_ast_cache, file, digest, self.unsaved_files(file), profile)
         result = action.parse()
+        published = result and result.published()
+        if not published or published.content_hash != digest:
+            # Parsing failed, readers get the last good version.
+            return result
+
+        if not was_up_to_date:
+            included_names = result.read(
+                lambda tu: [inclusion.include.name for inclusion in tu.get_includes()])
+            self._include_graph.update(file[0], included_names)
+            if self._on_includes_updated:
+                self._on_includes_updated(file[0], included_names)
+
+        # Something the translation unit depends on may have changed while
+        # parsing. It must then be parsed again on next use.
+        if self._invalidated_at.get(file[0], 0) <= started_at:
+            up_to_date[file[0]] = digest
         self._editor.display_message("[" + threading.currentThread(
         ).name + " ] - Finished parse: " + file[0])
         return result
 
+    def _store_in_ast_cache(self, snapshot, file, args, variant):
+        """Store the published translation unit on the AST cache writer's
+        thread, off the path of the parse waited for."""
+        self._ast_cache_stores.put((snapshot, file, args, variant))
+
+    def _write_ast_cache(self):
+        while True:
+            snapshot, file, args, variant = self._ast_cache_stores.get()
+            try:
+                with snapshot.handle.lock:
+                    # Skipped if the handle was rebuilt as standby meanwhile.
+                    if snapshot.handle.version == snapshot.version:
+                        self._ast_cache.store(snapshot.translation_unit(), file, args, variant)
+            finally:
+                self._ast_cache_stores.task_done()
+
+    def unsaved_files(self, file):
+        """The unsaved files to pass to libclang for the file: its own
+        contents and those of the modified buffers it includes."""
+        buffers = self._modified_buffers.relevant_to(file[0], self._include_graph.includes_of(file[0]))
+        # Completions may pass newer contents than those last parsed, or
+        # contents never parsed, e.g. with a member access pretended.
+        generation = (content_hash(file[1]),) + tuple(
+            (name, generation) for name, contents, generation in buffers)
+        return self._unsaved_files.unsaved_files(
+            file[0], [file] + [(name, contents) for name, contents, generation in buffers], generation)
+
+    def _compile_arguments(self, file_name):
+        user_options = list(self._editor.user_options())
+        if self._compilation_databases:
+            arguments = self._compilation_databases.arguments_for(file_name)
+            if arguments is not None:
+                return arguments + user_options
+        return user_options
+
+    def _translation_unit_evicted(self, file_name):
+        self._up_to_date.pop(file_name, None)
+        self._include_graph.remove(file_name)
+        self._unsaved_files.forget(file_name)
+        self._editor.display_message("Evicted translation unit: " + file_name)
+
     def clear_caches(self):
-        self._up_to_date = set()
+        self._up_to_date = {}
+
+    def file_changed(self, file):
+        """Only the translation units of the file itself and of files
+        including it become outdated, and only if its contents changed.
+        Returns the translation units including the file that became
+        outdated."""
+        if self._file_states.update(file[0], file[1]):
+            includers = self.includers_of(file[0])
+            self._invalidate(includers)
+            return includers
+        return set()
+
+    def files_changed_on_disk(self, file_names):
+        """Outdate the translation units of files changed outside the editor
+        and of all files including them in a single pass. Files whose
+        contents are those parsed already are skipped. None means that it is
+        unknown what changed, so everything is outdated. Returns the outdated
+        translation units."""
+        if file_names is None:
+            self._changes_lost += 1
+            affected = set(self._up_to_date)
+            for file_name in affected:
+                self._file_states.invalidate(file_name)
+            self._invalidate(affected)
+            return affected
+
+        affected = set()
+        compare = len(file_names) <= MAXIMUM_COMPARED_CHANGES
+        for file_name in file_names:
+            if compare and self._has_parsed_contents(file_name):
+                continue
+            self._file_states.invalidate(file_name)
+            affected.update(self.includers_of(file_name))
+            if self._include_graph.includes_of(file_name) is not None:
+                affected.add(file_name)
+        self._invalidate(affected)
+        return affected
+
+    def _has_parsed_contents(self, file_name):
+        parsed_content_hash = self._file_states.content_hash(file_name)
+        if parsed_content_hash is None:
+            return False
+        try:
+            return content_hash(get_file_for_file_name(file_name)[1]) == parsed_content_hash
+        except IOError:
+            return False
+
+    def buffer_modified(self, file):
+        self._modified_buffers.update(file[0], file[1])
+        return self.file_changed(file)
+
+    def buffer_unmodified(self, file_name):
+        """The buffer was saved or its changes were discarded. Returns the
+        translation units including the file that became outdated."""
+        self._modified_buffers.remove(file_name)
+        try:
+            return self.file_changed(get_file_for_file_name(file_name))
+        except IOError:
+            return self.files_changed_on_disk([file_name])
+
+    def modified_buffer_contents(self, file_name):
+        return self._modified_buffers.contents(file_name)
 
-    def is_up_to_date(self, file_name):
-        return file_name in self._up_to_date
+    def includers_of(self, file_name):
+        return self._include_graph.includers_of(file_name)
+
+    def includes_of(self, file_name):
+        return self._include_graph.includes_of(file_name)
+
+    def include_directories(self, file_name):
+        return include_directories(self._compile_arguments(file_name))
+
+    def symbol_index(self):
+        return self._symbol_index
+
+    def index_symbols(self, translation_unit, file_name):
+        self._symbol_index.index_translation_unit(translation_unit, file_name)
+
+    def dependency_generations(self, file_name, include_self=False):
+        """The generations of the files the file's translation unit includes,
+        and of the file itself if include_self, to tell later whether
+        anything derived from them is still valid. None if its includes are
+        unknown."""
+        included_names = self._include_graph.includes_of(file_name)
+        if included_names is None:
+            return None
+        file_names = set(included_names)
+        if include_self:
+            file_names.add(file_name)
+        return (self._changes_lost,
+                dict((name, self._file_states.generation(name)) for name in file_names))
+
+    def dependencies_unchanged(self, dependencies):
+        changes_lost, generations = dependencies
+        return changes_lost == self._changes_lost and all(
+            self._file_states.generation(name) == generation for name, generation in generations.iteritems())
+
+    def _invalidate(self, file_names):
+        generation = self._file_states.generation()
+        for file_name in file_names:
+            self._invalidated_at[file_name] = generation
+            self._up_to_date.pop(file_name, None)
+
+    def is_up_to_date(self, file_name, contents=None, profile=None):
+        """Whether the file is parsed with the given contents, and with a
+        profile serving the given one."""
+        parsed_content_hash = self._up_to_date.get(file_name)
+        if parsed_content_hash is None:
+            return False
+        if profile and not self._profile_of(file_name).serves(profile):
+            return False
+        if contents is None:
+            return parsed_content_hash == self._file_states.content_hash(file_name)
+        return parsed_content_hash == content_hash(contents)
+
+    def set_visible_files(self, file_names):
+        self._translation_units.pin(file_names)
+
+    def is_over_memory_budget(self):
+        return self._translation_units.memory_usage() > self._translation_units.memory_budget()
+
+    def translation_unit_cache_statistics(self):
+        return self._translation_units.statistics()
 
 
 class IdleTranslationUnitParserThreadDistributor():
     def __init__(self, editor, translation_unit_parser):
         self._editor = editor
-        self._remaining_files = Queue.PriorityQueue()
+        self._remaining_files = IndexedPriorityQueue()
         self._file_contents = {}
+        self._file_profiles = {}
         self._parser = translation_unit_parser
+        maximum_threads = editor.maximum_parser_threads() or number_of_cores()
+        self._scheduler = ParserThreadScheduler(
+            editor.minimum_parser_threads(), maximum_threads, translation_unit_parser.is_over_memory_budget)
         self._threads = [IdleTranslationUnitParserThread(self._editor,
-            translation_unit_parser, self._remaining_files, self._file_contents, self.enqueue_file)
-            for i in range(1, 8)]
+            translation_unit_parser, self._remaining_files, self._file_contents, self.contents_of,
+            self._file_profiles, self.enqueue_file, self._scheduler, i)
+            for i in range(self._scheduler.number_of_threads())]
 
     def terminate(self):
         for thread in self._threads:
             thread.terminate()
+        self._scheduler.terminate()
         # Only start waking up threads after all threads know they must
-        # terminate on notification
+        # terminate on notification. Keys must be unique to wake up every
+        # thread.
         for thread in self._threads:
-            self._remaining_files.put((-1, None))
+            self._remaining_files.put(object(), -1)
 
-    def enqueue_file(self, file, high_priority=True):
-        if self._parser.is_up_to_date(file[0]):
+    def enqueue_file(self, file, high_priority=True, profile=parse_profiles.BACKGROUND):
+        if self._parser.is_up_to_date(file[0], file[1], profile):
             return
 
         if high_priority:
@@ -148,31 +486,85 @@ class IdleTranslationUnitParserThreadDistributor():
         else:
             priority = 1
         self._file_contents[file[0]] = file[1]
-        if (priority, file[0]) not in self._remaining_files.queue:
-            self._remaining_files.put((priority, file[0]))
+        queued_profile = self._file_profiles.get(file[0])
+        if not queued_profile or not queued_profile.serves(profile):
+            self._file_profiles[file[0]] = profile
+        self._remaining_files.put(file[0], priority)
+
+    def user_active(self):
+        self._scheduler.user_active()
+
+    def utilization(self):
+        return self._scheduler.utilization()
+
+    def remember_file_contents(self, file):
+        """Make the file be parsed with the given contents the next time it
+        is enqueued by name."""
+        self._file_contents[file[0]] = file[1]
+
+    def forget_file_contents(self, file_names):
+        """Make files be read from disk again the next time they are
+        enqueued by name or taken from the queue."""
+        for file_name in file_names:
+            self._file_contents.pop(file_name, None)
+
+    def contents_of(self, file_name):
+        """The contents the file was last enqueued with, or else those of its
+        modified buffer, or else its contents on disk. Raises IOError if it
+        cannot be read."""
+        try:
+            return self._file_contents[file_name]
+        except KeyError:
+            pass
+        contents = self._parser.modified_buffer_contents(file_name)
+        if contents is not None:
+            return contents
+        return get_file_for_file_name(file_name)[1]
+
+    def enqueue_file_named(self, file_name, high_priority, profile=parse_profiles.BACKGROUND):
+        """Enqueue a file using the contents it was last enqueued with, or else
+        its contents on disk."""
+        try:
+            file = (file_name, self.contents_of(file_name))
+        except IOError:
+            return
+        self.enqueue_file(file, high_priority, profile)
 
 
 class IdleTranslationUnitParserThread(object):
-    def __init__(self, editor, translation_unit_parser, _remaining_files, file_contents, enqueue_in_any_thread):
+    def __init__(self, editor, translation_unit_parser, _remaining_files, file_contents, contents_of, file_profiles, enqueue_in_any_thread, scheduler, index):
         self._editor = editor
         self._parser = translation_unit_parser
         self._enqueue_in_any_thread = enqueue_in_any_thread
         self._file_contents = file_contents
-        self._worker = Worker(self._process, _remaining_files)
+        self._contents_of = contents_of
+        self._file_profiles = file_profiles
+        self._scheduler = scheduler
+        self._index = index
+        self._worker = Worker(self._process, _remaining_files,
+                              lambda: scheduler.wait_until_allowed(index))
 
     def _process(self, priority_and_file_name):
         if not priority_and_file_name:
             traceback.print_stack()
         ignored_priority, file_name = priority_and_file_name
+        profile = self._file_profiles.pop(file_name, parse_profiles.BACKGROUND)
+        self._scheduler.started_parsing(self._index)
         try:
+            # The contents are looked up only now, those remembered when the
+            # file was enqueued may have been forgotten since.
             def get_contents():
-                return self._file_contents[file_name]
-            self._parser.translation_unit_do(file_name, get_contents, lambda tu: tu)
+                return self._contents_of(file_name)
+            # Index the headers while the translation unit is at hand.
+            self._parser.translation_unit_do(
+                file_name, get_contents, lambda tu: self._parser.index_symbols(tu, file_name), profile)
             self._enqueue_definition_files(file_name)
         except Exception, e:
+            # A file that cannot be parsed must not stop the thread.
             self._editor.display_message(
                 "Exception thrown in idle thread: " + str(e))
-            raise e
+        finally:
+            self._scheduler.finished_parsing(self._index)
 
     def terminate(self):
         self._worker.terminate()
@@ -182,7 +574,7 @@ class IdleTranslationUnitParserThread(object):
         files with file-system files."""
         if not file_name in self._file_contents:
             self._enqueue_in_any_thread(get_file_for_file_name(
-                file_name), high_priority=False)
+                file_name), high_priority=False, profile=parse_profiles.BACKGROUND)
 
     def _enqueue_definition_files(self, file_name):
         finder = DefinitionFileFinder(self._editor.excluded_directories(
@@ -191,10 +583,6 @@ class IdleTranslationUnitParserThread(object):
             self._enqueue_if_new(file_name)
 
 
-class AlreadyLocked(Exception):
-    pass
-
-
 class SynchronizedDoer(object):
     def __init__(self):
         self._lock = threading.RLock()
@@ -206,15 +594,6 @@ class SynchronizedDoer(object):
         finally:
             self._lock.release()
 
-    def do_if_not_locked(self, action):
-        if self._lock.acquire(blocking=0):
-            try:
-                return action()
-            finally:
-                self._lock.release()
-        else:
-            raise AlreadyLocked()
-
     def is_locked(self):
         if self._lock.acquire(blocking=0):
             try:
@@ -228,36 +607,140 @@ class SynchronizedDoer(object):
 class TranslationUnitAccessor(object):
     def __init__(self, editor):
         self._editor = editor
-        self._parser = SynchronizedTranslationUnitParser(clang.cindex.Index.create(), self._editor)
+        if editor.watch_files():
+            self._file_watcher = make_file_watcher(self._files_changed_on_disk)
+            on_includes_updated = self._watch_translation_unit
+        else:
+            self._file_watcher = None
+            on_includes_updated = None
+        self._parser = SynchronizedTranslationUnitParser(clang.cindex.Index.create(), self._editor, on_includes_updated)
         self._idle_translation_unit_parser_thread_distributor = IdleTranslationUnitParserThreadDistributor(self._editor, self._parser)
+        self._visible_files = frozenset()
 
     def terminate(self):
+        if self._file_watcher:
+            self._file_watcher.terminate()
         self._idle_translation_unit_parser_thread_distributor.terminate()
-
-    def current_translation_unit_do(self, function):
+        self._parser.symbol_index().save_if_changed()
+
+    def _watch_translation_unit(self, file_name, included_names):
+        self._file_watcher.watch_files([file_name] + included_names)
+
+    def _files_changed_on_disk(self, file_names):
+        """Called from the watcher's thread with a whole burst of changes.
+        Only the visible translation units are reparsed right away, all
+        others are reparsed when they are used next."""
+        if file_names is None:
+            self._editor.display_message("Lost track of file changes, outdating all translation units.")
+        affected = self._parser.files_changed_on_disk(file_names)
+        distributor = self._idle_translation_unit_parser_thread_distributor
+        forgotten = set(affected)
+        if file_names is not None:
+            forgotten.update(file_names)
+        # What is parsed of a modified buffer stays its unsaved contents.
+        distributor.forget_file_contents([file_name for file_name in forgotten
+                                          if self._parser.modified_buffer_contents(file_name) is None])
+        for file_name in affected:
+            if file_name in self._visible_files:
+                distributor.enqueue_file_named(file_name, high_priority=True, profile=parse_profiles.DIAGNOSTICS)
+
+    def current_translation_unit_do(self, function, allow_stale=False):
         current_file = self._editor.current_file()
-        return self.translation_unit_do(current_file, function)
+        return self.translation_unit_do(current_file, function, parse_profiles.INTERACTIVE, allow_stale)
 
     def current_translation_unit_if_parsed_do(self, function):
         current_file = self._editor.current_file()
         return self._parser.translation_unit_if_parsed_do(current_file, function)
 
-    def translation_unit_for_file_named_do(self, file_name, function):
+    def translation_unit_for_file_named_do(self, file_name, function, profile=parse_profiles.INTERACTIVE):
         try:
             file = get_file_for_file_name(file_name)
-            return self.translation_unit_do(file, function)
+            return self.translation_unit_do(file, function, profile)
         except IOError:
             return None
 
     def clear_caches(self):
         self._parser.clear_caches()
 
-    def enqueue_translation_unit_creation(self, file):
+    def file_changed(self, file):
+        """Reparse the translation units that include the changed file, those
+        visible in the editor first."""
+        self._enqueue_includers(self._parser.file_changed(file))
+
+    def modified_buffers_changed(self, changed_files, unmodified_file_names):
+        """Every parse and completion passes the contents of the modified
+        buffers the file includes. changed_files are buffers with new
+        unsaved changes, unmodified_file_names those saved or reverted."""
+        distributor = self._idle_translation_unit_parser_thread_distributor
+        for file in changed_files:
+            distributor.remember_file_contents(file)
+            self._enqueue_includers(self._parser.buffer_modified(file))
+        for file_name in unmodified_file_names:
+            includers = self._parser.buffer_unmodified(file_name)
+            distributor.forget_file_contents([file_name])
+            self._enqueue_includers(includers)
+
+    def _enqueue_includers(self, includers):
+        visible = [file_name for file_name in includers if file_name in self._visible_files]
+        invisible = [file_name for file_name in includers if file_name not in self._visible_files]
+        for file_name in visible:
+            self._idle_translation_unit_parser_thread_distributor.enqueue_file_named(
+                file_name, high_priority=True, profile=parse_profiles.DIAGNOSTICS)
+        for file_name in invisible:
+            self._idle_translation_unit_parser_thread_distributor.enqueue_file_named(
+                file_name, high_priority=False, profile=parse_profiles.BACKGROUND)
+
+    def includers_of(self, file_name):
+        return self._parser.includers_of(file_name)
+
+    def includes_of(self, file_name):
+        """The files the file's translation unit includes, None if unknown."""
+        return self._parser.includes_of(file_name)
+
+    def include_directories(self, file_name):
+        return self._parser.include_directories(file_name)
+
+    def symbol_index(self):
+        return self._parser.symbol_index()
+
+    def dependency_generations(self, file_name, include_self=False):
+        return self._parser.dependency_generations(file_name, include_self)
+
+    def dependencies_unchanged(self, dependencies):
+        return self._parser.dependencies_unchanged(dependencies)
+
+    def visible_files_changed(self, file_names):
+        self._visible_files = frozenset(file_names)
+        self._parser.set_visible_files(file_names)
+
+    def translation_unit_cache_statistics(self):
+        return self._parser.translation_unit_cache_statistics()
+
+    def user_active(self):
+        """Parse in the background with fewer threads for a while."""
+        self._idle_translation_unit_parser_thread_distributor.user_active()
+
+    def parser_thread_utilization(self):
+        return self._idle_translation_unit_parser_thread_distributor.utilization()
+
+    def enqueue_translation_unit_creation(self, file, profile=parse_profiles.INTERACTIVE):
+        """Parse a file the user opened in the background."""
         self._idle_translation_unit_parser_thread_distributor.enqueue_file(
-            file)
+            file, high_priority=True, profile=profile)
+
+    def translation_unit_do(self, file, function, profile=parse_profiles.INTERACTIVE, allow_stale=False):
+        """If allow_stale, function may be called with the last version of
+        the translation unit built while a newer one is being built."""
+        return self._parser.translation_unit_do(file[0], lambda: file[1], function, profile, allow_stale)
+
+    def translation_unit_for_completion_do(self, file, function, profile=parse_profiles.INTERACTIVE):
+        return self._parser.translation_unit_for_completion_do(file[0], lambda: file[1], function, profile)
+
+    def unsaved_files(self, file):
+        return self._parser.unsaved_files(file)
 
-    def translation_unit_do(self, file, function):
-        return self._parser.translation_unit_do(file[0], lambda: file[1], function)
+    def parsed_contents(self, file_name, translation_unit):
+        return self._parser.parsed_contents(file_name, translation_unit)
 
 
 def get_file_for_file_name(file_name):
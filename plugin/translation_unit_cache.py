@@ -0,0 +1,115 @@
+import collections
+import threading
+
+
+class TranslationUnitCache(object):
+    """
+    Holds parsed translation units in least recently used order. Whenever the
+    memory libclang reports for all cached translation units exceeds the
+    budget, the least recently used ones are evicted. Translation units of
+    pinned files (the files visible in the editor) are never evicted, neither
+    is the most recently used one.
+    """
+
+    def __init__(self, memory_budget, on_evict=None):
+        self._memory_budget = memory_budget
+        self._on_evict = on_evict
+        self._translation_units = collections.OrderedDict()
+        self._memory_usages = {}
+        self._pinned = frozenset()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __contains__(self, file_name):
+        with self._lock:
+            return file_name in self._translation_units
+
+    def get(self, file_name):
+        with self._lock:
+            try:
+                translation_unit = self._translation_units.pop(file_name)
+            except KeyError:
+                self._misses += 1
+                return None
+            self._translation_units[file_name] = translation_unit
+            self._hits += 1
+            return translation_unit
+
+    def peek(self, file_name):
+        """Like get, but neither counted nor marking it as recently used."""
+        with self._lock:
+            return self._translation_units.get(file_name)
+
+    def add(self, file_name, translation_unit):
+        memory_usage = translation_unit.memory_usage
+        with self._lock:
+            self._translation_units.pop(file_name, None)
+            self._translation_units[file_name] = translation_unit
+            self._memory_usages[file_name] = memory_usage
+            evicted = self._evict()
+        self._notify_evicted(evicted)
+
+    def update_memory_usage(self, file_name):
+        """Measure the translation unit again, e.g. after it was reparsed."""
+        with self._lock:
+            translation_unit = self._translation_units.get(file_name)
+        if translation_unit is None:
+            return
+        memory_usage = translation_unit.memory_usage
+        with self._lock:
+            if file_name not in self._translation_units:
+                return
+            self._memory_usages[file_name] = memory_usage
+            evicted = self._evict()
+        self._notify_evicted(evicted)
+
+    def remove(self, file_name):
+        with self._lock:
+            self._translation_units.pop(file_name, None)
+            self._memory_usages.pop(file_name, None)
+
+    def pin(self, file_names):
+        """Replace the set of files whose translation units must be kept."""
+        with self._lock:
+            self._pinned = frozenset(file_names)
+            evicted = self._evict()
+        self._notify_evicted(evicted)
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(self._memory_usages.values())
+
+    def memory_budget(self):
+        return self._memory_budget
+
+    def statistics(self):
+        with self._lock:
+            return dict({'hits': self._hits,
+                         'misses': self._misses,
+                         'evictions': self._evictions,
+                         'translation_units': len(self._translation_units),
+                         'memory_usage': sum(self._memory_usages.values()),
+                         'memory_budget': self._memory_budget})
+
+    def _evict(self):
+        "Must be called with the lock held."
+        memory_usage = sum(self._memory_usages.values())
+        evicted = []
+        least_recently_used_first = list(self._translation_units)[:-1]
+        for file_name in least_recently_used_first:
+            if memory_usage <= self._memory_budget:
+                break
+            if file_name in self._pinned:
+                continue
+            del self._translation_units[file_name]
+            memory_usage -= self._memory_usages.pop(file_name)
+            self._evictions += 1
+            evicted.append(file_name)
+        return evicted
+
+    def _notify_evicted(self, file_names):
+        if self._on_evict:
+            for file_name in file_names:
+                self._on_evict(file_name)
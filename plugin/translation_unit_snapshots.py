@@ -0,0 +1,101 @@
+import threading
+
+
+class TranslationUnitHandle(object):
+    """
+    One libclang translation unit. libclang does not allow using a
+    translation unit from several threads at once, so readers and the
+    writer reparsing it hold its lock.
+    """
+
+    def __init__(self, translation_unit, profile, loaded_from_ast_cache=False):
+        self.translation_unit = translation_unit
+        self.profile = profile
+        # Translation units loaded from an AST file cannot be reparsed.
+        self.loaded_from_ast_cache = loaded_from_ast_cache
+        self.lock = threading.RLock()
+        # The version of the file the translation unit was last built from.
+        self.version = None
+        self.memory_usage = 0
+
+
+class TranslationUnitSnapshot(object):
+    """A version of a file's translation unit as published to readers."""
+
+    def __init__(self, handle, version, content_hash, contents=None):
+        self.handle = handle
+        self.version = version
+        self.content_hash = content_hash
+        # The contents of the file it was built from, None if unknown.
+        self.contents = contents
+
+    def translation_unit(self):
+        return self.handle.translation_unit
+
+    def profile(self):
+        return self.handle.profile
+
+
+class DoubleBufferedTranslationUnit(object):
+    """
+    The translation unit of a file, kept as two handles. Readers use the
+    published snapshot, the last good version, while the next version is
+    built on the standby handle. Publishing swaps the handles atomically, so
+    readers never wait for a reparse, only for other readers of the same
+    handle.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._published = None
+        self._standby = None
+        self._version = 0
+
+    def published(self):
+        with self._lock:
+            return self._published
+
+    def take_standby(self):
+        """The handle to build the next version on, None if there is none.
+        It is no longer standby until published."""
+        with self._lock:
+            standby = self._standby
+            self._standby = None
+            return standby
+
+    def publish(self, handle, content_hash, keep_previous, contents=None):
+        """Make the handle the published snapshot. The caller must hold the
+        handle's lock. The previously published handle becomes standby if
+        keep_previous, otherwise it is released once its readers are done."""
+        handle.memory_usage = handle.translation_unit.memory_usage
+        with self._lock:
+            self._version += 1
+            handle.version = self._version
+            previous = self._published
+            self._published = TranslationUnitSnapshot(handle, self._version, content_hash, contents)
+            if (keep_previous and previous and previous.handle is not handle
+                    and not previous.handle.loaded_from_ast_cache
+                    and previous.handle.profile.serves(handle.profile)):
+                self._standby = previous.handle
+            return self._published
+
+    def read(self, function):
+        """Call function with the translation unit of the latest published
+        snapshot. Returns None if nothing is published yet."""
+        while True:
+            snapshot = self.published()
+            if snapshot is None:
+                return None
+            with snapshot.handle.lock:
+                # The handle may have become standby and been rebuilt while
+                # waiting for its lock.
+                if snapshot.handle.version == snapshot.version:
+                    return function(snapshot.translation_unit())
+
+    @property
+    def memory_usage(self):
+        """As measured when the handles were published, so measuring does not
+        wait for readers."""
+        with self._lock:
+            handles = [self._published and self._published.handle, self._standby]
+            return sum(handle.memory_usage for handle in handles if handle)
@@ -0,0 +1,72 @@
+import threading
+from clang.cindex import UnsavedFiles
+from common import normalized_file_name
+
+
+class UnsavedFileRegistry(object):
+    """
+    Keeps the unsaved files handed to libclang for every file the parser
+    has seen. They are replaced only when their generation changes, so
+    parsing, reparsing and completing unchanged contents reuse the same
+    ctypes array instead of copying the buffers each time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def unsaved_files(self, file_name, files, generation):
+        """The unsaved files for parsing the given file. files is a list of
+        pairs of file name and contents, which is only looked at if the
+        generation differs from the previous one."""
+        with self._lock:
+            entry = self._entries.get(file_name)
+            if entry is None or generation is None or entry[0] != generation:
+                # A new instance, as the previous one may still be in use.
+                entry = (generation, UnsavedFiles(files))
+                self._entries[file_name] = entry
+            return entry[1]
+
+    def forget(self, file_name):
+        with self._lock:
+            self._entries.pop(file_name, None)
+
+
+class ModifiedBuffers(object):
+    """
+    Contents of the editor buffers with unsaved changes, by normalized file
+    name. Each contents is numbered, so unsaved files built from them can
+    tell whether they are still current.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._buffers = {}
+
+    def update(self, file_name, contents):
+        with self._lock:
+            self._generation += 1
+            self._buffers[normalized_file_name(file_name)] = (contents, self._generation)
+
+    def remove(self, file_name):
+        with self._lock:
+            self._buffers.pop(normalized_file_name(file_name), None)
+
+    def contents(self, file_name):
+        """The unsaved contents of the file's buffer, None if it has none."""
+        with self._lock:
+            entry = self._buffers.get(normalized_file_name(file_name))
+            return entry and entry[0]
+
+    def relevant_to(self, file_name, included_file_names):
+        """Tuples of file name, contents and generation of the buffers the
+        given file includes. All buffers are relevant while its includes are
+        unknown."""
+        file_name = normalized_file_name(file_name)
+        with self._lock:
+            if included_file_names is None:
+                names = self._buffers.keys()
+            else:
+                names = [name for name in included_file_names if name in self._buffers]
+            return [(name,) + self._buffers[name] for name in sorted(names) if name != file_name]
@@ -59,6 +59,14 @@ class VimInterface(object):
             self._check_thread("current")
             return self._vim.current
 
+        def function(self, name):
+            """The Vim function to call with Python values, None if this Vim
+            cannot pass them without converting them to strings."""
+            self._check_thread("function(%s)" % name)
+            if not hasattr(self._vim, 'Function'):
+                return None
+            return self._vim.Function(name)
+
     def __init__(self):
         self._vim = self.LoggingVim(self)
         self._id_to_highlight_group = {
@@ -79,6 +87,7 @@ class VimInterface(object):
                                        "b:clang_parameters",
                                        "g:clang_excluded_directories"]
         self._cached_variables = {}
+        self._buffer_contents = {}
         self.refresh_variables()
         self.init_highlight_groups()
 
@@ -92,7 +101,28 @@ class VimInterface(object):
             self._cached_variables[variable_name] = self._get_uncached_variable(variable_name)
 
     def changedtick(self):
-        return self._vim.eval("b:changedtick")
+        return int(self._vim.eval("b:changedtick"))
+
+    def modified_buffers(self):
+        """Tuples of file name, changedtick and contents of the buffers with
+        unsaved changes. A buffer's lines are only read again after its
+        changedtick changed."""
+        buffers = self._vim.eval(
+            "map(filter(range(1, bufnr('$')), 'bufloaded(v:val) && getbufvar(v:val, \"&modified\") && bufname(v:val) != \"\"'), "
+            "'[v:val, fnamemodify(bufname(v:val), \":p\"), getbufvar(v:val, \"changedtick\")]')")
+        buffer_contents = {}
+        result = []
+        for number, file_name, changedtick in buffers:
+            changedtick = int(changedtick)
+            cached = self._buffer_contents.get(number)
+            if cached and cached[0] == changedtick:
+                contents = cached[1]
+            else:
+                contents = "\n".join(self._vim.eval("getbufline(%s, 1, '$')" % number))
+            buffer_contents[number] = (changedtick, contents)
+            result.append((file_name, changedtick, contents))
+        self._buffer_contents = buffer_contents
+        return result
 
     # Get a tuple (file_name, filecontent) for the file opened in the current
     # vim buffer. The filecontent contains the unsafed buffer content.
@@ -143,12 +173,54 @@ class VimInterface(object):
             self._get_variable("b:clang_parameters"))
         return user_options_global + user_options_local + parameters_local
 
+    def translation_unit_memory_budget(self):
+        megabytes = self._get_uncached_variable("g:clang_translation_unit_memory_budget", 2048)
+        return int(megabytes) * 1024 * 1024
+
+    def use_compilation_database(self):
+        return int(self._get_uncached_variable("g:clang_use_compilation_database", 1))
+
+    def ast_cache_directory(self):
+        return self._get_uncached_variable("g:clang_ast_cache_directory")
+
+    def ast_cache_size_limit(self):
+        megabytes = self._get_uncached_variable("g:clang_ast_cache_size", 4096)
+        return int(megabytes) * 1024 * 1024
+
+    def symbol_index_file(self):
+        return self._get_uncached_variable("g:clang_symbol_index_file")
+
+    def watch_files(self):
+        return int(self._get_uncached_variable("g:clang_watch_files", 1))
+
+    def minimum_parser_threads(self):
+        return int(self._get_uncached_variable("g:clang_min_parser_threads", 1))
+
+    def maximum_parser_threads(self):
+        return int(self._get_uncached_variable("g:clang_max_parser_threads", 0))
+
+    def worker_processes(self):
+        return int(self._get_uncached_variable("g:clang_worker_processes", 0))
+
+    def worker_python(self):
+        return self._get_uncached_variable("g:clang_worker_python", "python")
+
+    def completion_limit(self):
+        return int(self._get_uncached_variable("g:clang_completion_limit", 50))
+
+    def completion_timeout(self):
+        return float(self._get_uncached_variable("g:clang_completion_timeout", 0))
+
     def excluded_directories(self):
         return self._split_options(self._get_variable("g:clang_excluded_directories"))
 
     def file_name(self):
         return self._vim.current().buffer.name
 
+    def visible_file_names(self):
+        return self._vim.eval(
+            "map(filter(range(1, bufnr('$')), 'bufwinnr(v:val) != -1'), 'fnamemodify(bufname(v:val), \":p\")')")
+
     def open_location(self, location):
         self.open_file(location.file.name, location.line, location.column)
 
@@ -247,6 +319,33 @@ class VimInterface(object):
     def _quick_fix_list_to_str(self, quick_fix_list):
         return '[' + ','.join(map(self._python_dict_to_vim_dict, quick_fix_list)) + ']'
 
+    def add_completions(self, completions):
+        """Add the completions to the popup menu. Returns whether the user
+        typed meanwhile, so the rest is not needed."""
+        add = self._vim.function("CalledFromPythonClangAddCompletions")
+        if add:
+            stop = add(completions)
+        else:
+            stop = self._vim.eval("CalledFromPythonClangAddCompletions(" + str(completions) + ")")
+        return 0 != int(stop)
+
+    def insert_include(self, directive):
+        """Insert the #include directive after the last one of the current
+        buffer, unless it is there already."""
+        buffer = self._vim.current().buffer
+        last = -1
+        for number, line in enumerate(buffer):
+            stripped = line.strip()
+            if stripped == directive:
+                return
+            if stripped.startswith("#include") or stripped.startswith("# include"):
+                last = number
+        buffer.append(directive, last + 1)
+
+    def show_completion_documentation(self, documentation):
+        escaped = documentation.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        self._vim.command('call g:CalledFromPythonClangShowDocumentation("' + escaped + '")')
+
     def display_diagnostics(self, quick_fix_list):
         self._vim.command("call g:CalledFromPythonClangDisplayQuickFix(" +
                           self._quick_fix_list_to_str(quick_fix_list) + ")")
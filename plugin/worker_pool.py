@@ -0,0 +1,283 @@
+import cPickle as pickle
+import itertools
+import os
+import subprocess
+import threading
+import time
+import zlib
+from parser_scheduling import number_of_cores
+
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clang_worker.py")
+
+# Seconds to wait for the response to a request before giving up on it. The
+# documentation of a highlighted completion is waited for by the editor.
+REQUEST_TIMEOUTS = dict({'complete': 10.0,
+                         'completion_documentation': 1.0,
+                         'definition_location': 10.0,
+                         'analyze': 120.0})
+
+# Seconds to wait before restarting a crashed worker, doubled with every
+# crash in a row, and the number of crashes in a row after which the worker
+# is given up on.
+FIRST_RESTART_DELAY = 0.5
+MAXIMUM_RESTART_DELAY = 30.0
+MAXIMUM_CRASHES = 6
+
+
+class WorkerPool(object):
+    """
+    Parses and analyzes files in separate processes, each owning its own
+    index and translation units. A file is always handled by the same
+    process, so its translation unit is only parsed once. A crashing process
+    is restarted; the request it was working on yields None. Once a process
+    keeps crashing, e.g. because the worker's Python cannot run it, the pool
+    is no longer alive and files must be parsed in the editor's process.
+    """
+
+    def __init__(self, editor, number_of_processes, library_path):
+        configuration = dict({
+            'library_path': library_path,
+            'translation_unit_memory_budget': editor.translation_unit_memory_budget() / number_of_processes,
+            'use_compilation_database': editor.use_compilation_database(),
+            'ast_cache_directory': editor.ast_cache_directory(),
+            'ast_cache_size_limit': editor.ast_cache_size_limit(),
+            'symbol_index_file': editor.symbol_index_file(),
+            'watch_files': editor.watch_files(),
+            'excluded_directories': editor.excluded_directories(),
+            'maximum_parser_threads': max(1, (editor.maximum_parser_threads() or number_of_cores()) / number_of_processes),
+            'debug': editor.debug_enabled()})
+        self._editor = editor
+        self._processes = [
+            WorkerProcess(editor.worker_python(), dict(configuration, worker_id=i), editor.display_message)
+            for i in range(number_of_processes)]
+
+    def terminate(self):
+        for process in self._processes:
+            process.terminate()
+
+    def alive(self):
+        return not any(process.given_up() for process in self._processes)
+
+    def _process_for(self, file_name):
+        return self._processes[(zlib.crc32(file_name) & 0xffffffff) % len(self._processes)]
+
+    def _broadcast(self, kind, *args):
+        for process in self._processes:
+            process.notify(kind, *args)
+
+    def enqueue_parse(self, file):
+        "Parse in the background of the responsible process."
+        self._process_for(file[0]).notify('parse', file, self._user_options())
+
+    def file_changed(self, file):
+        """Every process must know about the change, as any of them may have
+        parsed a translation unit including the file."""
+        self._broadcast('file_changed', file)
+
+    def modified_buffers_changed(self, changed_files, unmodified_file_names):
+        self._broadcast('modified_buffers_changed', changed_files, unmodified_file_names)
+
+    def visible_files_changed(self, file_names):
+        self._broadcast('visible_files_changed', list(file_names))
+
+    def complete(self, file, line, column, complete_flags, base, inserted=""):
+        """Returns the entries of Completer.complete of the completions
+        starting with base."""
+        return self._process_for(file[0]).request(
+            'complete', file, self._user_options(), line, column, complete_flags, base, inserted)
+
+    def completion_documentation(self, file, line, column, abbreviation):
+        return self._process_for(file[0]).request(
+            'completion_documentation', file, self._user_options(), line, column, abbreviation)
+
+    def analyze(self, file):
+        """Returns the quick fix list and the interesting ranges of a file."""
+        return self._process_for(file[0]).request('analyze', file, self._user_options())
+
+    def definition_location(self, file, location):
+        return self._process_for(file[0]).request(
+            'definition_location', file, self._user_options(), location)
+
+    def _user_options(self):
+        return list(self._editor.user_options())
+
+
+class Response(object):
+    """The response to a request, set by the thread reading responses."""
+
+    def __init__(self, process):
+        self.process = process
+        self.result = None
+        self._done = threading.Event()
+
+    def set(self, result):
+        self.result = result
+        self._done.set()
+
+    def wait(self, timeout):
+        return self._done.wait(timeout)
+
+
+class WorkerProcess(object):
+    """
+    Talks to a process running clang_worker.py. Messages are pickled tuples
+    of kind, arguments and the id of the request, None for notifications,
+    which are not answered. Responses are pairs of request id and result,
+    read on a thread of their own, as the worker answers requests
+    concurrently and not necessarily in order. A request yields None if the
+    worker crashes or does not respond within the request's timeout.
+
+    A crashed worker is restarted after a delay growing with every crash
+    before it answered anything, and given up on after MAXIMUM_CRASHES.
+    """
+
+    def __init__(self, python_executable, configuration, display_message):
+        self._python_executable = python_executable
+        self._configuration = configuration
+        self._display_message = display_message
+        self._write_lock = threading.Lock()
+        self._restart_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = {}
+        self._request_ids = itertools.count()
+        self._alive = True
+        self._given_up = False
+        self._restarts = 0
+        self._crashes = 0
+        self._process = None
+        try:
+            self._start()
+        except (IOError, OSError), e:
+            self._display_message("Cannot start clang worker: " + str(e))
+            self._given_up = True
+
+    def _start(self):
+        with open(os.devnull, "w") as devnull:
+            process = subprocess.Popen(
+                [self._python_executable, WORKER_SCRIPT],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull,
+                close_fds=True)
+        try:
+            self._send(process, self._configuration)
+        except IOError:
+            _kill(process)
+            raise
+        self._process = process
+        reader = threading.Thread(target=self._read_responses, args=(process,),
+                                  name="Clang worker %d responses" % self._configuration['worker_id'])
+        reader.daemon = True
+        reader.start()
+
+    def _read_responses(self, process):
+        while True:
+            try:
+                request_id, result = pickle.load(process.stdout)
+            except (EOFError, IOError, ValueError, pickle.UnpicklingError):
+                break
+            self._crashes = 0
+            with self._pending_lock:
+                response = self._pending.pop(request_id, None)
+            if response:
+                response.set(result)
+
+        # The requests the process did not answer yield None.
+        with self._pending_lock:
+            failed = [request_id for request_id, response in self._pending.iteritems()
+                      if response.process is process]
+            responses = [self._pending.pop(request_id) for request_id in failed]
+        for response in responses:
+            response.set(None)
+        self._restart(process)
+
+    def _restart(self, failed_process):
+        """Called on the failed process's thread reading responses, which
+        waits for the delay before starting the new process."""
+        with self._restart_lock:
+            if not self._alive or self._process is not failed_process:
+                return
+            self._display_message("Clang worker %d exited with %r" % (
+                self._configuration['worker_id'], failed_process.poll()))
+            _kill(failed_process)
+        while True:
+            with self._restart_lock:
+                if not self._alive:
+                    return
+                self._crashes += 1
+                if self._crashes > MAXIMUM_CRASHES:
+                    self._given_up = True
+                    self._display_message("Giving up on clang worker %d after %d crashes in a row" % (
+                        self._configuration['worker_id'], MAXIMUM_CRASHES))
+                    return
+                delay = min(MAXIMUM_RESTART_DELAY, FIRST_RESTART_DELAY * 2 ** (self._crashes - 1))
+            time.sleep(delay)
+            with self._restart_lock:
+                if not self._alive:
+                    return
+                self._restarts += 1
+                self._display_message("Restarting clang worker %d" % self._configuration['worker_id'])
+                try:
+                    self._start()
+                    return
+                except (IOError, OSError), e:
+                    self._display_message("Cannot start clang worker: " + str(e))
+
+    def _send(self, process, message):
+        with self._write_lock:
+            pickle.dump(message, process.stdin, pickle.HIGHEST_PROTOCOL)
+            process.stdin.flush()
+
+    def request(self, kind, *args):
+        if self._given_up:
+            return None
+        process = self._process
+        response = Response(process)
+        with self._pending_lock:
+            request_id = next(self._request_ids)
+            self._pending[request_id] = response
+        try:
+            self._send(process, (kind, args, request_id))
+        except IOError:
+            # The thread reading its responses restarts the process.
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            return None
+        if not response.wait(REQUEST_TIMEOUTS[kind]):
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            self._display_message("Clang worker %d did not answer %s in time" % (
+                self._configuration['worker_id'], kind))
+            return None
+        return response.result
+
+    def notify(self, kind, *args):
+        if self._given_up:
+            return
+        try:
+            self._send(self._process, (kind, args, None))
+        except IOError:
+            pass
+
+    def restarts(self):
+        return self._restarts
+
+    def given_up(self):
+        return self._given_up
+
+    def terminate(self):
+        with self._restart_lock:
+            self._alive = False
+            if self._process is None:
+                return
+            try:
+                self._process.stdin.close()
+            except IOError:
+                pass
+
+
+def _kill(process):
+    try:
+        process.kill()
+    except OSError:
+        pass
+    process.wait()